@@ -4,8 +4,14 @@ Tool for creating "views" of file containing histograms.
 
 Applies MC normalization factors, styles, etc.
 
+The views are backed by a HistogramCache: the result of each Get(path)
+through a view chain is memoized (LRU, bounded by an estimate of the memory
+used), and invalidated when the underlying files change.  The files are only
+opened when a histogram is first requested.
+
 '''
 
+from collections import OrderedDict
 import copy
 from data_styles import data_styles
 import fnmatch
@@ -16,6 +22,9 @@ from rootpy.plotting import views
 
 log = logging.getLogger("data_views")
 
+# Default memory bound of the histogram cache
+DEFAULT_CACHE_BYTES = 500e6
+
 def extract_sample(filename):
     ''' Get sample name from a path
 
@@ -38,7 +47,127 @@ def read_lumi(filename):
             print "I couldn't extract a float from %s" % filename
             raise
 
-def data_views(files, lumifiles):
+def _estimate_bytes(obj):
+    ''' Rough estimate of the memory used by a cached object '''
+    if hasattr(obj, 'InheritsFrom') and obj.InheritsFrom('TH1'):
+        # contents + sum of weights squared, plus the object itself
+        return 16 * obj.GetSize() + 1024
+    return 1024
+
+def _detach(obj):
+    ''' Make sure ROOT doesn't delete [obj] when a file is closed '''
+    if hasattr(obj, 'InheritsFrom') and obj.InheritsFrom('TH1'):
+        obj.SetDirectory(0)
+    return obj
+
+class LazyFile(object):
+    ''' A rootpy file which is only opened when it is first accessed
+
+    If the file is modified on disk, it is reopened.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.opened_stamp = None
+
+    def stamp(self):
+        ''' Get the (mtime, size) of the file '''
+        stat = os.stat(self.path)
+        return (stat.st_mtime, stat.st_size)
+
+    def open(self):
+        stamp = self.stamp()
+        if self.file is None or stamp != self.opened_stamp:
+            if self.file is not None:
+                log.info("%s changed on disk - reopening", self.path)
+                self.file.Close()
+            self.file = io.open(self.path)
+            self.opened_stamp = stamp
+        return self.file
+
+    def Get(self, path):
+        return self.open().Get(path)
+
+    def __getattr__(self, attr):
+        return getattr(self.open(), attr)
+
+class HistogramCache(object):
+    ''' LRU cache of the objects retrieved through views
+
+    Each entry is stored with the "stamps" of the files it was made from,
+    and is discarded if they don't match at lookup.
+
+    >>> cache = HistogramCache(max_bytes=2048)
+    >>> cache.put('a', (1,), 'histo a')
+    >>> cache.put('b', (1,), 'histo b')
+    >>> cache.get('a', (1,))
+    'histo a'
+    >>> cache.put('c', (1,), 'histo c') # evicts b, the least recently used
+    >>> cache.get('b', (1,)) is None
+    True
+    >>> cache.get('a', (2,)) is None # the file has changed
+    True
+    >>> cache.hits, cache.misses
+    (1, 2)
+    '''
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        # key => (stamps, object, size), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, stamps):
+        ''' Get a cached object, or None '''
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] != stamps:
+            if entry is not None:
+                self.bytes -= entry[2]
+            self.misses += 1
+            return None
+        # Mark as most recently used
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, stamps, obj):
+        ''' Add an object to the cache, evicting old ones if necessary '''
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+        size = _estimate_bytes(obj)
+        self.entries[key] = (stamps, obj, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+class CachedView(object):
+    ''' A view which caches the output of another view
+
+    [key] identifies the view chain (i.e. (sample, 'view')) and [files] are
+    the LazyFiles it reads from.  Get returns a copy of the cached object,
+    so it can be modified freely.
+    '''
+    def __init__(self, view, cache, key, files):
+        self.view = view
+        self.cache = cache
+        self.key = key
+        self.files = files
+
+    def Get(self, path):
+        stamps = tuple(x.stamp() for x in self.files)
+        obj = self.cache.get((self.key, path), stamps)
+        if obj is None:
+            obj = _detach(self.view.Get(path))
+            self.cache.put((self.key, path), stamps, obj)
+        return _detach(obj.Clone())
+
+    def __getattr__(self, attr):
+        return getattr(self.view, attr)
+
+def data_views(files, lumifiles, cache=None):
     ''' Builds views of files.
 
     [files] gives an iterator of .root files with histograms to build.
@@ -48,14 +177,18 @@ def data_views(files, lumifiles):
 
     The lumi to normalize to is taken as the sum of the data file int. lumis.
 
+    [cache] is the HistogramCache to use.  By default a new one is made.
+
     '''
 
     files = list(files)
+    if cache is None:
+        cache = HistogramCache()
 
     log.info("Creating views from %i files", len(files))
 
     # Map sample_name => root file
-    histo_files = dict((extract_sample(x), io.open(x)) for x in files)
+    histo_files = dict((extract_sample(x), LazyFile(x)) for x in files)
 
     # Map sample_name => lumi file
     lumi_files = dict((extract_sample(x), read_lumi(x)) for x in lumifiles)
@@ -122,18 +255,25 @@ def data_views(files, lumifiles):
             'intlumi': intlumi,
             'file' : raw_file,
             'weight' : weight,
-            'view' : view,
-            'unweighted_view' : unweighted_view
+            'view' : CachedView(view, cache, (sample, 'view'), [raw_file]),
+            'unweighted_view' : CachedView(
+                unweighted_view, cache, (sample, 'unweighted_view'),
+                [raw_file]),
         }
 
     # Merge the data into just 'data'
     log.info("Merging data together")
+    data_files = [histo_files[x] for x in datafiles]
     output['data'] = {
         'intlumi' : datalumi,
         'weight' : 1,
-        'view' : views.SumView(*[output[x]['view'] for x in datafiles]),
-        'unweighted_view' : views.SumView(*[output[x]['unweighted_view']
-                                            for x in datafiles]),
+        'view' : CachedView(
+            views.SumView(*[output[x]['view'] for x in datafiles]),
+            cache, ('data', 'view'), data_files),
+        'unweighted_view' : CachedView(
+            views.SumView(*[output[x]['unweighted_view']
+                            for x in datafiles]),
+            cache, ('data', 'unweighted_view'), data_files),
     }
 
     return output
@@ -7,6 +7,9 @@ Pick events
 Usage:
     pick.py primds json_file1 json_file2 --output output_name
 
+The json files are megaevents.py outputs, in JSON-lines or the old single
+list format.
+
 Author: Evan K. Friis, UW Madison
 
 '''
@@ -15,10 +18,10 @@ from RecoLuminosity.LumiDB import argparse
 import sys
 import logging
 import os
-import json
 from subprocess import Popen, PIPE, STDOUT
 from FinalStateAnalysis.MetaData.datadefs import datadefs
 import FinalStateAnalysis.MetaData.datatools as datatools
+from FinalStateAnalysis.PlotTools.eventlists import read_events
 
 if __name__ == "__main__":
     log = logging.getLogger("pick")
@@ -46,7 +49,7 @@ if __name__ == "__main__":
     for json_input_name in args.json_file:
         log.info("Getting events from %s", json_input_name)
         with open(json_input_name, 'r') as json_input:
-            this_event_list = json.load(json_input)
+            this_event_list = list(read_events(json_input))
             log.info("=> got %i events", len(this_event_list))
             event_list.extend(this_event_list)
 
@@ -5,6 +5,13 @@
 The event list should be passed in via stdin.  The list should be formatted
 with one run:lumi:event per line, separated by colon.
 
+The input files are skimmed in parallel.  For each file, only the run, lumi
+and evt branches are read (in chunks, into NumPy arrays) and matched against
+the event list, then only the selected entries are copied.  The skimmed
+trees are merged into the output file.
+
+With --index, the entries are instead looked up in the (cached) EventIndex
+of each file, so the files are only scanned the first time.
 
 Example:
 
@@ -13,10 +20,91 @@ Example:
 """
 
 from RecoLuminosity.LumiDB import argparse
+import hashlib
 import logging
+import multiprocessing
+import numpy
+import os
+import tempfile
+
+from FinalStateAnalysis.PlotTools.MegaColumns import iter_chunks
 
 log = logging.getLogger(__name__)
 
+# The event list, set before the pool is forked
+_events = set([])
+_evts = None
+
+def read_event_list(evts):
+    ''' Read a run:lumi:evt list into a set of (run, lumi, evt) tuples '''
+    output = set([])
+    for evt in evts:
+        if not evt.strip():
+            # skip blank lines
+            continue
+        output.add(tuple(int(x) for x in evt.strip().split(':')))
+    return output
+
+def select_entries(tree):
+    ''' Find the entries of the tree which are in the event list
+
+    The evt numbers are first checked against the sorted array of the
+    evt numbers in the list, then the candidates are checked exactly.
+
+    Returns a list of (entry, (run, lumi, evt)).
+    '''
+    output = []
+    for chunk in iter_chunks(tree, ['run', 'lumi', 'evt']):
+        evt = chunk.evt.astype(numpy.int64)
+        candidates = numpy.nonzero(numpy.in1d(evt, _evts))[0]
+        for i in candidates:
+            key = (int(chunk.run[i]), int(chunk.lumi[i]), int(evt[i]))
+            if key in _events:
+                output.append((chunk.first_entry + int(i), key))
+    return output
+
+def indexed_entries(input_file, treename):
+    ''' Find the entries in the event list using the EventIndex of a file '''
+    from FinalStateAnalysis.PlotTools.EventIndex import EventIndex, \
+        load_file_index
+    index = EventIndex([input_file], load_file_index(input_file, treename))
+    output = []
+    for key in _events:
+        output.extend((entry, key) for file, entry in index.find(*key))
+    return sorted(output)
+
+def skim_file(input_file, treename, output_file, use_index=False):
+    ''' Copy the selected entries of a tree into [output_file]
+
+    Returns the set of (run, lumi, evt) found.
+    '''
+    import ROOT
+    input = ROOT.TFile.Open(input_file, "READ")
+    if not input or input.IsZombie():
+        raise IOError("Can't open input file %s" % input_file)
+    tree = input.Get(treename)
+    if not tree:
+        raise IOError("Can't get tree %s from %s" % (treename, input_file))
+    if use_index:
+        selected = indexed_entries(input_file, treename)
+    else:
+        selected = select_entries(tree)
+    output = ROOT.TFile(output_file, "RECREATE")
+    output.cd()
+    new_tree = tree.CloneTree(0)
+    for entry, key in selected:
+        tree.GetEntry(entry)
+        new_tree.Fill()
+    new_tree.Write()
+    output.Close()
+    input.Close()
+    log.info("%s: selected %i entries", input_file, len(selected))
+    return set(key for entry, key in selected)
+
+def _skim_file(args):
+    ''' Pool.imap helper '''
+    return skim_file(*args)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("tree", metavar="path/to/TTree",
@@ -28,56 +116,51 @@ if __name__ == "__main__":
     parser.add_argument("--event-list", default="/dev/stdin",
                         metavar='/dev/stdin', dest='evts',
                         help="Event list .txt file. Default: /dev/stdin")
+    parser.add_argument('--workers', type=int, required=False, default=4,
+                        help='Number of worker processes (def: 4)')
+    parser.add_argument('--index', action='store_true',
+                        help='Use (and build if needed) the event index of'
+                        ' the input files')
 
     args = parser.parse_args()
 
     import ROOT
     #ROOT.SetBatch(True)
+    from FinalStateAnalysis.PlotTools.MegaMerger import merge_files
 
     logging.basicConfig(level=logging.INFO)
 
-    chain = ROOT.TChain(args.tree)
-
-    log.info("Adding %i files", len(args.inputs))
-
-    for in_file in args.inputs:
-        chain.Add(in_file)
-
-    run_lumis = []
-
-    run_lumi_set = set([])
-
     with open(args.evts, 'r') as evts:
-        for evt in evts:
-            if not evt.strip():
-                # skip blank lines
-                continue
-            datum = tuple(evt.strip().split(':'))
-            run_lumis.append(
-                "(run == %s && lumi == %s && evt == %s)" %
-                datum
-            )
-            run_lumi_set.add(
-                tuple(int(x) for x in datum)
-            )
-
-    log.info("Skimming %i vents", len(run_lumis))
-
-    # Make a huge cut string
-    the_cut = " || ".join(run_lumis)
-
-    output = ROOT.TFile(args.output, "RECREATE")
-    output.cd()
+        run_lumi_set = read_event_list(evts)
+    _events.update(run_lumi_set)
+    _evts = numpy.unique(numpy.array(
+        [evt for run, lumi, evt in run_lumi_set], dtype=numpy.int64))
 
-    log.info("Trimming tree...")
-    new_tree = chain.CopyTree(the_cut)
+    log.info("Skimming %i events from %i files",
+             len(run_lumi_set), len(args.inputs))
 
-    log.info("Trimmed tree has %i entries", new_tree.GetEntries())
+    temp_outputs = [os.path.join(
+        tempfile.gettempdir(),
+        hashlib.md5(args.output + in_file).hexdigest() + '.root')
+        for in_file in args.inputs]
 
     final_run_lumi_set = set()
-
-    for row in new_tree:
-        final_run_lumi_set.add((int(row.run), int(row.lumi), int(row.evt)))
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for found in pool.imap_unordered(_skim_file, [
+                (in_file, args.tree, temp_output, args.index)
+                for in_file, temp_output
+                in zip(args.inputs, temp_outputs)]):
+            final_run_lumi_set.update(found)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    log.info("Merging skimmed trees into %s", args.output)
+    merge_files(temp_outputs, args.output)
 
     log.info("corresponding to %i unique events", len(final_run_lumi_set))
 
@@ -86,5 +169,3 @@ if __name__ == "__main__":
         log.warning("I couldn't find %i events!", len(difference))
         for run, lumi, evt in difference:
             print run, lumi, evt
-
-    new_tree.Write()
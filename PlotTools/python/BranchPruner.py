@@ -0,0 +1,155 @@
+'''
+
+Automatically disable the branches a selector does not use.
+
+Wide ntuples have ~1000 branches, and with all of them active every
+TTree::GetEntry decompresses all of them.  The BranchPruner wraps the TTree
+handed to the selector and records which branches are accessed during the
+first [learn_entries] entries.  After the learning phase, all branches are
+disabled except:
+
+    * the ones accessed during learning
+    * the ones declared in the selector "branches" class variable
+    * the ones touched by the selector MetaTree (either the selector
+      "meta" attribute or a module level "meta" object)
+
+If a disabled branch is accessed after the learning phase, it is re-enabled
+and the current entry is re-read, so the selector never sees stale values.
+
+'''
+
+import sys
+import ROOT
+
+
+def selector_branches(selector):
+    ''' Get the branches a selector declares it needs '''
+    output = set(getattr(selector, 'branches', []))
+    meta = getattr(selector, 'meta', None)
+    if meta is None:
+        module = sys.modules.get(selector.__class__.__module__)
+        meta = getattr(module, 'meta', None)
+    if meta is not None:
+        output.update(meta.active_branches())
+    return output
+
+
+def _zip_bytes(tree):
+    ''' Map branch name => compressed size for the current tree '''
+    output = {}
+    for branch in tree.GetTree().GetListOfBranches():
+        output[branch.GetName()] = branch.GetZipBytes("*")
+    return output
+
+
+class BranchPruner(object):
+    def __init__(self, tree, log, learn_entries=1000):
+        self.tree = tree
+        self.log = log
+        self.learn_entries = learn_entries
+        self.entries_read = 0
+        self.pruned = False
+        if not tree.GetListOfBranches():
+            # TChains don't have branches until the first tree is loaded
+            tree.LoadTree(0)
+        self.all_branches = set(
+            branch.GetName() for branch in tree.GetListOfBranches())
+        # Branches which are known to be needed
+        self.enabled = set([])
+        self.late_branches = set([])
+        self.bytes_read_start = ROOT.TFile.GetFileBytesRead()
+
+    def declare(self, branches):
+        ''' Declare branches which should always be read '''
+        for branch in branches:
+            if branch not in self.all_branches:
+                self.log.warning("Declared branch %s does not exist", branch)
+                continue
+            self.enabled.add(branch)
+            if self.pruned:
+                self.tree.SetBranchStatus(branch, 1)
+
+    def prune(self):
+        ''' Disable all branches that have not been declared or accessed '''
+        self.log.info("Learned %i/%i used branches after %i entries",
+                      len(self.enabled), len(self.all_branches),
+                      self.entries_read)
+        self.tree.SetBranchStatus('*', 0)
+        for branch in self.enabled:
+            self.tree.SetBranchStatus(branch, 1)
+        self.pruned = True
+
+    def touch(self, branch):
+        ''' Record that a branch is accessed '''
+        if branch not in self.all_branches:
+            return
+        self.enabled.add(branch)
+        if self.pruned:
+            # We disabled something we need.  Turn it on and reload.
+            self.log.warning("Branch %s was accessed after the learning "
+                             "phase - re-enabling it", branch)
+            self.late_branches.add(branch)
+            self.tree.SetBranchStatus(branch, 1)
+            self.tree.GetEntry(self.tree.GetReadEntry())
+
+    def entry_loaded(self):
+        ''' Count the entries read, and prune after the learning phase '''
+        self.entries_read += 1
+        if not self.pruned and self.entries_read > self.learn_entries:
+            self.prune()
+
+    def report(self):
+        ''' Log the fraction of the compressed ntuple we skipped '''
+        if not self.pruned:
+            return
+        sizes = _zip_bytes(self.tree)
+        total = sum(sizes.itervalues())
+        used = sum(size for branch, size in sizes.iteritems()
+                   if branch in self.enabled)
+        if not total:
+            return
+        bytes_read = ROOT.TFile.GetFileBytesRead() - self.bytes_read_start
+        # Estimate what we would have read with all the branches enabled.
+        saved = 0.
+        if used:
+            saved = bytes_read * (float(total) / used - 1.)
+        self.log.info(
+            "Read %i/%i branches (%0.1f%% of the compressed size).  "
+            "Read %0.1f MB, saved ~%0.1f MB", len(self.enabled),
+            len(self.all_branches), 100. * used / total,
+            bytes_read / 1e6, saved / 1e6)
+        if self.late_branches:
+            self.log.warning(
+                "Branches %s were only used after the learning phase, "
+                "consider declaring them in the selector 'branches'",
+                ' '.join(sorted(self.late_branches)))
+
+
+class PrunedTree(object):
+    ''' Proxy for a TTree which records branch accesses in a BranchPruner '''
+    def __init__(self, tree, pruner):
+        # Avoid triggering __getattr__ for our own members
+        self.__dict__['_tree'] = tree
+        self.__dict__['_pruner'] = pruner
+        self.__dict__['_enabled'] = pruner.enabled
+
+    def __getattr__(self, attr):
+        if attr not in self._enabled:
+            self._pruner.touch(attr)
+        return getattr(self._tree, attr)
+
+    def __iter__(self):
+        for row in self._tree:
+            self._pruner.entry_loaded()
+            yield self
+
+    def GetEntry(self, entry, getall=0):
+        result = self._tree.GetEntry(entry, getall)
+        self._pruner.entry_loaded()
+        return result
+
+    def SetBranchStatus(self, branch, status, *args):
+        ''' Keep track of branches enabled by the selector itself '''
+        if status and branch in self._pruner.all_branches:
+            self._pruner.declare([branch])
+        return self._tree.SetBranchStatus(branch, status, *args)
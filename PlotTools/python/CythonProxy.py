@@ -0,0 +1,581 @@
+'''
+
+Generate (and cache) Cython TTree proxies.
+
+A proxy is a compiled class which reads the branches of a TTree directly
+into typed C++ members, which is much faster than PyROOT attribute access.
+
+Supported branch types are all the simple leaf types (B, b, S, s, I, i, F,
+D, L, l, G, g, O), fixed and variable length arrays of those (x[3]/F,
+x[n]/F), C strings (x/C), std::string's and std::vector's of simple types
+or of std::string.  Other branches are skipped with a warning; the proxy
+complains (once) if the selector tries to use one of them.
+
+Besides per-branch properties, the proxy has a bulk read method::
+
+    chunk = proxy.read_chunk(start, n, branches=None)
+
+which returns a dictionary mapping the name of each scalar branch to a
+contiguous typed buffer (supporting the buffer protocol, so
+numpy.asarray(chunk['muPt']) does not copy).
+
+If the proxy is built on a mega EntryRangeTree, the iteration and the bulk
+reads are restricted to its range of entries.
+
+Proxies can be built and cached automatically::
+
+    from FinalStateAnalysis.PlotTools.CythonProxy import load_proxy
+    MuMuTree = load_proxy(tree, 'MuMuTree')
+    for row in MuMuTree(tree):
+        ...
+
+The compiled module is keyed by a hash of the tree schema, so it is rebuilt
+when the ntuple layout changes.  The cache is in $MEGAPROXYCACHE
+(default: ~/.megaproxies).
+
+'''
+
+from collections import namedtuple
+import cStringIO
+import hashlib
+import imp
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import warnings
+
+# Bump this if the generated code changes, to invalidate the cache.
+_PROXY_VERSION = 4
+
+DEFAULT_CACHE = os.environ.get(
+    'MEGAPROXYCACHE', os.path.expanduser('~/.megaproxies'))
+
+# Minimum buffer size for variable length arrays
+DEFAULT_MAX_ARRAY = 1000
+
+# Minimum buffer size for C string (x/C) branches
+DEFAULT_MAX_STRING = 1024
+
+# A branch: kind is 'scalar', 'array', 'chars' (C string), 'string'
+# (std::string), 'vector' or 'unsupported'.  Arrays and C strings have a
+# length (the buffer size) and variable length arrays a counter branch.
+# For unsupported branches, ctype describes the type.
+BranchSpec = namedtuple('BranchSpec',
+                        ['name', 'ctype', 'kind', 'length', 'counter'])
+
+# Leaf type code => C type
+_leaf_types = {
+    'B': 'signed char',
+    'b': 'unsigned char',
+    'S': 'short',
+    's': 'unsigned short',
+    'I': 'int',
+    'i': 'unsigned int',
+    'F': 'float',
+    'D': 'double',
+    'L': 'long long',
+    'l': 'unsigned long long',
+    # Long_t/ULong_t, 64 bits on the platforms we use
+    'G': 'long long',
+    'g': 'unsigned long long',
+    'O': 'cbool',
+}
+
+# C++ type in a std::vector<...> => C type
+_vector_types = {
+    'char': 'signed char',
+    'unsigned char': 'unsigned char',
+    'short': 'short',
+    'unsigned short': 'unsigned short',
+    'int': 'int',
+    'unsigned int': 'unsigned int',
+    'float': 'float',
+    'double': 'double',
+    'long': 'long',
+    'unsigned long': 'unsigned long',
+    'long long': 'long long',
+    'Long64_t': 'long long',
+    'ULong64_t': 'unsigned long long',
+    'bool': 'cbool',
+    'string': 'string',
+    'std::string': 'string',
+}
+
+# C type => (buffer C type, buffer format) used in read_chunk
+_chunk_types = {
+    'signed char': ('signed char', 'b'),
+    'unsigned char': ('unsigned char', 'B'),
+    'short': ('short', 'h'),
+    'unsigned short': ('unsigned short', 'H'),
+    'int': ('int', 'i'),
+    'unsigned int': ('unsigned int', 'I'),
+    'float': ('float', 'f'),
+    'double': ('double', 'd'),
+    'long long': ('long long', 'q'),
+    'unsigned long long': ('unsigned long long', 'Q'),
+    'cbool': ('unsigned char', 'B'),
+}
+
+_leaflist_matcher = re.compile(
+    r'^(?P<name>\w+)(\[(?P<dim>\w+)\])?/(?P<type>\w)$')
+_vector_matcher = re.compile(r'^(std::)?vector<(?P<type>[\w: ]+?) ?>$')
+
+_pyx_template = '''
+
+# Load relevant ROOT C++ headers
+cdef extern from "TObject.h":
+    cdef cppclass TObject:
+        pass
+
+cdef extern from "TBranch.h":
+    cdef cppclass TBranch:
+        int GetEntry(long, int)
+        void SetAddress(void*)
+
+cdef extern from "TTree.h":
+    cdef cppclass TTree:
+        TTree()
+        int GetEntry(long, int)
+        long LoadTree(long)
+        long GetEntries()
+        TTree* GetTree()
+        int GetTreeNumber()
+        TBranch* GetBranch(char*)
+
+cdef extern from "TFile.h":
+    cdef cppclass TFile:
+        TFile(char*, char*, char*, int)
+        TObject* Get(char*)
+
+# Used for filtering with a string
+cdef extern from "TTreeFormula.h":
+    cdef cppclass TTreeFormula:
+        TTreeFormula(char*, char*, TTree*)
+        double EvalInstance(int, char**)
+        void UpdateFormulaLeaves()
+        void SetTree(TTree*)
+
+from cpython cimport PyCObject_AsVoidPtr
+from cython cimport view
+from libcpp cimport bool as cbool
+from libcpp.string cimport string
+from libcpp.vector cimport vector
+import warnings
+def my_warning_format(message, category, filename, lineno, line=""):
+    return "%s:%s\\n" % (category.__name__, message)
+warnings.formatwarning = my_warning_format
+
+# Branch name => type of the branches which are not in the proxy
+unsupported_branches = {unsupported!r}
+
+cdef class {TreeName}:
+    # Pointers to tree (may be a chain), current active tree, and current entry
+    # localentry is the entry in the current tree of the chain
+    cdef TTree* tree
+    cdef TTree* currentTree
+    cdef int currentTreeNumber
+    cdef long ientry
+    cdef long localentry
+    # Range of entries to iterate over [firstentry, lastentry)
+    cdef long firstentry
+    cdef long lastentry
+    # Keep track of missing branches we have complained about.
+    cdef public set complained
+
+    # Branches and address for all
+{branchblock}
+
+    def __cinit__(self, ttree):
+        #print "cinit"
+        # Constructor from a ROOT.TTree
+        from ROOT import AsCObject
+        # Unwrap the mega tree proxies, keeping the range of an
+        # EntryRangeTree if there is one
+        first_entry, nentries = getattr(ttree, 'entry_range', (0, None))
+        while hasattr(ttree, '_tree'):
+            ttree = ttree._tree
+        self.tree = <TTree*>PyCObject_AsVoidPtr(AsCObject(ttree))
+        self.firstentry = first_entry
+        if nentries is None:
+            self.lastentry = self.tree.GetEntries()
+        else:
+            self.lastentry = first_entry + nentries
+        self.ientry = first_entry
+        self.currentTreeNumber = -1
+        #print self.tree.GetEntries()
+        #self.load_entry(0)
+        self.complained = set([])
+{allocblock}
+
+    def __dealloc__(self):
+        pass
+{deallocblock}
+
+    cdef load_entry(self, long i):
+        #print "load", i
+        # Load the correct tree and setup the branches
+        self.localentry = self.tree.LoadTree(i)
+        #print "local", self.localentry
+        new_tree = self.tree.GetTree()
+        #print "tree", <long>(new_tree)
+        treenum = self.tree.GetTreeNumber()
+        #print "num", treenum
+        if treenum != self.currentTreeNumber or new_tree != self.currentTree:
+            #print "New tree!"
+            self.currentTree = new_tree
+            self.currentTreeNumber = treenum
+            self.setup_branches(new_tree)
+
+    cdef setup_branches(self, TTree* the_tree):
+        #print "setup"
+{setbranchesblock}
+
+    # Iterating over the tree
+    def __iter__(self):
+        self.ientry = self.firstentry
+        while self.ientry < self.lastentry:
+            self.load_entry(self.ientry)
+            yield self
+            self.ientry += 1
+
+    # Iterate over rows which pass the filter
+    def where(self, filter):
+        print "where"
+        cdef TTreeFormula* formula = new TTreeFormula(
+            "cyiter", filter, self.tree)
+        self.ientry = self.firstentry
+        cdef TTree* currentTree = self.tree.GetTree()
+        while self.ientry < self.lastentry:
+            self.tree.LoadTree(self.ientry)
+            if currentTree != self.tree.GetTree():
+                currentTree = self.tree.GetTree()
+                formula.SetTree(currentTree)
+                formula.UpdateFormulaLeaves()
+            if formula.EvalInstance(0, NULL):
+                yield self
+            self.ientry += 1
+        del formula
+
+    # Bulk read of the scalar branches into typed buffers
+    def read_chunk(self, long start, long n, branches=None):
+        cdef long i
+        cdef long nentries = self.lastentry
+        if start < self.firstentry:
+            n -= self.firstentry - start
+            start = self.firstentry
+        if start + n > nentries:
+            n = nentries - start
+        if n <= 0:
+            return {{}}
+        output = {{}}
+{chunkdeclblock}
+{chunkallocblock}
+        for i in range(n):
+            self.load_entry(start + i)
+{chunkfillblock}
+        return output
+
+    # Getting/setting the Tree entry number
+    property entry:
+        def __get__(self):
+            return self.ientry
+        def __set__(self, int i):
+            print i
+            self.ientry = i
+            self.load_entry(i)
+
+    # Access to the current branch values
+{getbranchesblock}
+
+    # Branches of types the proxy doesn't support
+    def __getattr__(self, name):
+        if name in unsupported_branches:
+            if name not in self.complained:
+                warnings.warn("{TreeName}: branch %s has an unsupported type"
+                              " (%s) and is not available in the proxy"
+                              % (name, unsupported_branches[name]), Warning)
+                self.complained.add(name)
+            raise AttributeError("{TreeName}: unsupported branch %s" % name)
+        raise AttributeError(name)
+
+'''
+
+_setup_template = '''
+# Tools to compile cython proxy class
+from distutils.core import setup
+from distutils.extension import Extension
+from Cython.Distutils import build_ext
+
+setup(ext_modules=[Extension(
+    "{modulename}",                 # name of extension
+    ["{modulename}.pyx"], #  our Cython source
+    include_dirs=['{incdir}'],
+    library_dirs=['{libdir}'],
+    libraries=['Tree', 'Core', 'TreePlayer'],
+    language="c++")],  # causes Cython to create C++ source
+    cmdclass={{'build_ext': build_ext}})
+'''
+
+
+def get_branches(tree):
+    ''' Get the list of branches in a tree
+
+    Returns a generator of BranchSpecs.
+
+    '''
+    for branch in tree.GetListOfBranches():
+        name = branch.GetName()
+        if branch.InheritsFrom('TBranchElement'):
+            classname = branch.GetClassName()
+            if classname in ('string', 'std::string'):
+                yield BranchSpec(name, 'string', 'string', None, None)
+                continue
+            match = _vector_matcher.match(classname)
+            if not match or match.group('type') not in _vector_types:
+                warnings.warn("Skipping branch %s of unsupported class %s" %
+                              (name, classname))
+                yield BranchSpec(name, classname, 'unsupported', None, None)
+                continue
+            yield BranchSpec(name, _vector_types[match.group('type')],
+                             'vector', None, None)
+            continue
+        match = _leaflist_matcher.match(branch.GetTitle())
+        if match and match.group('type') == 'C' and not match.group('dim'):
+            leaf = branch.GetLeaf(name)
+            length = max(DEFAULT_MAX_STRING, leaf.GetMaximum() + 1)
+            yield BranchSpec(name, 'char', 'chars', length, None)
+            continue
+        if not match or match.group('type') not in _leaf_types:
+            warnings.warn("Skipping branch %s of unsupported type %s" %
+                          (name, branch.GetTitle()))
+            yield BranchSpec(name, branch.GetTitle(), 'unsupported', None,
+                             None)
+            continue
+        ctype = _leaf_types[match.group('type')]
+        dim = match.group('dim')
+        if dim is None:
+            yield BranchSpec(name, ctype, 'scalar', None, None)
+        elif dim.isdigit():
+            yield BranchSpec(name, ctype, 'array', int(dim), None)
+        else:
+            counter = branch.GetLeaf(name).GetLeafCount()
+            length = max(DEFAULT_MAX_ARRAY, counter.GetMaximum())
+            yield BranchSpec(name, ctype, 'array', length, dim)
+
+
+def schema_hash(branches):
+    ''' Hash of a list of BranchSpecs, used to key the proxy cache '''
+    hash = hashlib.sha1(str(_PROXY_VERSION))
+    for branch in branches:
+        hash.update(repr(tuple(branch)))
+    return hash.hexdigest()[:16]
+
+
+def make_pyx(name, branches):
+    ''' Generate the content of a pyx file for a list of BranchSpecs '''
+    blocks = dict((x, cStringIO.StringIO()) for x in [
+        'branchblock', 'allocblock', 'deallocblock', 'setbranchesblock',
+        'chunkdeclblock', 'chunkallocblock', 'chunkfillblock',
+        'getbranchesblock'])
+
+    unsupported = {}
+
+    # Declare data members & methods for each branch.
+    for branch in branches:
+        if branch.kind == 'unsupported':
+            unsupported[branch.name] = branch.ctype
+            continue
+        fmt = dict(branchname=branch.name, branchtype=branch.ctype,
+                   length=branch.length, counter=branch.counter,
+                   TreeName=name)
+        # We need both a pointer to the TBranch, and
+        # an owned C++ type (int, float, etc) that the TBranch
+        # will point too.
+        blocks['branchblock'].write('''
+    cdef TBranch* {branchname}_branch
+'''.format(**fmt))
+        if branch.kind == 'scalar':
+            blocks['branchblock'].write('''
+    cdef {branchtype} {branchname}_value
+'''.format(**fmt))
+            address = '&self.{branchname}_value'
+        elif branch.kind in ('array', 'chars'):
+            blocks['branchblock'].write('''
+    cdef {branchtype} {branchname}_value[{length}]
+'''.format(**fmt))
+            address = 'self.{branchname}_value'
+        elif branch.kind == 'string':
+            # Object branches need the address of a pointer to the object
+            blocks['branchblock'].write('''
+    cdef string* {branchname}_value
+'''.format(**fmt))
+            blocks['allocblock'].write('''
+        self.{branchname}_value = new string()
+'''.format(**fmt))
+            blocks['deallocblock'].write('''
+        del self.{branchname}_value
+'''.format(**fmt))
+            address = '&self.{branchname}_value'
+        else:
+            # Object branches need the address of a pointer to the object
+            blocks['branchblock'].write('''
+    cdef vector[{branchtype}]* {branchname}_value
+'''.format(**fmt))
+            blocks['allocblock'].write('''
+        self.{branchname}_value = new vector[{branchtype}]()
+'''.format(**fmt))
+            blocks['deallocblock'].write('''
+        del self.{branchname}_value
+'''.format(**fmt))
+            address = '&self.{branchname}_value'
+
+        # Initialize the branch members.  The branch pointer
+        # is loaded from the tree, and the branch address
+        # is set to the owned value object.
+        blocks['setbranchesblock'].write(('''
+        #print "making {branchname}"
+        self.{branchname}_branch = the_tree.GetBranch("{branchname}")
+        #if not self.{branchname}_branch and "{branchname}" not in self.complained:
+        if not self.{branchname}_branch and "{branchname}":
+            warnings.warn( "{TreeName}: Expected branch {branchname} does not exist!" \\
+               " It will crash if you try and use it!",Warning)
+            #self.complained.add("{branchname}")
+        else:
+            self.{branchname}_branch.SetAddress(<void*>%s)
+''' % address).format(**fmt))
+
+        # Define a property for each branch.
+        # When the attribute is gotten, it will call
+        # GetEntry on the branch to load the information
+        # into the value, and then return the value.
+        # Note that the entry number is available/set via
+        # the class member ientry.
+        if branch.kind == 'scalar':
+            blocks['getbranchesblock'].write('''
+    property {branchname}:
+        def __get__(self):
+            self.{branchname}_branch.GetEntry(self.localentry, 0)
+            return self.{branchname}_value
+'''.format(**fmt))
+        elif branch.kind == 'chars':
+            # The buffer is null terminated by ROOT
+            blocks['getbranchesblock'].write('''
+    property {branchname}:
+        def __get__(self):
+            self.{branchname}_branch.GetEntry(self.localentry, 0)
+            return <bytes>(<char*>self.{branchname}_value)
+'''.format(**fmt))
+        elif branch.kind == 'array' and branch.counter is None:
+            blocks['getbranchesblock'].write('''
+    property {branchname}:
+        def __get__(self):
+            cdef int i
+            self.{branchname}_branch.GetEntry(self.localentry, 0)
+            return [self.{branchname}_value[i] for i in range({length})]
+'''.format(**fmt))
+        elif branch.kind == 'array':
+            # Check the counter before reading, so we never overflow the
+            # buffer.
+            blocks['getbranchesblock'].write('''
+    property {branchname}:
+        def __get__(self):
+            cdef int i
+            self.{counter}_branch.GetEntry(self.localentry, 0)
+            if self.{counter}_value > {length}:
+                raise IndexError("{TreeName}: {counter} = %i is larger "
+                                 "than the {branchname} buffer ({length})"
+                                 % self.{counter}_value)
+            self.{branchname}_branch.GetEntry(self.localentry, 0)
+            return [self.{branchname}_value[i]
+                    for i in range(self.{counter}_value)]
+'''.format(**fmt))
+        else:
+            blocks['getbranchesblock'].write('''
+    property {branchname}:
+        def __get__(self):
+            self.{branchname}_branch.GetEntry(self.localentry, 0)
+            return self.{branchname}_value[0]
+'''.format(**fmt))
+
+        # Bulk reading is only supported for scalars.
+        if branch.kind != 'scalar':
+            continue
+        chunktype, chunkformat = _chunk_types[branch.ctype]
+        fmt.update(chunktype=chunktype, chunkformat=chunkformat)
+        blocks['chunkdeclblock'].write('''
+        cdef {chunktype}[:] {branchname}_chunk
+        cdef bint {branchname}_wanted = \\
+            branches is None or "{branchname}" in branches
+'''.format(**fmt))
+        blocks['chunkallocblock'].write('''
+        if {branchname}_wanted:
+            output["{branchname}"] = view.array(
+                shape=(n,), itemsize=sizeof({chunktype}),
+                format="{chunkformat}")
+            {branchname}_chunk = output["{branchname}"]
+'''.format(**fmt))
+        blocks['chunkfillblock'].write('''
+            if {branchname}_wanted:
+                self.{branchname}_branch.GetEntry(self.localentry, 0)
+                {branchname}_chunk[i] = <{chunktype}>self.{branchname}_value
+'''.format(**fmt))
+
+    return _pyx_template.format(
+        TreeName=name, unsupported=unsupported,
+        **dict((key, value.getvalue()) for key, value in blocks.iteritems())
+    )
+
+
+def root_paths():
+    ''' Figure out the root include and lib paths '''
+    incdir = subprocess.Popen(
+        ['root-config', '--incdir'],
+        stdout=subprocess.PIPE).communicate()[0].strip()
+    libdir = subprocess.Popen(
+        ['root-config', '--libdir'],
+        stdout=subprocess.PIPE).communicate()[0].strip()
+    return incdir, libdir
+
+
+def make_setup(modulename):
+    ''' Generate the content of the setup.py used to build a proxy '''
+    incdir, libdir = root_paths()
+    return _setup_template.format(
+        incdir=incdir, libdir=libdir, modulename=modulename)
+
+
+def build_proxy(branches, classname, modulename, output_dir):
+    ''' Generate and compile a proxy module into output_dir
+
+    The module is compiled in a temporary directory and moved into place,
+    so concurrent builds of the same module are safe.
+    '''
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    build_dir = tempfile.mkdtemp(dir=output_dir)
+    try:
+        with open(os.path.join(build_dir, modulename + '.pyx'), 'w') as pyx:
+            pyx.write(make_pyx(classname, branches))
+        with open(os.path.join(build_dir, 'setup.py'), 'w') as setup:
+            setup.write(make_setup(modulename))
+        subprocess.check_call(
+            [sys.executable, 'setup.py', 'build_ext', '--inplace'],
+            cwd=build_dir)
+        os.rename(os.path.join(build_dir, modulename + '.so'),
+                  os.path.join(output_dir, modulename + '.so'))
+    finally:
+        shutil.rmtree(build_dir)
+
+
+def load_proxy(tree, classname, cache_dir=DEFAULT_CACHE):
+    ''' Get the proxy class for a tree, building it if necessary '''
+    branches = list(get_branches(tree))
+    modulename = '%s_%s' % (classname, schema_hash(branches))
+    library = os.path.join(cache_dir, modulename + '.so')
+    if not os.path.exists(library):
+        build_proxy(branches, classname, modulename, cache_dir)
+    module = imp.load_dynamic(modulename, library)
+    return getattr(module, classname)
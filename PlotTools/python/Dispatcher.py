@@ -7,6 +7,10 @@ Process dispatcher function for Mega framework
 import multiprocessing
 from MegaWorker import MegaWorker
 from MegaMerger import MegaMerger
+from MegaAccumulator import MegaAccumulator
+from EntryRange import split_entries
+from MegaIndex import MegaIndex
+from MegaScheduler import UsageMonitor, WorkerScheduler
 import sys
 
 def group_list(files, n=1):
@@ -28,7 +32,11 @@ def group_list(files, n=1):
 class MegaDispatcher(object):
     log = multiprocessing.get_logger()
     def __init__(self, files, treename, output_file, selector, nworkers,
-                 nchain=1):
+                 nchain=1, chunk_size=None, learn_entries=None, nmergers=2,
+                 in_memory=False, min_entries=None, report=None,
+                 profile_dir=None, samples=None, sample_interval=None,
+                 max_workers=None, memory_budget=None, max_tasks=None,
+                 poll_interval=2.):
         self.files = files
         self.treename = treename
         self.output_file = output_file
@@ -36,65 +44,158 @@ class MegaDispatcher(object):
         self.nworkers = nworkers
         # Figure out how many inputs to chain together
         self.nchain=nchain
-
-    def build_workers(self, input_q, result_q):
-        workers = [
-            MegaWorker(input_q, result_q, self.treename, self.selector)
-            for x in range(self.nworkers)
-        ]
-        return workers
+        # If set, run the selector in columnar mode with this chunk size
+        self.chunk_size = chunk_size
+        # If set, prune unused branches after this many entries
+        self.learn_entries = learn_entries
+        # Number of parallel merge processes
+        self.nmergers = nmergers
+        # Sum the histograms in memory instead of merging temporary files
+        self.in_memory = in_memory
+        # If set, split the files into entry ranges with at least this
+        # many entries, instead of (groups of) files.
+        self.min_entries = min_entries
+        # If set, write a JSON telemetry report to this file
+        self.report = report
+        # If set, write cProfile outputs of each job in this directory
+        self.profile_dir = profile_dir
+        # If set, sample the stacks of the workers every [sample_interval]
+        # seconds, and write the collapsed stacks to [samples]
+        self.samples = samples
+        self.sample_interval = sample_interval if samples else None
+        # The pool starts with [nworkers] workers, and grows up to
+        # [max_workers] while the workers are I/O bound.
+        self.max_workers = max_workers
+        # If set, stop workers when the job uses more than this many bytes
+        self.memory_budget = memory_budget
+        # If set, replace the workers after this many jobs
+        self.max_tasks = max_tasks
+        # Seconds between the measurements of the worker usage
+        self.poll_interval = poll_interval
+
+    def build_worker(self, input_q, result_q, taken):
+        ''' Build a worker, which can be stopped with worker.stop.set() '''
+        return MegaWorker(input_q, result_q, self.treename, self.selector,
+                          chunk_size=self.chunk_size,
+                          learn_entries=self.learn_entries,
+                          in_memory=self.in_memory,
+                          profile_dir=self.profile_dir,
+                          sample_interval=self.sample_interval,
+                          stop=multiprocessing.Event(),
+                          max_tasks=self.max_tasks, taken=taken,
+                          time_entries=bool(self.report or self.samples))
+
+    def work_units(self):
+        ''' Generate the work units to put in the process queue '''
+        if self.min_entries is None:
+            self.log.info(
+                "Putting %i files into the process queue, grouped into %i file chunks",
+                len(self.files), self.nchain)
+            return group_list(self.files, self.nchain)
+        file_entries = MegaIndex().entries(
+            self.files, self.treename, self.nworkers)
+        self.log.info(
+            "Putting %i entries from %i files into the process queue, "
+            "split into ranges of at least %i entries",
+            sum(x[1] for x in file_entries), len(self.files),
+            self.min_entries)
+        return split_entries(file_entries, self.nworkers, self.min_entries)
 
     def run(self):
         input_q = multiprocessing.Queue()
         # add the files to be processed
-        self.log.info(
-            "Putting %i files into the process queue, grouped into %i file chunks",
-                      len(self.files), self.nchain)
-        for file in group_list(self.files, self.nchain):
-            input_q.put(file)
+        njobs = 0
+        for unit in self.work_units():
+            input_q.put(unit)
+            njobs += 1
 
         result_q = multiprocessing.Queue()
+        # Number of jobs taken from the queue by the workers
+        taken = multiprocessing.Value('i', 0)
 
-        everything_will_turn_out_okay = True
+        scheduler = WorkerScheduler(self.nworkers, self.max_workers,
+                                    self.memory_budget)
+        monitor = UsageMonitor()
+        # The running workers, and the ones asked to stop
+        workers = []
+        stopping = set([])
+        merger = None
 
         try:
-            workers = self.build_workers(input_q, result_q)
-
-            # Start workers
-            for worker in workers:
+            for i in range(self.nworkers):
+                worker = self.build_worker(input_q, result_q, taken)
                 worker.start()
-                # Add poison pill for this worker
-                input_q.put(None)
-            input_q.close()
+                workers.append(worker)
 
             self.log.info("Started %i workers", len(workers))
 
             # Start the merger
-            merger = MegaMerger(result_q, self.output_file, len(self.files))
+            if self.in_memory:
+                merger = MegaAccumulator(result_q, self.output_file,
+                                         len(self.files), report=self.report,
+                                         samples=self.samples)
+            else:
+                merger = MegaMerger(result_q, self.output_file,
+                                    len(self.files), nprocesses=self.nmergers,
+                                    report=self.report, samples=self.samples)
             merger.start()
 
             self.log.info("Started the merger process")
 
-            # Require all the workers to finish
-            #input_q.join()
-            for i, worker in enumerate(workers):
-                worker.join()
-                exit_code = worker.exitcode
-                if exit_code:
-                    everything_will_turn_out_okay = False
-                    self.log.error("Working %i exited with code: %i",
-                                   i, worker.exitcode)
-
-            if not everything_will_turn_out_okay:
-                self.log.error("A worker died.  Terminating merger and exiting")
-                merger.terminate()
-                sys.exit(2)
+            # Watch the workers until all of them are done
+            while workers:
+                workers[0].join(self.poll_interval)
+                for worker in [x for x in workers if not x.is_alive()]:
+                    worker.join()
+                    workers.remove(worker)
+                    stopping.discard(worker)
+                    if worker.exitcode:
+                        self.log.error("Worker %s exited with code: %i",
+                                       worker.name, worker.exitcode)
+                        self.log.error(
+                            "A worker died.  Terminating everything")
+                        for other in workers:
+                            other.terminate()
+                        merger.terminate()
+                        sys.exit(2)
+
+                nleft = njobs - taken.value
+                if nleft <= 0:
+                    # Everything has been taken, let them finish and exit
+                    for worker in workers:
+                        worker.stop.set()
+                    continue
+
+                # Workers asked to stop free their memory soon, so they
+                # aren't counted
+                active = [x for x in workers if x not in stopping]
+                usage, other_memory = monitor.measure(active, [merger])
+                change = scheduler.decide(usage, other_memory, nleft)
+                if change < 0:
+                    biggest = max(usage, key=lambda x: usage[x][1])
+                    total = other_memory + sum(x[1] for x in usage.values())
+                    self.log.warning("Job uses %0.0f MB, stopping worker %s",
+                                     total / 1e6, biggest.name)
+                    biggest.stop.set()
+                    stopping.add(biggest)
+                elif change > 0:
+                    self.log.info("Workers are I/O bound, scaling up to %i",
+                                  scheduler.target)
+                # Start workers to replace the ones which reached max_tasks,
+                # or to scale up
+                nactive = len(workers) - len(stopping)
+                for i in range(min(scheduler.target - nactive,
+                                   nleft - nactive)):
+                    worker = self.build_worker(input_q, result_q, taken)
+                    worker.start()
+                    workers.append(worker)
 
             self.log.info("All process jobs have completed.")
 
             # Add a poison pill at the end of the results
             result_q.put(None)
             result_q.close()
+            input_q.close()
 
             self.log.info("Waiting for merge jobs to complete")
 
@@ -103,11 +204,12 @@ class MegaDispatcher(object):
             merger.join()
         except KeyboardInterrupt:
             self.log.error("Ctrl-c detected, terminating everything")
-            for i, worker in enumerate(workers):
-                self.log.error("Terminating worker %i", i)
+            for worker in workers:
+                self.log.error("Terminating worker %s", worker.name)
                 worker.terminate()
-            self.log.error("Terminating merger")
-            merger.terminate()
+            if merger is not None:
+                self.log.error("Terminating merger")
+                merger.terminate()
             sys.exit(1)
 
         self.log.info("All merge jobs have completed.")
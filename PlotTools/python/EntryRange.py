@@ -0,0 +1,110 @@
+'''
+
+Split the input files of a mega job into entry ranges.
+
+Splitting at file granularity means one huge file can stall the whole job
+while the other workers are idle.  Instead, the dispatcher can get the
+entries of each file up front (from the MegaIndex) and hand out EntryRange
+work units.
+
+The units are made with "guided self-scheduling": each unit covers
+1/(2*nworkers) of the entries which remain to be queued, with a minimum
+size.  The first units are big (little overhead), and the last ones are
+small, so the idle workers at the tail of the job pick up the small pieces
+instead of waiting for one worker to finish a huge file.
+
+'''
+
+from collections import namedtuple
+
+# A range of [nentries] entries starting at [first_entry] in a file.
+EntryRange = namedtuple('EntryRange', ['file', 'first_entry', 'nentries'])
+
+
+def split_entries(file_entries, nworkers, min_entries=10000):
+    ''' Split files into EntryRange work units
+
+    [file_entries] is a list of (file, number of entries) tuples.  The
+    largest files are queued first.
+
+    >>> for unit in split_entries([('a', 100), ('b', 40000), ('c', 9000)], 2):
+    ...     print unit
+    EntryRange(file='b', first_entry=0, nentries=16138)
+    EntryRange(file='b', first_entry=16138, nentries=13862)
+    EntryRange(file='b', first_entry=30000, nentries=10000)
+    EntryRange(file='c', first_entry=0, nentries=9000)
+    EntryRange(file='a', first_entry=0, nentries=100)
+
+    '''
+    remaining = sum(entries for file, entries in file_entries)
+    for file, entries in sorted(file_entries, key=lambda x: -x[1]):
+        sizes = []
+        left = entries
+        while left > 0:
+            size = min(left, max(min_entries, remaining // (2 * nworkers)))
+            sizes.append(size)
+            left -= size
+            remaining -= size
+            if 0 < left < min_entries:
+                # Don't leave a tiny piece at the end of the file: spread it
+                # over the earlier units, so the last one stays the smallest
+                earlier = max(len(sizes) - 1, 1)
+                for i in range(earlier):
+                    sizes[i] += left // earlier + (i < left % earlier)
+                remaining -= left
+                left = 0
+        first = 0
+        for size in sizes:
+            yield EntryRange(file, first, size)
+            first += size
+
+
+class EntryRangeTree(object):
+    ''' Proxy for a TTree which only shows a range of entries
+
+    Entry numbers are relative to the start of the range: GetEntries()
+    returns the size of the range, and GetEntry(i) reads the i-th entry of
+    the range, so selectors looping on the entries only see the range.
+    Draw is restricted to the range as well, and the generated Cython
+    proxies read [entry_range] and only iterate over it.  Everything else
+    is passed through to the real tree.
+    '''
+    def __init__(self, tree, first_entry, nentries):
+        self.__dict__['_tree'] = tree
+        self.__dict__['first_entry'] = first_entry
+        self.__dict__['nentries'] = nentries
+        self.__dict__['entry_range'] = (first_entry, nentries)
+
+    def __getattr__(self, attr):
+        return getattr(self._tree, attr)
+
+    def __iter__(self):
+        tree = self._tree
+        for entry in xrange(self.first_entry,
+                            self.first_entry + self.nentries):
+            tree.GetEntry(entry)
+            yield tree
+
+    def GetEntry(self, entry, getall=0):
+        if entry < 0 or entry >= self.nentries:
+            return 0
+        return self._tree.GetEntry(self.first_entry + entry, getall)
+
+    def GetEntries(self, selection=None):
+        if selection is None:
+            return self.nentries
+        # This is what TTree::GetEntries(selection) does
+        return self.Draw('1', selection, 'goff')
+
+    def Draw(self, varexp, selection='', option='', nentries=None,
+             firstentry=0):
+        available = max(self.nentries - firstentry, 0)
+        if nentries is None or nentries > available:
+            nentries = available
+        return self._tree.Draw(varexp, selection, option, nentries,
+                               self.first_entry + firstentry)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,207 @@
+'''
+
+Sorted (run, lumi, evt) => (file, entry) index of ntuples.
+
+Finding a few events in a sample normally means scanning all the trees.
+Instead, the run, lumi and evt of each entry in a file are read once and
+stored, sorted, as a compact NumPy array in a "sidecar" file.  Lookups are
+then binary searches, and the indices of all the files in a sample can be
+merged together.
+
+The sidecar is stored next to the ntuple ([file].[tree].evtidx.npy) if the
+directory is writable, otherwise in $MEGAEVENTINDEX (default:
+~/.megaeventindex).  It is rebuilt if the ntuple is newer than the sidecar.
+
+Usage::
+
+    index = EventIndex.for_files(files, 'mm/final/Ntuple')
+    (run, lumi, evt) in index
+    for file, entry in index.find(run, lumi, evt):
+        ...
+
+'''
+
+import hashlib
+import logging
+import multiprocessing
+import numpy
+import os
+
+from FinalStateAnalysis.PlotTools.MegaColumns import iter_chunks
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE = os.environ.get(
+    'MEGAEVENTINDEX', os.path.expanduser('~/.megaeventindex'))
+
+# The index of a single file (the file number is added when merging)
+_entry_dtype = numpy.dtype([
+    ('run', numpy.uint32), ('lumi', numpy.uint32), ('evt', numpy.uint64),
+    ('file', numpy.uint32), ('entry', numpy.int64)])
+
+
+def sidecar_path(path, treename, cache_dir=DEFAULT_CACHE):
+    ''' Get the location of the index of a tree in a file '''
+    tag = treename.strip('/').replace('/', '_')
+    directory = os.path.dirname(os.path.abspath(path))
+    if os.path.exists(path) and os.access(directory, os.W_OK):
+        return '%s.%s.evtidx.npy' % (path, tag)
+    hash = hashlib.md5(path + ':' + treename)
+    return os.path.join(cache_dir, hash.hexdigest() + '.evtidx.npy')
+
+
+def _sort(entries):
+    ''' Sort index entries by (run, lumi, evt) '''
+    return entries[numpy.lexsort(
+        (entries['evt'], entries['lumi'], entries['run']))]
+
+
+def build_file_index(path, treename):
+    ''' Read the run, lumi, evt of every entry of a tree '''
+    import ROOT
+    tfile = ROOT.TFile.Open(path, "READ")
+    if not tfile or tfile.IsZombie():
+        raise IOError("Can't open file %s" % path)
+    tree = tfile.Get(treename)
+    if not tree:
+        raise IOError("Can't get tree %s from %s" % (treename, path))
+    entries = numpy.zeros(tree.GetEntries(), dtype=_entry_dtype)
+    for chunk in iter_chunks(tree, ['run', 'lumi', 'evt']):
+        selected = slice(chunk.first_entry, chunk.first_entry + chunk.size)
+        entries['run'][selected] = chunk.run
+        entries['lumi'][selected] = chunk.lumi
+        entries['evt'][selected] = chunk.evt
+    entries['entry'] = numpy.arange(len(entries))
+    tfile.Close()
+    return _sort(entries)
+
+
+def load_file_index(path, treename, cache_dir=DEFAULT_CACHE):
+    ''' Get the index of a file from its sidecar, building it if needed '''
+    sidecar = sidecar_path(path, treename, cache_dir)
+    if os.path.exists(sidecar) and (
+            not os.path.exists(path) or
+            os.path.getmtime(sidecar) >= os.path.getmtime(path)):
+        return numpy.load(sidecar)
+    log.info("Building event index for %s", path)
+    entries = build_file_index(path, treename)
+    directory = os.path.dirname(sidecar)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # Write atomically, so concurrent jobs never see a partial index
+    temp = sidecar + '.%i.tmp' % os.getpid()
+    with open(temp, 'wb') as output:
+        numpy.save(output, entries)
+    os.rename(temp, sidecar)
+    return entries
+
+
+def _load_file_index(args):
+    ''' Pool.map helper '''
+    return load_file_index(*args)
+
+
+class EventIndex(object):
+    ''' Sorted index of the events in a list of files
+
+    >>> entries = numpy.zeros(3, dtype=_entry_dtype)
+    >>> entries['run'] = [2, 1, 1]
+    >>> entries['lumi'] = [1, 5, 4]
+    >>> entries['evt'] = [10, 20, 30]
+    >>> entries['entry'] = [0, 1, 2]
+    >>> index = EventIndex.merge([EventIndex(['a.root'], _sort(entries)),
+    ...                           EventIndex(['b.root'], _sort(entries[:1]))])
+    >>> len(index)
+    4
+    >>> (1, 5, 20) in index, (1, 5, 30) in index
+    (True, False)
+    >>> index.find(2, 1, 10)
+    [('a.root', 0), ('b.root', 0)]
+    >>> index.find(1, 4, 30)
+    [('a.root', 2)]
+
+    '''
+    def __init__(self, files, entries):
+        self.files = list(files)
+        self.entries = entries
+        # Contiguous copies of the sorted key columns, so searchsorted
+        # doesn't copy them at each lookup
+        self.columns = [numpy.ascontiguousarray(entries[name])
+                        for name in ('run', 'lumi', 'evt')]
+
+    @classmethod
+    def for_files(cls, files, treename, nprocesses=4,
+                  cache_dir=DEFAULT_CACHE):
+        ''' Load (or build, in parallel) the index of a list of files '''
+        files = list(files)
+        pool = multiprocessing.Pool(nprocesses)
+        try:
+            indices = pool.map(_load_file_index, [
+                (path, treename, cache_dir) for path in files])
+        finally:
+            pool.close()
+            pool.join()
+        return cls.merge(cls([path], entries)
+                         for path, entries in zip(files, indices))
+
+    @classmethod
+    def merge(cls, indices):
+        ''' Merge the indices of different files together '''
+        files = []
+        all_entries = []
+        for index in indices:
+            entries = index.entries.copy()
+            entries['file'] += len(files)
+            files.extend(index.files)
+            all_entries.append(entries)
+        if not all_entries:
+            return cls([], numpy.zeros(0, dtype=_entry_dtype))
+        return cls(files, _sort(numpy.concatenate(all_entries)))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _range(self, key):
+        ''' Get the [start, end) positions of an event
+
+        The entries are sorted by run, then lumi, then evt, so each column
+        is sorted within the range of the previous ones.
+        '''
+        start, end = 0, len(self.entries)
+        for column, value in zip(self.columns, key):
+            # Convert first, comparing uint64 with int would go via float
+            value = column.dtype.type(value)
+            selected = column[start:end]
+            start, end = (start + selected.searchsorted(value, 'left'),
+                          start + selected.searchsorted(value, 'right'))
+            if start == end:
+                break
+        return start, end
+
+    def __contains__(self, event):
+        start, end = self._range(tuple(event))
+        return end > start
+
+    def find(self, run, lumi, evt):
+        ''' Get the list of (file, entry) of an event '''
+        start, end = self._range((run, lumi, evt))
+        return [(self.files[self.entries['file'][i]],
+                 int(self.entries['entry'][i])) for i in xrange(start, end)]
+
+    def find_all(self, events):
+        ''' Get a dictionary {file: [entries]} for a list of events
+
+        The entries of each file are sorted.
+        '''
+        output = {}
+        for event in events:
+            for file, entry in self.find(*event):
+                output.setdefault(file, []).append(entry)
+        for entries in output.itervalues():
+            entries.sort()
+        return output
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
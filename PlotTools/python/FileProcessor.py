@@ -12,10 +12,40 @@ Objects are written to an output file.
 
 
 import ROOT
+import time
+from FinalStateAnalysis.PlotTools.BranchPruner import \
+    BranchPruner, PrunedTree, selector_branches
+from FinalStateAnalysis.PlotTools.EntryRange import EntryRangeTree
+from FinalStateAnalysis.PlotTools.MegaAccumulator import HistogramBundle
+from FinalStateAnalysis.PlotTools.MegaSampler import StackSampler
+from FinalStateAnalysis.PlotTools.MegaTelemetry import Telemetry, TimedTree
 
 class FileProcessor(object):
-    def __init__(self, filename, treename, selector, output_file, log, **kwargs):
+    def __init__(self, filename, treename, selector, output_file, log,
+                 chunk_size=None, learn_entries=None, in_memory=False,
+                 first_entry=0, nentries=None, sample_interval=None,
+                 time_entries=False, **kwargs):
         self.log = log
+        # If set, sample the stack every [sample_interval] s of CPU time
+        self.sample_interval = sample_interval
+        # If true, time the reading of the entries (row mode)
+        self.time_entries = time_entries
+        # Stage timing and counters of this job
+        self.telemetry = Telemetry()
+        self.start = time.time()
+        self.bytes_start = ROOT.TFile.GetFileBytesRead()
+        # If set, run the selector in columnar mode with chunks of this size
+        self.chunk_size = chunk_size
+        # If set, disable unused branches after learning which ones the
+        # selector uses in the first [learn_entries] entries
+        self.learn_entries = learn_entries
+        # If true, return the histograms as a HistogramBundle instead of
+        # writing them to the output file.
+        self.in_memory = in_memory
+        # If nentries is set, only process entries
+        # [first_entry, first_entry + nentries)
+        self.first_entry = first_entry
+        self.nentries = nentries
         self.log.debug("FileProcessor opening %s", filename)
         self.file = ROOT.TFile.Open(filename, "READ")
         if not self.file:
@@ -29,19 +59,69 @@ class FileProcessor(object):
         ROOT.TTreeCache.SetLearnEntries(200)
         self.tree.SetCacheSize(10000000)
         self.outfilename = output_file
-        self.out = ROOT.TFile(output_file, "RECREATE")
+        if self.in_memory:
+            # Uncompressed, since it never leaves this process
+            self.out = ROOT.TMemFile(output_file, "RECREATE", "", 0)
+        else:
+            self.out = ROOT.TFile(output_file, "RECREATE")
         if not self.file:
             raise IOError("Can't open output ROOT file %s for writing"
                           % output_file)
         self.log.debug("FileProcessor creating selector")
+        # Fraction of the input we process, for the progress bar
+        self.processed = 1
+        selector_tree = self.tree
+        if self.nentries is not None:
+            self.processed *= float(self.nentries) / max(
+                1, self.tree.GetEntries())
+            selector_tree = EntryRangeTree(
+                self.tree, self.first_entry, self.nentries)
+        if self.time_entries:
+            selector_tree = TimedTree(selector_tree, self.telemetry)
+        self.pruner = None
+        if self.learn_entries is not None and not self.chunk_size:
+            self.pruner = BranchPruner(self.tree, self.log, learn_entries)
+            selector_tree = PrunedTree(selector_tree, self.pruner)
         # Create our selector instance
-        self.selector = selector(self.tree, self.out, **kwargs)
+        self.selector = selector(selector_tree, self.out, **kwargs)
+        self.selector.telemetry = self.telemetry
+        if self.pruner is not None:
+            self.pruner.declare(selector_branches(self.selector))
 
     def process(self):
-        self.selector.begin()
-        self.selector.process()
-        self.selector.finish()
+        self.telemetry.add_time('open', time.time() - self.start)
+        sampler = None
+        if self.sample_interval:
+            sampler = StackSampler(self.selector.histograms,
+                                   self.sample_interval)
+            sampler.start()
+        try:
+            with self.telemetry.timer('begin'):
+                self.selector.begin()
+            with self.telemetry.timer('process'):
+                if self.chunk_size:
+                    # The EntryRangeTree already restricts the selector
+                    # tree to [first_entry, first_entry + nentries)
+                    self.selector.process_columns(self.chunk_size)
+                else:
+                    self.selector.process()
+            with self.telemetry.timer('finish'):
+                self.selector.finish()
+        finally:
+            if sampler is not None:
+                sampler.stop()
+        if self.pruner is not None:
+            self.pruner.report()
+        result = self.outfilename
+        if self.in_memory:
+            result = HistogramBundle.from_directory(self.out)
         # Cleanup files
         self.file.Close()
         self.out.Close()
-        return (1, self.outfilename)
+        self.telemetry.count('jobs')
+        self.telemetry.count(
+            'bytes_read', ROOT.TFile.GetFileBytesRead() - self.bytes_start)
+        telemetry = self.telemetry.to_dict()
+        if sampler is not None:
+            telemetry['samples'] = sampler.counts
+        return (self.processed, result, telemetry)
@@ -0,0 +1,229 @@
+'''
+
+In-memory alternative to the MegaMerger.
+
+Instead of writing the output of each job to a temporary .root file which
+is reopened by the merger, the processors extract the bin contents of
+every histogram into NumPy arrays (a HistogramBundle) which are sent back
+through the results queue.  The MegaAccumulator sums the arrays in place,
+and writes a single ROOT file at the end.
+
+'''
+
+import multiprocessing
+import numpy
+import os
+from progressbar import ETA, ProgressBar, FormatLabel, Bar
+import ROOT
+import signal
+import time
+
+from FinalStateAnalysis.PlotTools.MegaBase import make_dirs
+from FinalStateAnalysis.PlotTools.MegaTelemetry import TelemetryCollector
+
+# Size of the array passed to TH1::GetStats, large enough for a TH3
+_NSTATS = 13
+
+_array_types = [
+    ('TArrayD', numpy.float64),
+    ('TArrayF', numpy.float32),
+    ('TArrayI', numpy.int32),
+    ('TArrayS', numpy.int16),
+    ('TArrayC', numpy.int8),
+]
+
+def _array_dtype(histogram):
+    ''' Get the NumPy type of the bin contents of a histogram '''
+    for array_type, dtype in _array_types:
+        if isinstance(histogram, getattr(ROOT, array_type)):
+            return dtype
+    raise TypeError("Can't determine the storage type of %s" %
+                    histogram.GetName())
+
+def _wrap(buffer, dtype, size):
+    ''' Copy a PyROOT buffer into a NumPy array '''
+    buffer.SetSize(size)
+    return numpy.frombuffer(buffer, dtype=dtype, count=size).astype(
+        numpy.float64)
+
+def _has_plain_storage(histogram):
+    ''' Check if the content + sumw2 arrays describe the whole histogram '''
+    return not histogram.InheritsFrom('TProfile') and \
+        not histogram.InheritsFrom('TProfile2D') and \
+        not histogram.InheritsFrom('TProfile3D')
+
+def histogram_arrays(histogram):
+    ''' Extract (contents, sumw2, stats, entries) from a histogram
+
+    The arrays include the under and overflow bins.  sumw2 is None if the
+    histogram does not store the sum of weights squared.
+    '''
+    ncells = histogram.GetSize()
+    contents = _wrap(histogram.GetArray(), _array_dtype(histogram), ncells)
+    sumw2 = None
+    if histogram.GetSumw2N():
+        sumw2 = _wrap(histogram.GetSumw2().GetArray(), numpy.float64, ncells)
+    stats = numpy.zeros(_NSTATS)
+    histogram.GetStats(stats)
+    return (contents, sumw2, stats, histogram.GetEntries())
+
+def set_histogram_arrays(histogram, contents, sumw2, stats, entries):
+    ''' Inverse of histogram_arrays '''
+    histogram.Set(len(contents), numpy.ascontiguousarray(
+        contents, dtype=_array_dtype(histogram)))
+    if sumw2 is not None:
+        if not histogram.GetSumw2N():
+            histogram.Sumw2()
+        histogram.GetSumw2().Set(len(sumw2), numpy.ascontiguousarray(sumw2))
+    histogram.PutStats(numpy.ascontiguousarray(stats))
+    histogram.SetEntries(entries)
+
+def _walk(directory, path=''):
+    ''' Generate (path, object) for everything in a TDirectory
+
+    Objects in memory are preferred over the ones written to keys.
+    '''
+    seen = set([])
+    for object in directory.GetList():
+        name = object.GetName()
+        seen.add(name)
+        if object.InheritsFrom('TDirectory'):
+            for x in _walk(object, os.path.join(path, name)):
+                yield x
+        else:
+            yield os.path.join(path, name), object
+    for key in directory.GetListOfKeys():
+        name = key.GetName()
+        if name in seen:
+            continue
+        seen.add(name)
+        object = key.ReadObj()
+        if object.InheritsFrom('TDirectory'):
+            for x in _walk(object, os.path.join(path, name)):
+                yield x
+        else:
+            yield os.path.join(path, name), object
+
+class HistogramBundle(object):
+    ''' The content of an output directory, in a compact picklable form '''
+    def __init__(self):
+        # path => (contents, sumw2, stats, entries)
+        self.arrays = {}
+        # path => empty histogram with the binning, titles, etc.
+        self.templates = {}
+        # path => any other object (profiles, TObjStrings, ...)
+        self.objects = {}
+
+    @classmethod
+    def from_directory(cls, directory):
+        output = cls()
+        for path, object in _walk(directory):
+            if object.InheritsFrom('TH1') and _has_plain_storage(object):
+                output.arrays[path] = histogram_arrays(object)
+                template = object.Clone()
+                template.SetDirectory(0)
+                template.Reset()
+                output.templates[path] = template
+            else:
+                if object.InheritsFrom('TH1'):
+                    object.SetDirectory(0)
+                output.objects[path] = object
+        return output
+
+    def drop_templates(self, paths):
+        ''' Don't send the templates of paths which have already been sent '''
+        for path in paths:
+            self.templates.pop(path, None)
+
+
+class MegaAccumulator(multiprocessing.Process):
+    log = multiprocessing.get_logger()
+    def __init__(self, input_queue, output_file, ninputs, report=None,
+                 samples=None):
+        super(MegaAccumulator, self).__init__()
+        self.input = input_queue
+        self.output = output_file
+        self.ninputs = ninputs
+        self.processed = 0
+        # Telemetry of the jobs, written to [report] at the end
+        self.telemetry = TelemetryCollector(report, samples)
+        self.add_time = 0.
+        self.pbar = ProgressBar(widgets=[
+            FormatLabel('Processed %(value)i/' + str(ninputs) + ' files. ')] +
+            self.telemetry.widgets() + [ETA(), Bar('>')],
+            maxval=ninputs).start()
+        self.pbar.update(0)
+        # path => [contents, sumw2, stats, entries]
+        self.sums = {}
+        self.templates = {}
+        self.objects = {}
+
+    def add(self, bundle):
+        ''' Sum the content of a HistogramBundle into the totals '''
+        self.templates.update(bundle.templates)
+        for path, (contents, sumw2, stats, entries) in \
+                bundle.arrays.iteritems():
+            total = self.sums.get(path)
+            if total is None:
+                self.sums[path] = [contents, sumw2, stats, entries]
+                continue
+            total[0] += contents
+            if sumw2 is not None:
+                if total[1] is None:
+                    total[1] = sumw2
+                else:
+                    total[1] += sumw2
+            total[2] += stats
+            total[3] += entries
+        for path, object in bundle.objects.iteritems():
+            if path not in self.objects:
+                self.objects[path] = object
+            elif object.InheritsFrom('TH1'):
+                self.objects[path].Add(object)
+
+    def write(self):
+        ''' Write all the summed histograms to the output file '''
+        self.log.info("Writing %i histograms to %s",
+                      len(self.sums), self.output)
+        output = ROOT.TFile(self.output, "RECREATE")
+        if not output:
+            raise IOError("Can't open output ROOT file %s for writing"
+                          % self.output)
+        to_write = []
+        for path, (contents, sumw2, stats, entries) in \
+                self.sums.iteritems():
+            histogram = self.templates[path]
+            set_histogram_arrays(histogram, contents, sumw2, stats, entries)
+            to_write.append((path, histogram))
+        to_write.extend(self.objects.iteritems())
+        for path, object in sorted(to_write):
+            location, name = os.path.split(path)
+            directory = output
+            if location:
+                directory = make_dirs(output, location.split('/'))
+            directory.WriteTObject(object, name)
+        output.Close()
+
+    def run(self):
+        # ignore sigterm signal and let parent take care of this
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        while True:
+            result = self.input.get()
+            # Check for poison pill
+            if result is None:
+                self.log.info("Got poison pill - shutting down")
+                self.telemetry.finished_jobs()
+                break
+            nfiles, bundle, telemetry = result
+            self.telemetry.add(telemetry)
+            start = time.time()
+            self.add(bundle)
+            self.add_time += time.time() - start
+            self.processed += nfiles
+            self.pbar.update(self.processed)
+        start = time.time()
+        self.write()
+        self.telemetry.write({
+            'histograms': len(self.sums),
+            'time': self.add_time + time.time() - start,
+        })
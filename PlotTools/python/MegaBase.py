@@ -8,6 +8,9 @@ import json
 import os
 import multiprocessing
 import ROOT
+from FinalStateAnalysis.PlotTools.MegaColumns import \
+    DEFAULT_CHUNK_SIZE, fill_histogram, iter_chunks
+from FinalStateAnalysis.PlotTools.MegaTelemetry import Telemetry
 
 def make_dirs(base_dir, subdirs):
     ''' Make the directory structure.  Subdirs is a list. '''
@@ -22,11 +25,20 @@ def make_dirs(base_dir, subdirs):
 
 class MegaBase(object):
     log = multiprocessing.get_logger()
+    # Branches (or TTreeFormula expressions) read in columnar mode
+    columns = []
+    # Number of entries per chunk in columnar mode
+    chunk_size = DEFAULT_CHUNK_SIZE
+    # Branches which are never disabled when running with --prune-branches
+    branches = []
+
     def __init__(self, tree, output, **kwargs):
         self.tree = tree
         self.output = output
         self.opts = kwargs
         self.histograms = {}
+        # Stage timing, replaced by the one of the job by the processor
+        self.telemetry = Telemetry()
         # Always store sum of weights for histograms, so the errors make sense
         # later.
         ROOT.TH1.SetDefaultSumw2(True)
@@ -61,6 +73,36 @@ class MegaBase(object):
         self.histograms[os.path.join(location, name)] = object
         return object
 
+    def fill(self, location, x, y=None, weights=None):
+        ''' Fill the histogram booked at location from arrays of values
+
+        Used in columnar mode, where x, y and weights are NumPy arrays.
+        '''
+        with self.telemetry.timer('fill'):
+            fill_histogram(self.histograms[location], x, y, weights)
+
+    def process_chunk(self, chunk):
+        ''' Analyze a ColumnChunk of entries.  Override in columnar selectors.
+
+        The chunk maps the names in self.columns to NumPy arrays.
+        '''
+        raise NotImplementedError(
+            "%s does not support columnar mode" % self.__class__.__name__)
+
+    def process_columns(self, chunk_size=None, first_entry=0, nentries=None):
+        ''' Loop over the tree in chunks, calling process_chunk on each '''
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        chunks = iter_chunks(self.tree, self.columns, chunk_size,
+                             first_entry, nentries)
+        while True:
+            with self.telemetry.timer('read'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            self.telemetry.count('entries', chunk.size)
+            self.process_chunk(chunk)
+
     def enable_branch(self, branch):
         ''' Set the branch to read on TTree::GetEntry '''
         self.tree.SetBranchStatus(branch, 1)
@@ -0,0 +1,357 @@
+'''
+
+Reproducible benchmarks of the mega pipeline on synthetic ntuples.
+
+Synthetic flat ntuples (run, lumi, evt plus [nbranches] float branches
+var0 ... varN) are generated with a fixed random seed, so the same
+configuration always reads the same data.  They are cached in the work
+directory.
+
+Three representative selectors are provided:
+
+    * cut: many branches read and cut on, few fills
+    * fill: few branches read, many histograms filled per entry
+    * wide: every branch of the tree is read
+
+Each benchmark case runs in a fresh process, so its memory use is not
+polluted by the previous ones.  The memory of the case is sampled while it
+runs, as the total proportional set size (PSS) of the case process and of
+all its workers and mergers, so single mode and multi worker cases can be
+compared.
+
+Usage::
+
+    files = make_ntuples('bench', nfiles=4, nentries=100000, nbranches=50)
+    result = run_case(files, 'bench', 'cut', nworkers=4)
+
+See mega_benchmark.py for the command line interface.
+
+'''
+
+import json
+import logging
+import multiprocessing
+import numpy
+import os
+import Queue
+import socket
+import subprocess
+import time
+
+from FinalStateAnalysis.PlotTools.MegaBase import MegaBase
+from FinalStateAnalysis.PlotTools.MegaScheduler import \
+    read_process_table, tree_usage
+
+log = logging.getLogger(__name__)
+
+TREE = 'Ntuple'
+
+
+def ntuple_path(workdir, index, nentries, nbranches, seed=0):
+    return os.path.join(workdir, 'ntuple_%i_%ix%i_s%i.root' % (
+        index, nentries, nbranches, seed))
+
+
+def make_ntuple(path, nentries, nbranches, seed=0):
+    ''' Write a synthetic flat ntuple to [path] '''
+    import ROOT
+    random = numpy.random.RandomState(seed)
+    tfile = ROOT.TFile(path + '.tmp', 'RECREATE')
+    tree = ROOT.TTree(TREE, 'Synthetic ntuple')
+    ids = numpy.zeros(2, dtype=numpy.uint32)
+    evt = numpy.zeros(1, dtype=numpy.uint64)
+    values = numpy.zeros(nbranches, dtype=numpy.float32)
+    tree.Branch('run', ids[0:], 'run/i')
+    tree.Branch('lumi', ids[1:], 'lumi/i')
+    tree.Branch('evt', evt, 'evt/l')
+    for i in range(nbranches):
+        tree.Branch('var%i' % i, values[i:], 'var%i/F' % i)
+    # Generate in blocks to keep the memory usage bounded
+    block = 10000
+    for first in xrange(0, nentries, block):
+        size = min(block, nentries - first)
+        # Exponential "pt" like and gaussian "eta" like distributions
+        data = numpy.where(
+            numpy.arange(nbranches) % 2 == 0,
+            random.exponential(30., (size, nbranches)),
+            random.normal(0., 1.5, (size, nbranches))).astype(numpy.float32)
+        for i in xrange(size):
+            entry = first + i
+            ids[0] = 1 + seed
+            ids[1] = 1 + entry / 1000
+            evt[0] = entry
+            values[:] = data[i]
+            tree.Fill()
+    tfile.Write()
+    tfile.Close()
+    os.rename(path + '.tmp', path)
+
+
+def make_ntuples(workdir, nfiles, nentries, nbranches):
+    ''' Get (generating them if needed) the paths of synthetic ntuples '''
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    output = []
+    for index in range(nfiles):
+        path = ntuple_path(workdir, index, nentries, nbranches, index)
+        if not os.path.exists(path):
+            log.info("Generating %s", path)
+            make_ntuple(path, nentries, nbranches, seed=index)
+        output.append(path)
+    return output
+
+
+def _branch_names(tree):
+    return [branch.GetName() for branch in tree.GetListOfBranches()
+            if branch.GetName().startswith('var')]
+
+
+class CutSelector(MegaBase):
+    ''' Cut heavy: a long chain of cuts on 10 branches '''
+    tree = TREE
+
+    def __init__(self, tree, outfile, **kwargs):
+        super(CutSelector, self).__init__(tree, outfile, **kwargs)
+        self.cut_branches = _branch_names(tree)[:10]
+        self.columns = self.cut_branches
+
+    def begin(self):
+        self.book('cut', 'var0', 'var0', 100, 0, 200)
+        self.book('cut', 'npassed', 'npassed', 11, -0.5, 10.5)
+
+    def process(self):
+        branches = self.cut_branches
+        var0 = self.histograms['cut/var0']
+        npassed = self.histograms['cut/npassed']
+        for row in self.tree:
+            passed = 0
+            for i, branch in enumerate(branches):
+                value = getattr(row, branch)
+                if i % 2 == 0:
+                    if value < 10:
+                        break
+                elif abs(value) > 2.1:
+                    break
+                passed += 1
+            npassed.Fill(passed)
+            if passed == len(branches):
+                var0.Fill(row.var0)
+
+    def process_chunk(self, chunk):
+        alive = numpy.ones(chunk.size, dtype=bool)
+        npassed = numpy.zeros(chunk.size)
+        for i, branch in enumerate(self.cut_branches):
+            if i % 2 == 0:
+                alive &= chunk[branch] >= 10
+            else:
+                alive &= numpy.abs(chunk[branch]) <= 2.1
+            npassed += alive
+        self.fill('cut/npassed', npassed)
+        self.fill('cut/var0', chunk.var0[alive])
+
+    def finish(self):
+        self.write_histos()
+
+
+class FillSelector(MegaBase):
+    ''' Fill heavy: 50 histograms filled per entry from 4 branches '''
+    tree = TREE
+    nhistograms = 50
+
+    def __init__(self, tree, outfile, **kwargs):
+        super(FillSelector, self).__init__(tree, outfile, **kwargs)
+        self.fill_branches = _branch_names(tree)[:4]
+        self.columns = self.fill_branches
+
+    def begin(self):
+        for i in range(self.nhistograms):
+            self.book('fill', 'h%i' % i, 'h%i' % i, 100, -5, 100)
+
+    def process(self):
+        branches = self.fill_branches
+        histograms = [self.histograms['fill/h%i' % i]
+                      for i in range(self.nhistograms)]
+        for row in self.tree:
+            values = [getattr(row, branch) for branch in branches]
+            for i, histogram in enumerate(histograms):
+                histogram.Fill(values[i % len(values)])
+
+    def process_chunk(self, chunk):
+        branches = self.fill_branches
+        for i in range(self.nhistograms):
+            self.fill('fill/h%i' % i, chunk[branches[i % len(branches)]])
+
+    def finish(self):
+        self.write_histos()
+
+
+class WideSelector(MegaBase):
+    ''' Wide read: every branch is read, and their sum histogrammed '''
+    tree = TREE
+
+    def __init__(self, tree, outfile, **kwargs):
+        super(WideSelector, self).__init__(tree, outfile, **kwargs)
+        self.columns = _branch_names(tree)
+
+    def begin(self):
+        self.book('wide', 'sum', 'sum', 100, 0, 5000)
+
+    def process(self):
+        branches = self.columns
+        histogram = self.histograms['wide/sum']
+        for row in self.tree:
+            histogram.Fill(sum(getattr(row, branch) for branch in branches))
+
+    def process_chunk(self, chunk):
+        total = numpy.zeros(chunk.size)
+        for branch in self.columns:
+            total += chunk[branch]
+        self.fill('wide/sum', total)
+
+    def finish(self):
+        self.write_histos()
+
+
+SELECTORS = {
+    'cut': CutSelector,
+    'fill': FillSelector,
+    'wide': WideSelector,
+}
+
+
+def _run_case(files, workdir, selector, nworkers, chunk_size, in_memory):
+    ''' Run a benchmark case in the current process '''
+    # Imported here, so the parent never loads ROOT state into the forks
+    from FinalStateAnalysis.PlotTools.ChainProcessor import ChainProcessor
+    from FinalStateAnalysis.PlotTools.Dispatcher import MegaDispatcher
+    from FinalStateAnalysis.PlotTools.MegaTelemetry import TelemetryCollector
+    mode = 'single' if not nworkers else '%iw' % nworkers
+    output = os.path.join(workdir, 'result_%s_%s.root' % (selector, mode))
+    report = output.replace('.root', '.json')
+    start = time.time()
+    if not nworkers:
+        processor = ChainProcessor(files, TREE, SELECTORS[selector], output,
+                                   log, chunk_size=chunk_size,
+                                   in_memory=in_memory, time_entries=True)
+        result = processor.process()
+        collector = TelemetryCollector(report)
+        collector.add(result[2])
+        collector.finished_jobs()
+        collector.write({})
+    else:
+        MegaDispatcher(files, TREE, output, SELECTORS[selector], nworkers,
+                       chunk_size=chunk_size, in_memory=in_memory,
+                       report=report).run()
+    wall_time = time.time() - start
+    with open(report) as input:
+        telemetry = json.load(input)
+    entries = telemetry['total']['counters'].get('entries', 0)
+    return {
+        'entries': entries,
+        'wall_time': wall_time,
+        'entries_per_second': entries / wall_time,
+        'merge_time': telemetry['merge'].get('time', 0.),
+        'merge_tail_time': telemetry['merge'].get('tail_time', 0.),
+        'bottleneck': telemetry['bottleneck'],
+    }
+
+
+def _case_process(queue, args):
+    try:
+        queue.put(_run_case(*args))
+    except Exception, e:
+        queue.put({'error': repr(e)})
+
+
+def run_case(files, workdir, selector, nworkers=0, chunk_size=None,
+             in_memory=False, memory_interval=0.2):
+    ''' Run a benchmark case in a fresh process
+
+    If nworkers is 0, the case is run in single mode.  The memory of the
+    case is measured every [memory_interval] seconds, the peak is reported
+    as peak_memory_mb.
+    '''
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=_case_process, args=(queue, (
+            files, workdir, selector, nworkers, chunk_size, in_memory)))
+    process.start()
+    peak_memory = 0
+    while True:
+        peak_memory = max(
+            peak_memory, tree_usage(read_process_table(), process.pid)[1])
+        try:
+            result = queue.get(timeout=memory_interval)
+            break
+        except Queue.Empty:
+            if not process.is_alive():
+                result = {'error': 'exit code %s' % process.exitcode}
+                break
+    process.join()
+    result['peak_memory_mb'] = peak_memory / 1e6
+    if 'error' in result:
+        raise RuntimeError("Benchmark %s with %i workers failed: %s" % (
+            selector, nworkers, result['error']))
+    return result
+
+
+def case_key(record):
+    ''' Identify equivalent cases in different results files '''
+    return (record['selector'], record['mode'], record['columnar'],
+            record['in_memory'], record['nfiles'], record['nentries'],
+            record['nbranches'])
+
+
+def git_version():
+    ''' The version of the code being benchmarked '''
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def read_results(path):
+    ''' Read a JSON-lines results file '''
+    with open(path) as input:
+        return [json.loads(line) for line in input if line.strip()]
+
+
+def compare(results, baseline, tolerance=0.1):
+    ''' Compare the throughput of results with a baseline
+
+    Returns a list of (case key, ratio, is a regression), where ratio is
+    new/old entries per second.  The latest baseline record of each case
+    is used.
+
+    >>> old = [{'selector': 'cut', 'mode': 'single', 'columnar': False,
+    ...         'in_memory': False, 'nfiles': 1, 'nentries': 10,
+    ...         'nbranches': 5, 'entries_per_second': 100.}]
+    >>> new = [dict(old[0], entries_per_second=80.)]
+    >>> [(ratio, bad) for key, ratio, bad in compare(new, old)]
+    [(0.8, True)]
+
+    '''
+    reference = {}
+    for record in baseline:
+        reference[case_key(record)] = record
+    output = []
+    for record in results:
+        key = case_key(record)
+        if key not in reference:
+            continue
+        ratio = record['entries_per_second'] / max(
+            reference[key]['entries_per_second'], 1e-9)
+        output.append((key, ratio, ratio < 1. - tolerance))
+    return output
+
+
+def describe_host():
+    return {'host': socket.gethostname(), 'ncpus': multiprocessing.cpu_count()}
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,109 @@
+'''
+
+Columnar access to flat ntuples for Mega selectors.
+
+Instead of reading the tree one row at a time through PyROOT attribute
+access, the branches are read in fixed size entry chunks into NumPy arrays.
+The reading is done by TTree::Draw, so the branch decompression and formula
+evaluation happens in compiled code, and the result buffers are wrapped
+directly by NumPy.
+
+Only scalar (one value per entry) branches are supported.
+
+'''
+
+import numpy
+
+# TTree::Draw can only return 4 columns at a time (GetV1 ... GetV4)
+_MAX_DRAW_COLUMNS = 4
+DEFAULT_CHUNK_SIZE = 100000
+
+
+class ColumnChunk(dict):
+    ''' A chunk of entries, mapping branch name => NumPy array
+
+    The branches can be accessed either as dictionary keys or as attributes,
+    so selector code reads like the row-based version::
+
+        mask = (chunk.m1Pt > 20) & (chunk.m2Pt > 10)
+
+    '''
+    def __init__(self, first_entry, size, columns=None):
+        super(ColumnChunk, self).__init__(columns or {})
+        self.first_entry = first_entry
+        self.size = size
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(
+                "Branch %s was not declared in the selector columns" % attr)
+
+    def __len__(self):
+        return self.size
+
+
+def _get_draw_buffer(tree, index, nrows):
+    ''' Copy the index-th TTree::Draw result buffer into a NumPy array '''
+    buffer = getattr(tree, 'GetV%i' % (index + 1))()
+    buffer.SetSize(nrows)
+    return numpy.frombuffer(buffer, dtype=numpy.float64, count=nrows).copy()
+
+
+def read_columns(tree, branches, first_entry, nentries):
+    ''' Read [nentries] entries of [branches] starting at [first_entry]
+
+    Returns a dictionary mapping branch name => numpy.float64 array.  Any
+    TTreeFormula expression is valid as a "branch".
+
+    '''
+    output = {}
+    tree.SetEstimate(nentries + 1)
+    for i in range(0, len(branches), _MAX_DRAW_COLUMNS):
+        group = branches[i:i + _MAX_DRAW_COLUMNS]
+        nrows = tree.Draw(':'.join(group), "", "goff", nentries, first_entry)
+        if nrows < 0:
+            raise IOError("Could not read branches %s from tree %s" %
+                          (' '.join(group), tree.GetName()))
+        for j, branch in enumerate(group):
+            output[branch] = _get_draw_buffer(tree, j, nrows)
+    return output
+
+
+def iter_chunks(tree, branches, chunk_size=DEFAULT_CHUNK_SIZE,
+                first_entry=0, nentries=None):
+    ''' Generate ColumnChunks of [branches] from the tree
+
+    The entries from [first_entry] to [first_entry + nentries] (or the end of
+    the tree) are read in groups of [chunk_size].
+
+    '''
+    branches = list(branches)
+    if not branches:
+        raise ValueError("Columnar mode requires at least one branch")
+    last_entry = tree.GetEntries()
+    if nentries is not None:
+        last_entry = min(last_entry, first_entry + nentries)
+    start = first_entry
+    while start < last_entry:
+        size = min(chunk_size, last_entry - start)
+        yield ColumnChunk(start, size,
+                          read_columns(tree, branches, start, size))
+        start += size
+
+
+def fill_histogram(histogram, x, y=None, weights=None):
+    ''' Fill a TH1 (or TH2 if y is given) from arrays using TH1::FillN '''
+    x = numpy.ascontiguousarray(x, dtype=numpy.float64)
+    if not len(x):
+        return
+    if weights is None:
+        weights = numpy.ones(len(x), dtype=numpy.float64)
+    else:
+        weights = numpy.ascontiguousarray(weights, dtype=numpy.float64)
+    if y is None:
+        histogram.FillN(len(x), x, weights)
+    else:
+        y = numpy.ascontiguousarray(y, dtype=numpy.float64)
+        histogram.FillN(len(x), x, y, weights)
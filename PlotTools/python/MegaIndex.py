@@ -0,0 +1,207 @@
+'''
+
+Persistent index of the metadata of Mega input files.
+
+Opening thousands of files (possibly over xrootd) just to count their
+entries is expensive, so the metadata of each (file, tree) is stored in a
+local SQLite database:
+
+    * the number of entries
+    * the list of branches
+    * the compressed size of the tree
+    * optionally, the processed run-lumis (as a JSON lumi mask) and the sum
+      of the "nevents" branch, for meta info trees
+
+Local files are keyed by path, mtime and size, so the information is
+recomputed if the file changes.  Remote (xrootd) files are assumed to be
+immutable.  Missing information is computed in parallel and stored as soon
+as it is available, so an interrupted scan is not lost.
+
+The location of the database can be set with the $MEGAINDEX environment
+variable.
+
+Usage::
+
+    index = MegaIndex()
+    for info in index.get(files, 'mm/final/Ntuple'):
+        print info.path, info.entries
+
+'''
+
+from collections import namedtuple
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+
+from FinalStateAnalysis.Utilities.lumitools import json_summary
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INDEX = os.environ.get(
+    'MEGAINDEX', os.path.expanduser('~/.megaindex.sqlite'))
+
+# The metadata of a tree in a file.  If the file could not be read, error
+# is set to a description of the problem and the other fields are None.
+FileInfo = namedtuple('FileInfo', [
+    'path', 'tree', 'mtime', 'size', 'entries', 'zip_bytes', 'branches',
+    'nevents', 'lumis', 'error'])
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT,
+    tree TEXT,
+    mtime REAL,
+    size INTEGER,
+    entries INTEGER,
+    zip_bytes INTEGER,
+    branches TEXT,
+    nevents INTEGER,
+    lumis TEXT,
+    PRIMARY KEY (path, tree)
+)
+'''
+
+
+def file_stamp(path):
+    ''' Get the (mtime, size) of a local file, or (None, None) '''
+    if os.path.exists(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+    return None, None
+
+
+def scan_file(path, treename, lumis=False):
+    ''' Open a file and extract the FileInfo of a tree
+
+    If lumis is True, the run, lumi (and nevents, if it exists) branches
+    are read to build the lumi mask and the total number of events.
+    '''
+    import ROOT
+    mtime, size = file_stamp(path)
+
+    def failed(error):
+        return FileInfo(path, treename, mtime, size,
+                        None, None, None, None, None, error)
+
+    tfile = ROOT.TFile.Open(path, "READ")
+    if not tfile or tfile.IsZombie():
+        return failed("Can't open file")
+    tree = tfile.Get(treename)
+    if not tree:
+        tfile.Close()
+        return failed("Can't get tree %s" % treename)
+    branches = [branch.GetName() for branch in tree.GetListOfBranches()]
+    nevents = None
+    lumi_mask = None
+    if lumis:
+        from FinalStateAnalysis.PlotTools.MegaColumns import read_columns
+        columns = ['run', 'lumi']
+        if 'nevents' in branches:
+            columns.append('nevents')
+        arrays = read_columns(tree, columns, 0, tree.GetEntries())
+        lumi_mask = json_summary(set(zip(
+            arrays['run'].astype(int).tolist(),
+            arrays['lumi'].astype(int).tolist())))
+        if 'nevents' in arrays:
+            nevents = int(arrays['nevents'].sum())
+    info = FileInfo(path, treename, mtime, size, tree.GetEntries(),
+                    tree.GetZipBytes(), branches, nevents, lumi_mask, None)
+    tfile.Close()
+    return info
+
+
+def _scan_file(args):
+    ''' Pool.imap helper '''
+    return scan_file(*args)
+
+
+class MegaIndex(object):
+    def __init__(self, path=DEFAULT_INDEX):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute(_schema)
+        self.db.commit()
+
+    def lookup(self, path, treename, lumis=False):
+        ''' Get the FileInfo of a tree, or None if it isn't (validly) cached.
+
+        If lumis is True, only entries with lumi information are valid.
+        '''
+        row = self.db.execute(
+            'SELECT mtime, size, entries, zip_bytes, branches, nevents, lumis'
+            ' FROM files WHERE path = ? AND tree = ?',
+            (path, treename)).fetchone()
+        if row is None:
+            return None
+        mtime, size, entries, zip_bytes, branches, nevents, lumi_mask = row
+        if (mtime, size) != file_stamp(path):
+            return None
+        if lumis and lumi_mask is None:
+            return None
+        if lumi_mask is not None:
+            lumi_mask = json.loads(lumi_mask)
+        return FileInfo(path, treename, mtime, size, entries, zip_bytes,
+                        json.loads(branches), nevents, lumi_mask, None)
+
+    def store(self, info):
+        ''' Store a FileInfo in the index.  Failures are not stored. '''
+        if info.error is not None:
+            return
+        lumi_mask = None
+        if info.lumis is not None:
+            lumi_mask = json.dumps(info.lumis)
+        self.db.execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (info.path, info.tree, info.mtime, info.size, info.entries,
+             info.zip_bytes, json.dumps(info.branches), info.nevents,
+             lumi_mask))
+
+    def get(self, files, treename, nprocesses=4, lumis=False, force=False):
+        ''' Get the FileInfo of the tree in each of the files
+
+        The files missing from the index (or all of them, if force is True)
+        are scanned in parallel and added to the index.  The output is in
+        the same order as the input.
+        '''
+        output = {}
+        to_scan = []
+        for path in files:
+            info = None
+            if not force:
+                info = self.lookup(path, treename, lumis)
+            if info is None:
+                to_scan.append(path)
+            else:
+                output[path] = info
+
+        if to_scan:
+            log.info("Scanning %i files for tree %s", len(to_scan), treename)
+            pool = multiprocessing.Pool(nprocesses)
+            try:
+                results = pool.imap_unordered(
+                    _scan_file, [(path, treename, lumis) for path in to_scan])
+                for i, info in enumerate(results):
+                    if info.error is not None:
+                        log.warning("%s: %s", info.path, info.error)
+                    output[info.path] = info
+                    self.store(info)
+                    # Save the progress every once in a while
+                    if i % 100 == 0:
+                        self.db.commit()
+            finally:
+                self.db.commit()
+                pool.close()
+                pool.join()
+
+        return [output[path] for path in files]
+
+    def entries(self, files, treename, nprocesses=4):
+        ''' Get a list of (file, entries) for all the files '''
+        output = []
+        for info in self.get(files, treename, nprocesses):
+            if info.error is not None:
+                raise IOError("%s: %s" % (info.path, info.error))
+            output.append((info.path, info.entries))
+        return output
@@ -2,6 +2,12 @@
 
 A Process object which takes a list of files and TFileMerger's them together.
 
+The merging is done as a tree reduction.  As soon as [fan_in] files are
+available at a given level of the tree, they are merged (in a pool of
+[nprocesses] merge processes) into a file at the next level.  Each input is
+only read once per level, so the total amount of I/O grows as
+N*log(N) instead of N^2, and independent merges run in parallel.
+
 Author: Evan K. Friis, UW Madison
 
 '''
@@ -15,69 +21,140 @@ import ROOT
 import shutil
 import signal
 import tempfile
+import time
+
+from FinalStateAnalysis.PlotTools.MegaTelemetry import TelemetryCollector
+
+def merge_files(inputs, output):
+    ''' Merge the inputs into output, and delete the inputs.
+
+    Returns a tuple of (output, number of inputs, input bytes, merge time)
+    '''
+    start = time.time()
+    input_bytes = sum(os.path.getsize(file) for file in inputs)
+    merger = ROOT.TFileMerger(False)
+    merger.OutputFile(output)
+    for file in inputs:
+        merger.AddFile(file, False)
+    if not merger.Merge():
+        raise IOError("Merging %i files into %s failed" %
+                      (len(inputs), output))
+    for file in inputs:
+        os.remove(file)
+    return (output, len(inputs), input_bytes, time.time() - start)
+
+def _ignore_sigint():
+    ''' Let the parent process take care of Ctrl-c '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 class MegaMerger(multiprocessing.Process):
     log = multiprocessing.get_logger()
-    def __init__(self, input_file_queue, output_file, ninputs):
+    def __init__(self, input_file_queue, output_file, ninputs,
+                 nprocesses=2, fan_in=8, report=None, samples=None):
         super(MegaMerger, self).__init__()
         self.input = input_file_queue
         self.output = output_file
-        self.first_merge = True
         self.ninputs = ninputs
+        self.nprocesses = nprocesses
+        self.fan_in = fan_in
         self.processed = 0
+        # Telemetry of the jobs, written to [report] at the end
+        self.telemetry = TelemetryCollector(report, samples)
         self.pbar = ProgressBar(widgets=[
-            FormatLabel('Processed %(value)i/' + str(ninputs) + ' files. '),
-            ETA(), Bar('>')], maxval=ninputs).start()
+            FormatLabel('Processed %(value)i/' + str(ninputs) + ' files. ')] +
+            self.telemetry.widgets() + [ETA(), Bar('>')],
+            maxval=ninputs).start()
         self.pbar.update(0)
-        self.files_to_clean = None
+        # Files waiting to be merged, keyed by their level in the tree
+        self.levels = {}
+        # (level, AsyncResult) of the merges in progress
+        self.running = []
+        # Throughput bookkeeping
+        self.merged_files = 0
+        self.merged_bytes = 0
+        self.merge_time = 0.
 
-    def merge_into_output(self, files):
-        self.files_to_clean = list(files)
-        self.log.info("Merging %i into output %s", len(files), self.output)
-        # Merge into a temporary output file
+    def temporary_output(self, files):
+        ''' Make a temporary file name from the hash of the files to merge '''
         output_file_hash = hashlib.md5()
-        to_merge = []
         for file in files:
-            to_merge.append(file)
             output_file_hash.update(file)
+        return os.path.join(
+            tempfile.gettempdir(), output_file_hash.hexdigest() + '.root')
 
-        output_file_name = os.path.join(
-            tempfile.gettempdir(),
-            output_file_hash.hexdigest() + '.root')
+    def schedule(self, pool, flush=False):
+        ''' Start merges for every level with enough files waiting.
 
-        # If we are doing a later merge, we need to include the
-        # "merged-so-far"
-        if self.first_merge:
-            self.first_merge = False
-        else:
-            to_merge.append(self.output)
+        If flush is True, all the waiting files are merged together
+        regardless of their level.
+        '''
+        if flush and self.levels:
+            top = max(self.levels.keys())
+            self.levels = {top: sum(
+                (self.levels[x] for x in sorted(self.levels.keys())), [])}
+        for level, files in sorted(self.levels.items()):
+            while len(files) >= self.fan_in or (flush and len(files) > 1):
+                to_merge = files[:self.fan_in]
+                del files[:self.fan_in]
+                output = self.temporary_output(to_merge)
+                self.log.info("Merging %i files at level %i into %s",
+                              len(to_merge), level, output)
+                self.running.append((level + 1, pool.apply_async(
+                    merge_files, (to_merge, output))))
 
-        merger = ROOT.TFileMerger()
-        merger.OutputFile(output_file_name)
-        for file in to_merge:
-            merger.AddFile(file, False)
-        result = merger.Merge()
+    def collect(self):
+        ''' Move the outputs of completed merges to the next level '''
+        still_running = []
+        for level, result in self.running:
+            if not result.ready():
+                still_running.append((level, result))
+                continue
+            # Raises if the merge failed
+            output, nmerged, nbytes, merge_time = result.get()
+            self.merged_files += nmerged
+            self.merged_bytes += nbytes
+            self.merge_time += merge_time
+            self.levels.setdefault(level, []).append(output)
+        self.running = still_running
 
-        self.log.info("Merge completed with result: %s" % result)
-        self.log.info("Output file is: %s, moving to %s", output_file_name,
-                      self.output)
-        shutil.move(output_file_name, self.output)
+    def finalize(self):
+        ''' Merge all the remaining files directly into the output '''
+        remaining = []
+        for level in sorted(self.levels.keys()):
+            remaining.extend(self.levels[level])
+        self.levels = {}
+        if not remaining:
+            self.log.warning("No files to merge into %s", self.output)
+        elif len(remaining) == 1:
+            shutil.move(remaining[0], self.output)
+        else:
+            self.log.info("Merging %i files into output %s",
+                          len(remaining), self.output)
+            output, nmerged, nbytes, merge_time = merge_files(
+                remaining, self.output)
+            self.merged_files += nmerged
+            self.merged_bytes += nbytes
+            self.merge_time += merge_time
 
-        # Cleanup.  We don't need to cleanup the temporary output, since it
-        # is moved.
-        while self.files_to_clean:
-            os.remove(self.files_to_clean.pop())
-        return result
+    def report(self, wall_time):
+        ''' Log the merge throughput '''
+        if not wall_time:
+            return
+        self.log.info(
+            "Merged %i files (%0.1f MB) in %0.1f s (%0.1f s in merges): "
+            "%0.1f files/s, %0.2f MB/s", self.merged_files,
+            self.merged_bytes / 1e6, wall_time, self.merge_time,
+            self.merged_files / wall_time,
+            self.merged_bytes / 1e6 / wall_time)
 
     def run(self):
         # ignore sigterm signal and let parent take care of this
         signal.signal(signal.SIGINT, signal.SIG_IGN)
-        while True:
-            # Check if we are done merging
+        start = time.time()
+        pool = multiprocessing.Pool(self.nprocesses, _ignore_sigint)
+        try:
             done = False
-            inputs_to_merge = []
-            # Accumulate some files to merge
-            while True:
+            while not done:
                 try:
                     self.log.debug("trying to get")
                     to_merge = self.input.get(timeout=1)
@@ -85,22 +162,34 @@ class MegaMerger(multiprocessing.Process):
                     # Check for poison pill
                     if to_merge is None:
                         self.log.info("Got poison pill - shutting down")
+                        self.telemetry.finished_jobs()
                         done = True
-                        break
-                    inputs_to_merge.append(to_merge)
-                    self.processed += to_merge[0]
-                    self.pbar.update(self.processed)
-                    # Make it merge the files if the queue is stacking up.
-                    if len(inputs_to_merge) > 15:
-                        break
+                    else:
+                        entries, file, telemetry = to_merge
+                        self.telemetry.add(telemetry)
+                        self.levels.setdefault(0, []).append(file)
+                        self.processed += entries
+                        self.pbar.update(self.processed)
                 except Empty:
                     self.log.debug("empty to get")
-                    # Noting to merge right now
-                    break
-            if inputs_to_merge:
-                files_to_merge = []
-                for entries, file in inputs_to_merge:
-                    files_to_merge.append(file)
-                self.merge_into_output(files_to_merge)
-            if done:
-                return
+                self.collect()
+                self.schedule(pool)
+
+            # Reduce until everything fits in one last merge.
+            while self.running or \
+                    sum(len(x) for x in self.levels.values()) > self.fan_in:
+                time.sleep(0.1)
+                self.collect()
+                self.schedule(pool, flush=not self.running)
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+        self.finalize()
+        self.report(time.time() - start)
+        self.telemetry.write({
+            'files': self.merged_files,
+            'bytes': self.merged_bytes,
+            'time': self.merge_time,
+        })
@@ -0,0 +1,114 @@
+'''
+
+Low overhead sampling profiler for mega selectors.
+
+Instead of tracing every function call (like cProfile, which distorts tight
+per-event loops), the Python stack is sampled every [interval] seconds of
+CPU time using a SIGPROF timer.  Each sample is recorded as a "collapsed"
+stack: the frames from the outermost to the innermost, as
+file:function:line, separated by semicolons.  Time spent in ROOT (C++) code
+is attributed to the Python line which called it.
+
+If the innermost selector line is a histogram fill, and the booked
+histogram (a key of MegaBase.histograms) can be identified from the source
+line or the local variables, a [histogram path] frame is added, so the cost
+of each fill shows up separately.
+
+The samples of all the jobs are summed and written in the format used by
+flamegraph.pl::
+
+    MyAnalyzer.py:process:85;MyAnalyzer.py:process:91;[signal/MyPt] 42
+
+'''
+
+import linecache
+import os
+import signal
+
+# Default sampling interval, in seconds of CPU time
+DEFAULT_INTERVAL = 0.005
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return '%s:%s:%i' % (os.path.basename(code.co_filename), code.co_name,
+                         frame.f_lineno)
+
+
+class StackSampler(object):
+    ''' Samples the stack of the current process
+
+    [histograms] is the MegaBase.histograms dictionary of the selector.
+    '''
+    def __init__(self, histograms=None, interval=DEFAULT_INTERVAL):
+        self.histograms = histograms if histograms is not None else {}
+        self.interval = interval
+        # collapsed stack => number of samples
+        self.counts = {}
+        # (file, line) => (is a fill, histogram paths written in the line)
+        self.line_cache = {}
+        self.previous_handler = None
+
+    def histogram_label(self, frame):
+        ''' Get the booked histogram a frame is filling, if we can tell '''
+        key = (frame.f_code.co_filename, frame.f_lineno)
+        if key not in self.line_cache:
+            line = linecache.getline(*key)
+            self.line_cache[key] = ('fill' in line.lower(), [
+                path for path in self.histograms
+                if "'%s'" % path in line or '"%s"' % path in line])
+        is_fill, literals = self.line_cache[key]
+        if not is_fill:
+            return None
+        if literals:
+            return literals[0]
+        # i.e. self.histograms[path].Fill(...) or MegaBase.fill(location, ...)
+        for value in frame.f_locals.itervalues():
+            if isinstance(value, basestring) and value in self.histograms:
+                return value
+        return None
+
+    def sample(self, signum, frame):
+        ''' The SIGPROF handler '''
+        stack = []
+        histogram = None
+        while frame is not None:
+            if histogram is None and len(stack) < 3:
+                histogram = self.histogram_label(frame)
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        if histogram is not None:
+            stack.append('[%s]' % histogram)
+        collapsed = ';'.join(stack)
+        self.counts[collapsed] = self.counts.get(collapsed, 0) + 1
+
+    def start(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        # Don't make the ROOT I/O system calls fail with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def add_samples(total, counts):
+    ''' Add the sample counts of a job to a total '''
+    for stack, count in counts.iteritems():
+        total[stack] = total.get(stack, 0) + count
+
+
+def write_collapsed(path, counts):
+    ''' Write sample counts in the flamegraph.pl collapsed format '''
+    with open(path, 'w') as output:
+        for stack, count in sorted(counts.iteritems()):
+            output.write('%s %i\n' % (stack, count))
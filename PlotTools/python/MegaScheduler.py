@@ -0,0 +1,233 @@
+'''
+
+Adaptive, memory aware sizing of the mega worker pool.
+
+The dispatcher periodically measures the CPU utilization and memory of its
+workers (and of the merger processes) from /proc, and asks a
+WorkerScheduler how many workers should be running:
+
+    * if the workers are mostly waiting on I/O (low CPU utilization), one
+      more worker is started, up to [max_workers], as long as the memory
+      budget allows for it.
+    * if the total memory gets close to the memory budget, the worker using
+      the most memory is stopped after its current job.
+
+The memory of a process is its proportional set size (PSS): the forked
+workers share the pages of the ROOT libraries and of the preloaded selector
+with the dispatcher, copy-on-write, and summing their resident set sizes
+would count these pages once per worker.  The PSS splits the shared pages
+between the processes using them, so the sum is the real memory used.
+Where the PSS is not available, the RSS is used.
+
+The scheduler only changes the pool size once per [cooldown] seconds, so
+the effect of the previous change can be measured first.
+
+'''
+
+import os
+import time
+
+_CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK')) \
+    if hasattr(os, 'sysconf') else 100.
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def parse_stat(line):
+    ''' Parse a /proc/[pid]/stat line into (pid, ppid, cpu seconds, rss)
+
+    The RSS is in bytes.  The command name can contain spaces and
+    parentheses, so the fields are counted from the last ')'.
+
+    >>> line = '42 (my (odd) cmd) S 7 ' + ' '.join(['0'] * 9) + ' 250 150 '
+    >>> line += ' '.join(['0'] * 8) + ' 10'
+    >>> pid, ppid, cpu, rss = parse_stat(line)
+    >>> pid, ppid, cpu == 400 / _CLOCK_TICKS, rss == 10 * _PAGE_SIZE
+    (42, 7, True, True)
+
+    '''
+    pid = int(line[:line.index(' ')])
+    fields = line[line.rindex(')') + 2:].split()
+    # fields[0] is the state (3rd field of the stat file)
+    ppid = int(fields[1])
+    cpu = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    rss = int(fields[21]) * _PAGE_SIZE
+    return pid, ppid, cpu, rss
+
+
+def read_process_table():
+    ''' Get {pid: (ppid, cpu seconds, rss bytes)} of all processes
+
+    Returns an empty dictionary where /proc is not available.
+    '''
+    output = {}
+    if not os.path.isdir('/proc'):
+        return output
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as stat:
+                pid, ppid, cpu, rss = parse_stat(stat.read())
+        except (IOError, OSError, ValueError, IndexError):
+            # The process is gone
+            continue
+        output[pid] = (ppid, cpu, rss)
+    return output
+
+
+def parse_pss(lines):
+    ''' Sum the Pss lines of a /proc/[pid]/smaps(_rollup) file, in bytes
+
+    >>> parse_pss(['Rss:     1296 kB', 'Pss:      417 kB',
+    ...            'Pss_Anon:   100 kB'])
+    427008
+    '''
+    total = 0
+    for line in lines:
+        if line.startswith('Pss:'):
+            total += int(line.split()[1]) * 1024
+    return total
+
+
+def read_pss(pid):
+    ''' Get the PSS of a process in bytes, or None if it is not available
+
+    smaps_rollup (Linux >= 4.14) is much cheaper to read than smaps.
+    '''
+    for name in ('smaps_rollup', 'smaps'):
+        try:
+            with open('/proc/%i/%s' % (pid, name)) as smaps:
+                return parse_pss(smaps)
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+    return None
+
+
+def tree_usage(table, pid, read_memory=read_pss):
+    ''' Total (cpu seconds, memory bytes) of a process and its descendants
+
+    The memory of each process is given by [read_memory] (the PSS by
+    default), or is the RSS from the [table] if it returns None.
+
+    >>> table = {1: (0, 1., 100), 2: (1, 2., 200), 3: (2, 3., 300),
+    ...          4: (0, 4., 400)}
+    >>> tree_usage(table, 2, lambda pid: None)
+    (5.0, 500)
+    >>> tree_usage(table, 1, lambda pid: 10 if pid != 3 else None)
+    (6.0, 320)
+    '''
+    children = {}
+    for child, (ppid, cpu, rss) in table.iteritems():
+        children.setdefault(ppid, []).append(child)
+    total_cpu, total_memory = 0., 0
+    to_visit = [pid]
+    while to_visit:
+        current = to_visit.pop()
+        if current not in table:
+            continue
+        total_cpu += table[current][1]
+        memory = read_memory(current)
+        total_memory += table[current][2] if memory is None else memory
+        to_visit.extend(children.get(current, []))
+    return total_cpu, total_memory
+
+
+class WorkerScheduler(object):
+    ''' Decides how the worker pool should change
+
+    [memory_budget] is in bytes (None for no limit).  Above [high_water]
+    times the budget workers are stopped.  Workers are added while their
+    mean CPU utilization is below [io_bound].
+
+    >>> scheduler = WorkerScheduler(2, 4, memory_budget=1000, cooldown=0)
+    >>> scheduler.decide({1: (0.3, 200), 2: (0.4, 200)}, 100, 10)
+    1
+    >>> scheduler.target
+    3
+    >>> scheduler.decide({1: (0.3, 200), 2: (0.4, 200), 3: (0.3, 200)},
+    ...                  400, 10)
+    -1
+    >>> scheduler.decide({1: (0.95, 200), 2: (0.95, 200)}, 100, 10)
+    0
+
+    '''
+    def __init__(self, nworkers, max_workers=None, memory_budget=None,
+                 io_bound=0.75, high_water=0.9, cooldown=10.):
+        self.target = nworkers
+        self.max_workers = max(max_workers or nworkers, nworkers)
+        self.memory_budget = memory_budget
+        self.io_bound = io_bound
+        self.high_water = high_water
+        self.cooldown = cooldown
+        self.last_change = None
+
+    def decide(self, workers, other_memory, nleft):
+        ''' Get the change of the number of workers (-1, 0 or +1)
+
+        [workers] maps the workers to their (CPU utilization, memory), with a
+        CPU utilization of 1 for a fully busy worker.  [other_memory] is the
+        memory used by the other processes of the job, and [nleft] the
+        number of jobs not yet started.  Workers which were already asked to
+        stop should be left out of both, they will free their memory soon.
+        '''
+        if not workers:
+            return 0
+        now = time.time()
+        total_memory = other_memory + sum(x[1] for x in workers.itervalues())
+        limit = None
+        if self.memory_budget is not None:
+            limit = self.high_water * self.memory_budget
+        change = 0
+        if limit is not None and total_memory > limit:
+            # Don't wait for the cooldown, memory is urgent
+            if self.target > 1:
+                change = -1
+        elif self.last_change is not None and \
+                now - self.last_change < self.cooldown:
+            change = 0
+        elif self.target < self.max_workers and nleft > len(workers):
+            utilization = sum(x[0] for x in workers.itervalues()) / \
+                len(workers)
+            largest = max(x[1] for x in workers.itervalues())
+            if utilization < self.io_bound and (
+                    limit is None or total_memory + largest < limit):
+                change = 1
+        if change:
+            self.target += change
+            self.last_change = now
+        return change
+
+
+class UsageMonitor(object):
+    ''' Measures the CPU utilization and memory (PSS) of the job processes '''
+    def __init__(self):
+        # pid => (time, cpu seconds) of the previous measurement
+        self.previous = {}
+
+    def measure(self, workers, others):
+        ''' Get ({worker: (utilization, memory)}, memory of the others)
+
+        [workers] and [others] are lists of (running) Process objects.
+        The utilization of a worker is only known from its second
+        measurement, so new workers are left out until then.
+        '''
+        table = read_process_table()
+        now = time.time()
+        output = {}
+        current = {}
+        for worker in workers:
+            cpu, memory = tree_usage(table, worker.pid)
+            current[worker.pid] = (now, cpu)
+            if worker.pid in self.previous:
+                then, previous_cpu = self.previous[worker.pid]
+                utilization = (cpu - previous_cpu) / max(now - then, 1e-9)
+                output[worker] = (utilization, memory)
+        self.previous = current
+        other_memory = sum(tree_usage(table, process.pid)[1]
+                        for process in others)
+        return output, other_memory
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
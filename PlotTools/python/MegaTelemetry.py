@@ -0,0 +1,237 @@
+'''
+
+Per-stage timing and throughput counters for mega jobs.
+
+Each job (file, chain or entry range) records how long it spends in each
+stage:
+
+    * open: opening the inputs and building the selector
+    * read: TTree::GetEntry (row mode) or reading chunks (columnar mode)
+    * fill: histogram fills (columnar mode, via MegaBase.fill)
+    * process: the whole event loop, read and fill included
+    * begin, finish: the selector begin() and finish() methods
+
+and counts the entries processed and the bytes read from disk.  The job
+telemetry is sent back with the results to the merger, which adds its own
+merge time and writes a JSON report at the end of the job.
+
+Selectors can time their own stages with::
+
+    with self.telemetry.timer('my_stage'):
+        ...
+
+'''
+
+import contextlib
+import json
+import time
+
+from progressbar import Widget
+
+from FinalStateAnalysis.PlotTools.MegaSampler import add_samples, \
+    write_collapsed
+
+
+class Telemetry(object):
+    ''' Accumulated stage times and counters
+
+    >>> telemetry = Telemetry()
+    >>> telemetry.count('entries', 10)
+    >>> telemetry.add_time('read', 1.5)
+    >>> other = Telemetry.from_dict(telemetry.to_dict())
+    >>> other.update(telemetry)
+    >>> other.counters['entries'], other.times['read']
+    (20, 3.0)
+
+    '''
+    def __init__(self):
+        # stage => seconds
+        self.times = {}
+        # name => count
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        ''' Time a block of code '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start)
+
+    def add_time(self, stage, seconds):
+        self.times[stage] = self.times.get(stage, 0.) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def update(self, other):
+        ''' Add the contents of another Telemetry (or its dict) '''
+        if isinstance(other, dict):
+            other = Telemetry.from_dict(other)
+        for stage, seconds in other.times.iteritems():
+            self.add_time(stage, seconds)
+        for name, n in other.counters.iteritems():
+            self.count(name, n)
+
+    def to_dict(self):
+        return {'times': dict(self.times), 'counters': dict(self.counters)}
+
+    @classmethod
+    def from_dict(cls, data):
+        output = cls()
+        output.times.update(data.get('times', {}))
+        output.counters.update(data.get('counters', {}))
+        return output
+
+    def summary(self, wall_time=None):
+        ''' Derived quantities: throughput and selector time '''
+        times = self.times
+        output = {}
+        output['selector_time'] = max(0., times.get('process', 0.) -
+                                      times.get('read', 0.) -
+                                      times.get('fill', 0.))
+        if wall_time:
+            output['entries_per_second'] = \
+                self.counters.get('entries', 0) / wall_time
+            output['MB_per_second'] = \
+                self.counters.get('bytes_read', 0) / 1e6 / wall_time
+        return output
+
+
+class TimedTree(object):
+    ''' Proxy for a TTree which times the reading of entries '''
+    def __init__(self, tree, telemetry):
+        # Avoid triggering __getattr__ for our own members
+        self.__dict__['_tree'] = tree
+        self.__dict__['_telemetry'] = telemetry
+
+    def __getattr__(self, attr):
+        return getattr(self._tree, attr)
+
+    def GetEntry(self, entry, getall=0):
+        start = time.time()
+        result = self._tree.GetEntry(entry, getall)
+        self._telemetry.add_time('read', time.time() - start)
+        self._telemetry.count('entries')
+        return result
+
+    def __iter__(self):
+        # Time the steps of the iteration of the wrapped tree, so an entry
+        # range (EntryRangeTree) is respected
+        rows = iter(self._tree)
+        telemetry = self._telemetry
+        while True:
+            start = time.time()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            telemetry.add_time('read', time.time() - start)
+            telemetry.count('entries')
+            yield row
+
+
+class ThroughputLabel(Widget):
+    ''' Progress bar widget with the live entry rate and read bandwidth '''
+    def __init__(self, telemetry, start):
+        self.telemetry = telemetry
+        self.start = start
+
+    def update(self, pbar):
+        summary = self.telemetry.summary(max(time.time() - self.start, 1e-9))
+        return '%0.1f kHz %0.1f MB/s ' % (
+            summary['entries_per_second'] / 1e3, summary['MB_per_second'])
+
+
+def bottleneck(total, nworkers, merge_tail):
+    ''' Guess what limits a job: reading, the selector, or merging
+
+    The read and selector times are summed over the workers, which run in
+    parallel.  The merging only costs wall time after the last job is done
+    ([merge_tail]), the rest overlaps with the workers.
+    '''
+    nworkers = max(nworkers, 1)
+    candidates = {
+        'io': total.times.get('read', 0.) / nworkers,
+        'cpu': (total.summary()['selector_time'] +
+                total.times.get('fill', 0.)) / nworkers,
+        'merge': merge_tail,
+    }
+    return max(candidates, key=lambda x: candidates[x])
+
+
+def write_report(path, workers, merge, wall_time):
+    ''' Write the JSON telemetry report of a mega job
+
+    [workers] maps worker name => Telemetry, [merge] is a dictionary of the
+    merger statistics.  merge['tail_time'] is the time between the end of
+    the last job and the end of the merging.
+    '''
+    total = Telemetry()
+    for telemetry in workers.itervalues():
+        total.update(telemetry)
+    report = {
+        'wall_time': wall_time,
+        'total': dict(total.to_dict(), **total.summary(wall_time)),
+        'workers': dict(
+            (name, dict(telemetry.to_dict(), **telemetry.summary()))
+            for name, telemetry in workers.iteritems()),
+        'merge': merge,
+        'bottleneck': bottleneck(total, len(workers),
+                                 merge.get('tail_time', 0.)),
+    }
+    with open(path, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    return report
+
+
+class TelemetryCollector(object):
+    ''' Collects the telemetry of the jobs in the merger process
+
+    The JSON report is written to [report], and the stack samples of the
+    jobs (see MegaSampler) to [samples], if they are not None.
+    '''
+    def __init__(self, report=None, samples=None):
+        self.report = report
+        self.samples = samples
+        # collapsed stack => number of samples
+        self.sample_counts = {}
+        self.start = time.time()
+        # Time when the last job finished
+        self.jobs_done = None
+        self.total = Telemetry()
+        # worker name => Telemetry
+        self.workers = {}
+
+    def widgets(self):
+        ''' Progress bar widgets to show the live throughput '''
+        if self.report is None:
+            return []
+        return [ThroughputLabel(self.total, self.start)]
+
+    def add(self, data):
+        ''' Add the telemetry dictionary of a job '''
+        worker = data.get('worker', 'unknown')
+        add_samples(self.sample_counts, data.get('samples', {}))
+        self.workers.setdefault(worker, Telemetry()).update(data)
+        self.total.update(data)
+
+    def finished_jobs(self):
+        self.jobs_done = time.time()
+
+    def write(self, merge):
+        ''' Write the report, with the merger statistics [merge] '''
+        if self.samples is not None:
+            write_collapsed(self.samples, self.sample_counts)
+        if self.report is None:
+            return None
+        end = time.time()
+        merge = dict(merge, tail_time=end - (self.jobs_done or end))
+        return write_report(self.report, self.workers, merge,
+                            end - self.start)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -7,16 +7,21 @@ analyzes, them, and stores the results in output ROOT files.
 
 from FileProcessor import FileProcessor
 from ChainProcessor import ChainProcessor
+from EntryRange import EntryRange
 import hashlib
 import multiprocessing
 import os
+import Queue
 import signal
 import tempfile
 
 def make_hashed_filename(to_process):
     ''' Make an output file from the hash of the file(s) to process '''
     hash = hashlib.md5(os.environ['LOGNAME']) # so users don't collide
-    if isinstance(to_process, basestring):
+    if isinstance(to_process, EntryRange):
+        hash.update('%s:%i:%i' % to_process)
+        return hash.hexdigest() + '.root'
+    elif isinstance(to_process, basestring):
         hash.update(to_process)
         return hash.hexdigest() + '.root'
     else:
@@ -27,7 +32,10 @@ def make_hashed_filename(to_process):
 class MegaWorker(multiprocessing.Process):
     log = multiprocessing.get_logger()
     def __init__(self, input_file_queue, results_queue, treename, selector,
-                 output_dir=None, **kwargs):
+                 output_dir=None, chunk_size=None, learn_entries=None,
+                 in_memory=False, profile_dir=None, sample_interval=None,
+                 stop=None, max_tasks=None, taken=None, time_entries=False,
+                 **kwargs):
         super(MegaWorker, self).__init__()
         self.input = input_file_queue
         self.output = results_queue
@@ -36,18 +44,51 @@ class MegaWorker(multiprocessing.Process):
         self.output_dir = output_dir
         if self.output_dir is None:
             self.output_dir = tempfile.gettempdir()
+        # Run the selector in columnar mode if set
+        self.chunk_size = chunk_size
+        # Prune unused branches after this many entries if set
+        self.learn_entries = learn_entries
+        # Send HistogramBundles instead of file names to the results queue
+        self.in_memory = in_memory
+        # If set, write a cProfile output for each job in this directory
+        self.profile_dir = profile_dir
+        # If set, sample the stack of the jobs with this interval
+        self.sample_interval = sample_interval
+        # If true, time the reading of the entries for the telemetry
+        self.time_entries = time_entries
+        # If set (multiprocessing.Event), exit after the current job
+        self.stop = stop
+        # If set, exit after this many jobs, to bound memory leaks.  The
+        # dispatcher starts a fresh worker if there are jobs left.
+        self.max_tasks = max_tasks
+        # If set (multiprocessing.Value), count the jobs taken from the queue
+        self.taken = taken
+        # Histogram templates already sent to the accumulator
+        self.sent_templates = set([])
         # Passed to selector
         self.options = kwargs
 
     def run(self):
         # ignore sigterm signal and let parent take care of this
         signal.signal(signal.SIGINT, signal.SIG_IGN)
-        while True:
-            to_process = self.input.get()
+        ntasks = 0
+        while self.max_tasks is None or ntasks < self.max_tasks:
+            if self.stop is not None and self.stop.is_set():
+                self.log.info("Asked to stop - shutting down")
+                break
+            try:
+                # Don't block forever, so we notice if we are asked to stop
+                to_process = self.input.get(timeout=1)
+            except Queue.Empty:
+                continue
             # Poison pill
             if to_process is None:
                 self.log.info("Got poison pill - shutting down")
                 break
+            ntasks += 1
+            if self.taken is not None:
+                with self.taken.get_lock():
+                    self.taken.value += 1
 
             # Make a unique output file name
             output_file_name = os.path.join(
@@ -55,7 +96,14 @@ class MegaWorker(multiprocessing.Process):
 
             # Do we need to chain the files or not?
             processor_class = FileProcessor
-            if isinstance(to_process, basestring):
+            inputs = to_process
+            first_entry, nentries = 0, None
+            if isinstance(to_process, EntryRange):
+                self.log.info("Processing %i entries of file %s => %s",
+                              to_process.nentries, to_process.file,
+                              output_file_name)
+                inputs, first_entry, nentries = to_process
+            elif isinstance(to_process, basestring):
                 self.log.info("Processing file %s => %s",
                               to_process, output_file_name)
             else:
@@ -65,18 +113,21 @@ class MegaWorker(multiprocessing.Process):
 
             try:
                 processor = processor_class(
-                    to_process, self.tree, self.selector,
-                    output_file_name, self.log, **self.options)
+                    inputs, self.tree, self.selector,
+                    output_file_name, self.log, chunk_size=self.chunk_size,
+                    learn_entries=self.learn_entries,
+                    in_memory=self.in_memory, first_entry=first_entry,
+                    nentries=nentries, sample_interval=self.sample_interval,
+                    time_entries=self.time_entries, **self.options)
 
                 # Check if we want to profile the script
-                profile_dir_base = os.environ.get('megaprofile', None)
                 result = None
-                if profile_dir_base is None:
+                if self.profile_dir is None:
                     result = processor.process()
                 else:
                     import cProfile
                     profile_dir = os.path.join(
-                        profile_dir_base,
+                        self.profile_dir,
                         self.selector.__name__,
                     )
                     if not os.path.exists(profile_dir):
@@ -85,10 +136,16 @@ class MegaWorker(multiprocessing.Process):
                         profile_dir,
                         make_hashed_filename(to_process).replace('.root', '.prf')
                     )
+                    namespace = {'processor': processor}
                     cProfile.runctx('result = processor.process()',
-                                    globals(), locals(), profile_output)
-                    # Fake this.
-                    result = (len(to_process), output_file_name)
+                                    globals(), namespace, profile_output)
+                    result = namespace['result']
+                # Tag the telemetry with the worker it comes from
+                result[2]['worker'] = self.name
+                if self.in_memory:
+                    bundle = result[1]
+                    bundle.drop_templates(self.sent_templates)
+                    self.sent_templates.update(bundle.templates.keys())
                 self.output.put(result)
             except:
                 # If we fail, put a poison pill to stop the merge job.
@@ -2,11 +2,20 @@
 
 Base class which makes nice plots.
 
+Large sets of plots can be made in one go with Plotter.plot_batch, which
+renders the plots in a pool of processes and skips plots whose inputs
+have not changed since they were last made.
+
 Author: Evan K. Friis, UW
 
 '''
 
+from collections import namedtuple
 import fnmatch
+import hashlib
+import json
+import logging
+import multiprocessing
 import os
 import rootpy.plotting.views as views
 import rootpy.plotting as plotting
@@ -22,6 +31,37 @@ def _monkey_patch_legend_draw(self, *args, **kwargs):
     _original_draw(self, *args, **kwargs)
 plotting.Legend.Draw = _monkey_patch_legend_draw
 
+log = logging.getLogger("Plotter")
+
+# A plot to make with plot_batch.  The plot is saved as [filename].png/pdf
+PlotSpec = namedtuple('PlotSpec', [
+    'filename', 'folder', 'variable', 'rebin', 'xaxis', 'leftside', 'xrange'])
+
+def plot_spec(filename, folder, variable, rebin=1, xaxis='', leftside=True,
+              xrange=None):
+    ''' Make a PlotSpec, with the same defaults as plot_mc_vs_data '''
+    return PlotSpec(filename, folder, variable, rebin, xaxis, leftside,
+                    xrange)
+
+def histogram_hash(hash, histo):
+    ''' Update [hash] with the content and style of a histogram '''
+    if histo.InheritsFrom('TH1'):
+        hash.update(repr([(histo.GetBinContent(i), histo.GetBinError(i))
+                          for i in xrange(histo.GetSize())]))
+    hash.update(repr((histo.GetName(), histo.GetTitle(),
+                      histo.GetLineColor(), histo.GetFillColor(),
+                      histo.GetFillStyle(), histo.GetMarkerStyle())))
+
+# The Plotter used by the plot_batch worker processes.  It is inherited from
+# the parent process when the pool is forked.
+_batch_plotter = None
+
+def _render(spec):
+    ''' Make one plot in a worker process '''
+    ROOT.gROOT.SetBatch(True)
+    _batch_plotter.render(spec)
+    return spec
+
 class Plotter(object):
     def __init__(self, files, lumifiles, outputdir, blinder=None):
         ''' Initialize the Plotter object
@@ -194,3 +234,84 @@ class Plotter(object):
             mc_stack.SetMaximum(1.2*data.GetMaximum())
         # Add legend
         self.add_legend([data, mc_stack], leftside, entries=5)
+
+    def render(self, spec):
+        ''' Make and save the plot described by a PlotSpec
+
+        Override this to customize the plots made by plot_batch.
+        '''
+        self.plot_mc_vs_data(spec.folder, spec.variable, spec.rebin,
+                             spec.xaxis, spec.leftside, spec.xrange)
+        self.save(spec.filename)
+
+    def spec_inputs(self, spec):
+        ''' Get the histograms that a PlotSpec depends on '''
+        path = os.path.join(spec.folder, spec.variable)
+        samples = [self.get_view(x) for x in self.mc_samples]
+        samples.append(self.get_view('data'))
+        return [self.rebin_view(x, spec.rebin).Get(path) for x in samples]
+
+    def spec_hash(self, spec):
+        ''' Hash the input histograms and the spec of a plot '''
+        hash = hashlib.sha1(repr(tuple(spec)))
+        hash.update(repr(self.mc_samples))
+        for histo in self.spec_inputs(spec):
+            histogram_hash(hash, histo)
+        return hash.hexdigest()
+
+    def plot_batch(self, specs, nprocesses=4, force=False):
+        ''' Make a list of plots in parallel
+
+        Plots whose inputs (the histograms and the PlotSpec) have the same
+        hash as when they were last made are skipped, unless [force] is
+        True.  The hashes are stored in [outputdir]/plot_hashes.json.
+
+        Returns the list of the PlotSpecs which were made.
+        '''
+        global _batch_plotter
+        manifest_file = os.path.join(self.outputdir, 'plot_hashes.json')
+        manifest = {}
+        if not os.path.exists(self.outputdir):
+            os.makedirs(self.outputdir)
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as manifest_json:
+                manifest = json.load(manifest_json)
+
+        # Fetching the inputs here also fills the histogram cache, which is
+        # inherited by the workers.
+        to_make = []
+        hashes = {}
+        for spec in specs:
+            hashes[spec.filename] = self.spec_hash(spec)
+            outputs = [os.path.join(self.outputdir, spec.filename) + x
+                       for x in ('.png', '.pdf')]
+            if not force and \
+                    manifest.get(spec.filename) == hashes[spec.filename] and \
+                    all(os.path.exists(x) for x in outputs):
+                continue
+            to_make.append(spec)
+            # Make sure subdirectories exist
+            directory = os.path.dirname(outputs[0])
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        log.info("Making %i/%i plots (the others are up to date)",
+                 len(to_make), len(specs))
+
+        made = []
+        _batch_plotter = self
+        pool = multiprocessing.Pool(nprocesses)
+        try:
+            for spec in pool.imap_unordered(_render, to_make):
+                manifest[spec.filename] = hashes[spec.filename]
+                made.append(spec)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _batch_plotter = None
+            # Save what was done, even if something failed
+            with open(manifest_file, 'w') as manifest_json:
+                json.dump(manifest, manifest_json, indent=2)
+        return made
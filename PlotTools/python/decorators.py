@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from functools import update_wrapper
 
 def decorator(d):
@@ -41,4 +42,40 @@ def memo_last(fn):
             print "cannot do"
             return fn(*args, **kwargs)
     return _f
-        
+
+def memo_lru(maxsize=10000):
+    '''Decorator to memoize (cache) the last [maxsize] distinct results of a
+    function, dropping the least recently used one when the cache is full.
+    Useful for slow functions of a few discrete inputs, which repeat often
+    but not necessarily in consecutive calls.
+
+    >>> @memo_lru(2)
+    ... def square(x):
+    ...     print "computing", x
+    ...     return x * x
+    >>> square(2), square(3), square(2)
+    computing 2
+    computing 3
+    (4, 9, 4)
+    >>> square(4), square(2), square(3)
+    computing 4
+    computing 3
+    (16, 4, 9)
+    '''
+    def _decorator(fn):
+        cache = OrderedDict()
+        def _f(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            try: #check if we have it in cache, and move it to the end
+                result = cache.pop(key)
+            except KeyError: #No, we don't
+                result = fn(*args, **kwargs)
+                if len(cache) >= maxsize:
+                    cache.popitem(last=False)
+            except TypeError: #the args cannot be a key of dict (like lists)
+                return fn(*args, **kwargs)
+            cache[key] = result
+            return result
+        _f.cache = cache
+        return update_wrapper(_f, fn)
+    return _decorator
@@ -0,0 +1,31 @@
+'''
+
+Read the event lists written by megaevents.py.
+
+The lists are in JSON-lines format (one event per line).  Old style lists (a
+single JSON list of events) are also accepted.
+
+>>> from StringIO import StringIO
+>>> list(read_events(StringIO('{"evt": [1, 2, 3]}\\n\\n{"evt": [1, 2, 4]}\\n')))
+[{u'evt': [1, 2, 3]}, {u'evt': [1, 2, 4]}]
+>>> list(read_events(StringIO('[{"evt": [1, 2, 3]}, {"evt": [1, 2, 4]}]')))
+[{u'evt': [1, 2, 3]}, {u'evt': [1, 2, 4]}]
+
+'''
+
+import json
+
+def read_events(file):
+    ''' Generate the events in a megaevents output file '''
+    first = file.read(1)
+    file.seek(0)
+    if first == '[':
+        for event in json.load(file):
+            yield event
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+if __name__ == "__main__":
+    import doctest; doctest.testmod()
@@ -151,6 +151,51 @@ You cane make a cut "explain" itself.
 >>> anded_cut.explain(fake_tree)
 "[Branch('elecPt') < 20 failed]"
 
+Vectorized selections
+---------------------
+
+Selections can also be evaluated on a dictionary of branch arrays (for
+example, a ColumnChunk in columnar mode), giving a boolean mask:
+
+>>> import numpy
+>>> columns = {
+...     'muPt' : numpy.array([5., 25., 15., 40.]),
+...     'elecPt' : numpy.array([10., 30., 10., 10.]),
+... }
+>>> (tree.muPt > 20).mask(columns)
+array([False,  True, False,  True])
+>>> (mu_is_harder & (tree.muPt < 30)).mask(columns)
+array([False, False,  True, False])
+>>> (~mu_is_harder | (tree.muPt > 30)).mask(columns)
+array([ True,  True, False,  True])
+
+And(...) selections evaluate each term only on the entries which passed the
+previous terms, and keep track of how many entries each term rejects.
+The terms are then reordered so the most powerful cut is applied first.
+
+>>> weak_then_strong = And(tree.elecPt > 5, tree.muPt > 30)
+>>> weak_then_strong.mask(columns)
+array([False, False, False,  True])
+>>> weak_then_strong.rejection_rate(0), weak_then_strong.rejection_rate(1)
+(0.0, 0.75)
+>>> weak_then_strong.term_order()
+[1, 0]
+
+TTreeFormula strings
+--------------------
+
+Selections can also be converted to strings for TTree::Draw or
+TTree::CopyTree.  And(...) terms are ordered by rejection rate too.
+
+>>> (abs(tree.negativeNumber) > 30).to_formula()
+'(abs(negativeNumber) > 30)'
+>>> (tree.elecId.bit(2) >= 1).to_formula()
+'((int(elecId) & 2) >= 1)'
+>>> weak_then_strong.to_formula()
+'((muPt > 30) && (elecPt > 5))'
+>>> (~mu_is_harder | (tree.elecPt + 6 < 20)).to_formula()
+'(!(muPt > elecPt) || ((elecPt + 6) < 20))'
+
 Branch Bookkeeping
 ------------------
 
@@ -162,12 +207,81 @@ The MetaTree object also keeps track of which branches are accessed:
 '''
 
 
+import numpy
 import operator
 
+def _column_length(columns):
+    ''' Get the number of entries in a dictionary of branch arrays '''
+    size = getattr(columns, 'size', None)
+    if size is not None:
+        return size
+    for column in columns.itervalues():
+        return len(column)
+    return 0
+
+def _vectorizable(*values):
+    ''' Check if all the values can be evaluated on branch arrays '''
+    return all(value.array_getter is not None for value in values)
+
+def _compose(template, *values):
+    ''' Build a TTreeFormula expression from values, if they all have one '''
+    formulas = tuple(value.formula for value in values)
+    if None in formulas:
+        return None
+    return template % formulas
+
+def _constant(value):
+    ''' Format a Python constant for a TTreeFormula expression
+
+    Returns None if the constant can't be written in a formula.
+
+    >>> _constant(5L), _constant(True), _constant(0.1), _constant('a"b')
+    ('5', '1', '0.1', '"a\\\\"b"')
+    >>> _constant(numpy.float32(2.5)), _constant(numpy.int32(3))
+    ('2.5', '3')
+    '''
+    if isinstance(value, (bool, numpy.bool_)):
+        return '1' if value else '0'
+    if isinstance(value, (int, long, numpy.integer)):
+        return '%d' % value
+    if isinstance(value, (float, numpy.floating)):
+        return repr(float(value))
+    if isinstance(value, basestring):
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return None
+
+def _compose_constant(template, value, constant):
+    ''' Build the TTreeFormula expression template % (value, constant) '''
+    text = _constant(constant)
+    if value.formula is None or text is None:
+        return None
+    return template % (value.formula, text)
+
+class _ColumnSubset(object):
+    ''' A view of a subset of the entries in a dictionary of branch arrays
+
+    The columns are only indexed when they are accessed.
+    '''
+    def __init__(self, columns, indices):
+        self.columns = columns
+        self.indices = indices
+        self.size = len(indices)
+        self.cache = {}
+
+    def __getitem__(self, branch):
+        if branch not in self.cache:
+            self.cache[branch] = numpy.asarray(
+                self.columns[branch])[self.indices]
+        return self.cache[branch]
+
 class Selection(object):
-    def __init__(self, selection, repr="Selection"):
+    def __init__(self, selection, repr="Selection", masker=None, formula=None):
         self.functor = selection
         self.repr = repr
+        # Vectorized version of the functor, operating on branch arrays
+        self.masker = masker
+        # Equivalent TTreeFormula expression
+        self.formula = formula
         self.last_result = None
         self.last_entry = None
 
@@ -184,6 +298,23 @@ class Selection(object):
             self.last_result = result
             return result
 
+    def mask(self, columns):
+        ''' Evaluate the selection on a dictionary of branch arrays
+
+        Returns a boolean array with the result for each entry.
+        '''
+        if self.masker is None:
+            raise NotImplementedError(
+                "Selection %s can't be vectorized" % self.repr)
+        return numpy.asarray(self.masker(columns), dtype=bool)
+
+    def to_formula(self):
+        ''' Get the selection as a TTreeFormula/TTree::Draw string '''
+        if self.formula is None:
+            raise NotImplementedError(
+                "Selection %s has no TTreeFormula equivalent" % self.repr)
+        return self.formula
+
     def __repr__(self):
         return self.repr
 
@@ -200,14 +331,27 @@ class Selection(object):
 
     def __invert__(self):
         ''' Bitwise ~ operator - invert the cuts '''
-        def invert_cut(tree):
-            return not self(tree)
-        return Selection(invert_cut, "!%s" % self)
+        return Not(self)
 
     def explain(self, tree):
         ''' Explain what this cut does, given the TTree '''
         return "NotImplemented"
 
+class Not(Selection):
+    def __init__(self, selection):
+        self.selection = selection
+        def invert_cut(tree):
+            return not selection(tree)
+        super(Not, self).__init__(invert_cut, "!%s" % selection)
+
+    def mask(self, columns):
+        ''' Evaluate the inverted cut on a dictionary of branch arrays '''
+        return ~self.selection.mask(columns)
+
+    def to_formula(self):
+        ''' Get the inverted cut as a TTreeFormula string '''
+        return "!%s" % self.selection.to_formula()
+
 class And(Selection):
     def __init__(self, *selections):
         self.selections = selections
@@ -218,6 +362,10 @@ class And(Selection):
             return True
         super(And, self).__init__(functor, "AND[%s]" % ' '.join(
             [str(x) for x in selections]))
+        # Number of entries evaluated/rejected by each (flattened) term.
+        self.terms = list(self)
+        self.evaluated = [0] * len(self.terms)
+        self.rejected = [0] * len(self.terms)
 
     def explain(self, tree):
         ''' Figure out which cut caused the And to fail '''
@@ -244,8 +392,56 @@ class And(Selection):
             else:
                 yield selection
 
+    def rejection_rate(self, i):
+        ''' Fraction of the entries evaluated by the ith term it rejected '''
+        if not self.evaluated[i]:
+            return 0.
+        return float(self.rejected[i]) / self.evaluated[i]
+
+    def term_order(self):
+        ''' Indices of the terms, sorted by decreasing rejection rate
+
+        Terms which have not been measured yet keep their declared order.
+        '''
+        return sorted(range(len(self.terms)),
+                      key=lambda i: -self.rejection_rate(i))
+
+    def mask(self, columns):
+        ''' Evaluate the AND on a dictionary of branch arrays
+
+        Each term is only evaluated on the entries which passed the previous
+        terms.  The terms are ordered by their measured rejection rate, so
+        the most powerful cuts are applied first.
+        '''
+        nentries = _column_length(columns)
+        indices = numpy.arange(nentries)
+        subset = columns
+        for i in self.term_order():
+            if not len(indices):
+                break
+            passed = self.terms[i].mask(subset)
+            self.evaluated[i] += len(indices)
+            npassed = numpy.count_nonzero(passed)
+            self.rejected[i] += len(indices) - npassed
+            if npassed < len(indices):
+                indices = indices[passed]
+                subset = _ColumnSubset(columns, indices)
+        result = numpy.zeros(nentries, dtype=bool)
+        result[indices] = True
+        return result
+
+    def to_formula(self):
+        ''' Get the AND as a TTreeFormula string
+
+        The terms are ordered by their measured rejection rate, so
+        TTreeFormula can short-circuit as early as possible.
+        '''
+        return "(%s)" % ' && '.join(
+            self.terms[i].to_formula() for i in self.term_order())
+
 class Or(Selection):
     def __init__(self, *selections):
+        self.selections = selections
         def functor(tree):
             for selection in selections:
                 if selection(tree):
@@ -254,6 +450,31 @@ class Or(Selection):
         super(Or, self).__init__(functor, "OR[%s]" % ' '.join(
             [str(x) for x in selections]))
 
+    def mask(self, columns):
+        ''' Evaluate the OR on a dictionary of branch arrays
+
+        Each selection is only evaluated on the entries which failed the
+        previous ones.
+        '''
+        nentries = _column_length(columns)
+        indices = numpy.arange(nentries)
+        subset = columns
+        for selection in self.selections:
+            if not len(indices):
+                break
+            failed = ~selection.mask(subset)
+            if numpy.count_nonzero(failed) < len(indices):
+                indices = indices[failed]
+                subset = _ColumnSubset(columns, indices)
+        result = numpy.ones(nentries, dtype=bool)
+        result[indices] = False
+        return result
+
+    def to_formula(self):
+        ''' Get the OR as a TTreeFormula string '''
+        return "(%s)" % ' || '.join(
+            selection.to_formula() for selection in self.selections)
+
 _operator_names = {
     operator.lt : '<',
     operator.gt : '>',
@@ -270,8 +491,13 @@ class TwoValueOp(Selection):
         self.op = op
         def functor(tree):
             return op(getter1(tree), getter2(tree))
+        def masker(columns):
+            return op(val1.array_getter(columns), val2.array_getter(columns))
+        if not _vectorizable(val1, val2):
+            masker = None
         repr = "%s %s %s" % (val1, _operator_names[op], val2)
-        super(TwoValueOp, self).__init__(functor, repr)
+        formula = _compose("(%%s %s %%s)" % _operator_names[op], val1, val2)
+        super(TwoValueOp, self).__init__(functor, repr, masker, formula)
 
     def explain(self, tree):
         ''' Explain the result of this cut '''
@@ -287,8 +513,14 @@ class OneValueOp(Selection):
         self.op = op
         def functor(tree):
             return op(getter(tree), val2)
+        def masker(columns):
+            return op(val1.array_getter(columns), val2)
+        if not _vectorizable(val1):
+            masker = None
         repr = "%s %s %s" % (val1, _operator_names[op], str(val2))
-        super(OneValueOp, self).__init__(functor, repr)
+        formula = _compose_constant(
+            "(%%s %s %%s)" % _operator_names[op], val1, val2)
+        super(OneValueOp, self).__init__(functor, repr, masker, formula)
 
     def explain(self, tree):
         ''' Explain the result of this cut '''
@@ -296,11 +528,17 @@ class OneValueOp(Selection):
             self.getter(tree), _operator_names[self.op], self.val)
 
 class Value(object):
-    ''' An object which can get a real value from a tree '''
-    def __init__(self, getter, repr=""):
+    ''' An object which can get a real value from a tree
+
+    The array_getter gets the value from a dictionary of branch arrays
+    instead, and formula is the equivalent TTreeFormula expression.
+    '''
+    def __init__(self, getter, repr="", array_getter=None, formula=None):
         # Initialize w/ functor to get value
         self.getter = getter
         self.repr = repr
+        self.array_getter = array_getter
+        self.formula = formula
 
     def handle_op(self, other, the_op):
         if isinstance(other, Value):
@@ -325,39 +563,75 @@ class Value(object):
         def bit_getter(tree):
             value = int(self.getter(tree))
             return value & (1 << (n-1))
-        return Value(bit_getter, "%s.bit(%i)" % (repr(self), n))
+        def bit_array_getter(columns):
+            values = numpy.asarray(self.array_getter(columns))
+            return values.astype(numpy.int64) & (1 << (n-1))
+        if not _vectorizable(self):
+            bit_array_getter = None
+        return Value(bit_getter, "%s.bit(%i)" % (repr(self), n),
+                     bit_array_getter,
+                     _compose("(int(%%s) & %i)" % (1 << (n-1)), self))
 
     def __abs__(self):
         # Apply absolute value
         def abs_applyer(tree):
             return abs(self.getter(tree))
-        return Value(abs_applyer, "|%s|" % repr(self))
+        def abs_array_applyer(columns):
+            return numpy.abs(self.array_getter(columns))
+        if not _vectorizable(self):
+            abs_array_applyer = None
+        return Value(abs_applyer, "|%s|" % repr(self), abs_array_applyer,
+                     _compose("abs(%s)", self))
 
     def __sub__(self, other):
         # Subtract some other value
         def subtractor_value(tree):
             return self.getter(tree) - other.getter(tree)
+        def array_subtractor_value(columns):
+            return self.array_getter(columns) - other.array_getter(columns)
         # Used if the other value is just a plain type like a float
         def subtractor_plain(tree):
             return self.getter(tree) - other
+        def array_subtractor_plain(columns):
+            return self.array_getter(columns) - other
         if isinstance(other, Value):
+            if not _vectorizable(self, other):
+                array_subtractor_value = None
             return Value(subtractor_value,
-                         "%s - %s" % (repr(self), repr(other)))
+                         "%s - %s" % (repr(self), repr(other)),
+                         array_subtractor_value,
+                         _compose("(%s - %s)", self, other))
         else:
+            if not _vectorizable(self):
+                array_subtractor_plain = None
             return Value(subtractor_plain,
-                         "%s - %s" % (repr(self), repr(other)))
+                         "%s - %s" % (repr(self), repr(other)),
+                         array_subtractor_plain,
+                         _compose_constant("(%s - %s)", self, other))
 
     def __add__(self, other):
         # Subtract some other value
         def adder_value(tree):
             return self.getter(tree) + other.getter(tree)
+        def array_adder_value(columns):
+            return self.array_getter(columns) + other.array_getter(columns)
         # Used if the other value is just a plain type like a float
         def adder_plain(tree):
             return self.getter(tree) + other
+        def array_adder_plain(columns):
+            return self.array_getter(columns) + other
         if isinstance(other, Value):
-            return Value(adder_value, "%s + %s" % (repr(self), repr(other)))
+            if not _vectorizable(self, other):
+                array_adder_value = None
+            return Value(adder_value, "%s + %s" % (repr(self), repr(other)),
+                         array_adder_value,
+                         _compose("(%s + %s)", self, other))
         else:
-            return Value(adder_plain, "%s + %s" % (repr(self), repr(other)))
+            if not _vectorizable(self):
+                array_adder_plain = None
+            return Value(adder_plain, "%s + %s" % (repr(self), repr(other)),
+                         array_adder_plain,
+                         _compose_constant("(%s + %s)", self, other))
 
     def __call__(self, tree):
         return self.getter(tree)
@@ -374,7 +648,11 @@ class Branch(Value):
         self.branch = branch
         def getter(tree):
             return getattr(tree, branch)
-        super(Branch, self).__init__(getter, repr="Branch('%s')" % self.branch)
+        def array_getter(columns):
+            return columns[branch]
+        super(Branch, self).__init__(getter, repr="Branch('%s')" % self.branch,
+                                     array_getter=array_getter,
+                                     formula=branch)
 
 class MetaTree(object):
     def __init__(self):
@@ -4,11 +4,15 @@
 Combine multiple output megaevents output.  The combined list
 ist written to stdout.  The total nubmer of events is written to stderr
 
+The inputs and output are in JSON-lines format (one event per line).  Old
+style event lists (a single JSON list) are also accepted as input.
+
 Usage: combine_event_lists.py file [file [file] ]]
 
 '''
 
 from RecoLuminosity.LumiDB import argparse
+from FinalStateAnalysis.PlotTools.eventlists import read_events
 import json
 import sys
 
@@ -21,22 +25,22 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    full_event_list = []
+    nevents = 0
     unique_events = set([])
 
     for filename in args.files:
         with open(filename) as file:
-            event_list = json.load(file)
-            full_event_list.extend(event_list)
-            for event in event_list:
+            for event in read_events(file):
+                nevents += 1
                 unique_events.add(tuple(event['evt']))
+                if not args.count:
+                    sys.stdout.write(json.dumps(event, sort_keys=True) + '\n')
 
     if not args.count:
-        json.dump(full_event_list, sys.stdout, indent=2, sort_keys=True)
         sys.stderr.write(
             'Combined %i events [%i unique]\n'
-            % (len(full_event_list), len(unique_events))
+            % (nevents, len(unique_events))
         )
     else:
         sys.stderr.write(
-            '%i[%i unique]' % (len(full_event_list), len(unique_events)) )
+            '%i[%i unique]' % (nevents, len(unique_events)) )
@@ -5,6 +5,14 @@
 Given an input directory, find the input ntuple files and put them in one
 .txt filelist for each discovered sample.
 
+The files are checked for corruption (by opening them and getting the
+[--meta] tree) in parallel.  The results are stored in the MegaIndex, keyed
+by path, size and mtime, so files are only reopened if they have changed.
+
+With --summary, the number of entries, the sum of the "nevents" branch and
+the lumi mask of the [--meta] tree are harvested during the same check and
+written to [sample].summary.json.
+
 Author: Evan K. Friis, UW
 
 '''
@@ -13,6 +21,7 @@ from RecoLuminosity.LumiDB import argparse
 import contextlib
 import glob
 from hashlib import sha1
+import json
 import logging
 import os
 import tempfile
@@ -21,6 +30,9 @@ import sys
 
 from progressbar import ETA, ProgressBar, FormatLabel, Bar
 
+from FinalStateAnalysis.PlotTools.MegaIndex import MegaIndex
+from FinalStateAnalysis.Utilities.lumitools import LumiMask
+
 log = logging.getLogger("discover_ntuples")
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
@@ -97,6 +109,27 @@ def find_sample_dirs(search_dirs, jobid):
             yield (sample_name, search_dir, all_files)
 
 
+def sample_summary(infos):
+    """ Sum the entries, nevents and lumis of a list of FileInfos. """
+    output = {
+        'n_entries': 0,
+        'n_evts': 0,
+        'corrupt': [],
+    }
+    # run => intervals of all the files, merged at the end
+    intervals = {}
+    for info in infos:
+        if info.error is not None:
+            output['corrupt'].append(info.path)
+            continue
+        output['n_entries'] += info.entries
+        output['n_evts'] += info.nevents or 0
+        for run, run_intervals in (info.lumis or {}).iteritems():
+            intervals.setdefault(run, []).extend(run_intervals)
+    output['lumi_mask'] = LumiMask(intervals).to_json()
+    return output
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('jobid', help='Job ID')
@@ -111,7 +144,16 @@ if __name__ == "__main__":
                         help='Output paths relative to input directory(ies)')
     parser.add_argument('--force', default=False, action='store_true',
                         help='If specified, check files even if they '
-                        ' have an older timestamp than previously output')
+                        ' were OK in the previous output.  Only files which'
+                        ' have changed since they were indexed are reopened.')
+    parser.add_argument('--rescan', default=False, action='store_true',
+                        help='Ignore the index, and reopen all the files'
+                        ' which are checked.')
+    parser.add_argument('--summary', default=False, action='store_true',
+                        help='Write the number of entries, events and the'
+                        ' lumi mask of each sample to [sample].summary.json')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of parallel checks (def: 4)')
     parser.add_argument('--no-check', dest='nocheck', default=False,
                         action='store_true',
                         help='If specified, never check files for corruption.')
@@ -123,8 +165,7 @@ if __name__ == "__main__":
     if args.verbose:
         log.setLevel(logging.DEBUG)
 
-    # We do this here to prevent ROOT from messing with sys.argv
-    import ROOT
+    index = MegaIndex()
 
     if not os.path.exists(args.outputdir):
         os.makedirs(args.outputdir)
@@ -136,6 +177,25 @@ if __name__ == "__main__":
             args.directory.split(':'), args.jobid):
         output_txt = os.path.join(args.outputdir, sample_name + '.txt')
         previous_files = get_previous_files(output_txt)
+        # Always write if we have found + checked it OK before
+        to_check = []
+        if args.summary:
+            # We need the information for all the files
+            to_check = all_files
+        elif not args.nocheck:
+            to_check = [file for file in all_files
+                        if args.force or file not in previous_files]
+        # Check the files in parallel.  Files already in the index (and
+        # unchanged) have been checked before.
+        infos = index.get(to_check, args.meta, nprocesses=args.workers,
+                          lumis=args.summary, force=args.rescan)
+        checked = dict(zip(to_check, infos))
+        if args.summary:
+            summary_json = os.path.join(
+                args.outputdir, sample_name + '.summary.json')
+            with open_update_if_changed(summary_json, sample_name) as output:
+                output.write(json.dumps(
+                    sample_summary(infos), indent=2, sort_keys=True) + '\n')
         with open_update_if_changed(output_txt, sample_name) as flist:
             pbar = ProgressBar(widgets=[FormatLabel(
                 'Checked %(value)i/' + str(len(all_files)) + ' files. '),
@@ -146,21 +206,11 @@ if __name__ == "__main__":
                 filepath = file
                 if args.relative:
                     filepath = os.path.relpath(file, search_dir)
-                # Always write if we have found + checked it OK before
-                if not args.nocheck and (args.force
-                                         or file not in previous_files):
-                    tfile = ROOT.TFile.Open(file)
-                    if not tfile:
-                        log.warning("-- Can't open file: %s" % file)
-                        flist.write('# corrupt %s\n' % filepath)
-                        continue
-                    ntuple = tfile.Get(args.meta)
-                    if not ntuple:
-                        log.warning("-- Can't read ntuple in file: %s"
-                                    % file)
-                        flist.write('# corrupt %s\n' % filepath)
-                        continue
-                    tfile.Close()
+                info = checked.get(file)
+                if info is not None and info.error is not None:
+                    log.warning("-- Corrupt file %s: %s" % (file, info.error))
+                    flist.write('# corrupt %s\n' % filepath)
+                    continue
                 # Made it!
                 flist.write(filepath + '\n')
 
@@ -1,16 +1,48 @@
 #! /bin/env python
+'''
 
-import sys
+Combine and print the cProfile outputs of a mega job.
+
+Usage: dump_profile_stats.py [--sort cumulative] [--limit N] file.prf|dir ...
+
+Directories (i.e. the --profile DIR of mega) are searched for .prf files.
+The per-stage times and throughput of a job are in the mega --report JSON.
+
+'''
+
+from RecoLuminosity.LumiDB import argparse
+import os
 import pstats
 
-if len(sys.argv) < 2 or '-h' in sys.argv or '--help' in sys.argv:
-        print 'Usage dump_profile_stats.py profile_stat_files.prf'
-        sys.exit(1)
-
-            
-files = filter(lambda x: '.prf' in x, sys.argv)
-stats = pstats.Stats(files[0])
-for f in files[1:]:
-    stats.add(f)
-stats.sort_stats('cumulative')
-stats.print_stats()
+def find_profiles(paths):
+    ''' Generate the .prf files in a list of files and directories '''
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if filename.endswith('.prf'):
+                        yield os.path.join(dirpath, filename)
+        elif '.prf' in path:
+            yield path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+', metavar='file.prf|dir',
+                        help='Profile outputs, or directories with them')
+    parser.add_argument('--sort', default='cumulative',
+                        help='Sort key (see pstats), default: cumulative')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Only print the top N functions')
+    args = parser.parse_args()
+
+    files = list(find_profiles(args.inputs))
+    if not files:
+        parser.error("No .prf files found")
+    stats = pstats.Stats(files[0])
+    for f in files[1:]:
+        stats.add(f)
+    stats.sort_stats(args.sort)
+    if args.limit is not None:
+        stats.print_stats(args.limit)
+    else:
+        stats.print_stats()
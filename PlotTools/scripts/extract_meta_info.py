@@ -9,6 +9,10 @@ You can use this to normalize an MC sample to a given int. lumi.
 
 This script extract that info and puts in it a json file.
 
+The nevents, run and lumi branches of each file are read as arrays, and the
+files are processed in parallel.  Duplicate run-lumis (i.e. the same lumi
+processed twice) are found by sorting.
+
 Author: Evan K. Friis, UW
 
 '''
@@ -16,6 +20,8 @@ Author: Evan K. Friis, UW
 from RecoLuminosity.LumiDB import argparse
 import json
 import logging
+import multiprocessing
+import numpy
 import sys
 
 from FinalStateAnalysis.PlotTools.MegaPath import resolve_file
@@ -23,6 +29,56 @@ from FinalStateAnalysis.Utilities.lumitools import json_summary
 
 log = logging.getLogger(__name__)
 
+def read_meta(file, treename, lumimask):
+    ''' Read the meta tree of a file
+
+    Returns the total number of events and an array of (run, lumi) pairs
+    (empty unless lumimask is True).
+    '''
+    import ROOT
+    from FinalStateAnalysis.PlotTools.MegaColumns import read_columns
+    log.debug("OPEN file %s", file)
+    tfile = ROOT.TFile.Open(file, "READ")
+    tree = tfile.Get(treename) if tfile else None
+    if not tree:
+        raise IOError("Cannot get tree %s from file %s" % (treename, file))
+    branches = ['nevents']
+    if lumimask:
+        branches.extend(['run', 'lumi'])
+    columns = read_columns(tree, branches, 0, tree.GetEntries())
+    total_events = int(columns['nevents'].sum())
+    run_lumis = numpy.zeros((0, 2), dtype=numpy.int64)
+    if lumimask:
+        run_lumis = numpy.column_stack(
+            (columns['run'], columns['lumi'])).astype(numpy.int64)
+    tfile.Close()
+    return total_events, run_lumis
+
+def _read_meta(args):
+    ''' Pool.map helper '''
+    return read_meta(*args)
+
+def sort_run_lumis(run_lumis, file_indices):
+    ''' Sort run-lumis and find those which appear more than once
+
+    Returns the list of unique (run, lumi) and a list of duplicates
+    (run, lumi, first file index, other file index).
+
+    >>> run_lumis = numpy.array([[2, 1], [1, 5], [1, 4], [2, 1]])
+    >>> sort_run_lumis(run_lumis, numpy.array([0, 0, 1, 1]))
+    ([(1, 4), (1, 5), (2, 1)], [(2, 1, 0, 1)])
+    '''
+    order = numpy.lexsort((file_indices, run_lumis[:, 1], run_lumis[:, 0]))
+    run_lumis = run_lumis[order]
+    file_indices = file_indices[order]
+    same = numpy.all(run_lumis[1:] == run_lumis[:-1], axis=1)
+    duplicates = []
+    for i in numpy.nonzero(same)[0]:
+        duplicates.append((int(run_lumis[i, 0]), int(run_lumis[i, 1]),
+                           int(file_indices[i]), int(file_indices[i + 1])))
+    unique = run_lumis[numpy.concatenate(([True], ~same))]
+    return [tuple(x) for x in unique.tolist()], duplicates
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('input', type=str, metavar='input(.txt|.root)',
@@ -37,6 +93,8 @@ if __name__ == "__main__":
     parser.add_argument('--lumimask', action='store_const',
                         const=True, default=False,
                         help='If true, include the run-lumi mask result')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of parallel processes (def: 4)')
     parser.add_argument('--debug', action='store_const',
                         const=True, default=False,
                         help='Print debug output')
@@ -61,28 +119,32 @@ if __name__ == "__main__":
 
     log.info("Extracting meta info from %i files", len(files))
 
-    total_events = 0
-    run_lumis = {}
-
-    for file in files:
-        log.debug("OPEN file %s", file)
-        tfile = ROOT.TFile.Open(file, "READ")
-        tree = tfile.Get(args.tree)
-        if not tree:
-            log.error("Cannot get tree %s from file %s", args.tree, file)
-            raise SystemExit(1)
-        for entry in xrange(tree.GetEntries()):
-            tree.GetEntry(entry)
-            total_events += tree.nevents
-            # We only care about this if we are building the lumimask
-            if args.lumimask:
-                run_lumi = (tree.run, tree.lumi)
-                log.debug("R-L %s %s", repr(run_lumi), file)
-                if run_lumi in run_lumis:
-                    log.error("Run-lumi %s found in file \n%s \nand %s!",
-                              run_lumi, file, run_lumis[run_lumi])
-                run_lumis[run_lumi] = file
-        tfile.Close()
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        results = pool.map(
+            _read_meta, [(file, args.tree, args.lumimask) for file in files])
+        pool.close()
+    except IOError as error:
+        pool.terminate()
+        log.error(str(error))
+        raise SystemExit(1)
+    finally:
+        pool.join()
+
+    total_events = sum(events for events, run_lumis in results)
+
+    run_lumis = []
+    # We only care about this if we are building the lumimask
+    if args.lumimask and results:
+        all_run_lumis = numpy.concatenate(
+            [file_run_lumis for events, file_run_lumis in results])
+        file_indices = numpy.concatenate(
+            [numpy.repeat(i, len(file_run_lumis))
+             for i, (events, file_run_lumis) in enumerate(results)])
+        run_lumis, duplicates = sort_run_lumis(all_run_lumis, file_indices)
+        for run, lumi, first, other in duplicates:
+            log.error("Run-lumi %s found in file \n%s \nand %s!",
+                      (run, lumi), files[first], files[other])
 
     output = {
         'n_evts': total_events,
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+'''
+
+Find the file and entry of events in a set of ntuples.
+
+The event list is read from stdin, with one run:lumi:event per line.  The
+indices of the ntuples are built (in parallel) the first time they are
+needed, and reused afterwards.  See PlotTools/python/EventIndex.py
+
+Example:
+
+    cat events.txt | find_ntuple_events.py path/to/tree inputs/*.root
+
+The output has one line per (event, file, entry).  Events which are not
+found are written to stderr.
+
+'''
+
+from RecoLuminosity.LumiDB import argparse
+import logging
+import sys
+
+log = logging.getLogger("find_ntuple_events")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tree", metavar="path/to/TTree",
+                        help="Path in root file to TTree")
+    parser.add_argument("inputs", metavar="in.root", nargs='+',
+                        help="Input ROOT files")
+    parser.add_argument("--event-list", default="/dev/stdin",
+                        metavar='/dev/stdin', dest='evts',
+                        help="Event list .txt file. Default: /dev/stdin")
+    parser.add_argument('--workers', type=int, required=False, default=4,
+                        help='Number of processes used to build the indices'
+                        ' (def: 4)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    from FinalStateAnalysis.PlotTools.EventIndex import EventIndex
+
+    index = EventIndex.for_files(args.inputs, args.tree, args.workers)
+    log.info("Indexed %i entries in %i files", len(index), len(index.files))
+
+    nmissing = 0
+    with open(args.evts, 'r') as evts:
+        for evt in evts:
+            if not evt.strip():
+                continue
+            run, lumi, evt = (int(x) for x in evt.strip().split(':'))
+            found = index.find(run, lumi, evt)
+            if not found:
+                sys.stderr.write("%i:%i:%i not found\n" % (run, lumi, evt))
+                nmissing += 1
+            for file, entry in found:
+                print "%i:%i:%i %s %i" % (run, lumi, evt, file, entry)
+    if nmissing:
+        log.warning("I couldn't find %i events!", nmissing)
@@ -17,6 +17,7 @@ import sys
 from FinalStateAnalysis.PlotTools.ChainProcessor import ChainProcessor
 from FinalStateAnalysis.PlotTools.Dispatcher import MegaDispatcher
 from FinalStateAnalysis.PlotTools.MegaPath import find_input_files
+from FinalStateAnalysis.PlotTools.MegaTelemetry import TelemetryCollector
 
 log = multiprocessing.log_to_stderr()
 log.setLevel(logging.WARNING)
@@ -56,9 +57,83 @@ if __name__ == "__main__":
     parser.add_argument('--workers', type=int, required=False, default=4,
                         help='Number of worker processes (def: 4)')
 
+    parser.add_argument('--max-workers', type=int, required=False,
+                        default=None, dest='max_workers',
+                        help='Start more workers, up to this number, while'
+                        ' the workers are waiting on I/O (def: --workers)')
+
+    parser.add_argument('--memory-budget', type=float, required=False,
+                        default=None, dest='memory_budget', metavar='MB',
+                        help='Stop workers when the job gets close to using'
+                        ' this much memory, in MB')
+
+    parser.add_argument('--max-tasks', type=int, required=False,
+                        default=None, dest='max_tasks', metavar='N',
+                        help='Replace each worker by a fresh one after N'
+                        ' jobs, to bound the growth of memory leaks')
+
+    parser.add_argument('--merge-workers', type=int, required=False,
+                        default=2, dest='merge_workers',
+                        help='Number of parallel merge processes (def: 2)')
+
+    parser.add_argument('--in-memory', action='store_true', dest='in_memory',
+                        help="Send the histograms of each job back as arrays"
+                        " and sum them in memory, instead of merging "
+                        "temporary files.  Ignored with --single-mode, which"
+                        " writes the output file directly.")
+
     parser.add_argument('--chain', type=int, required=False,
                         default=1, help='Number of files to chain together')
 
+    parser.add_argument('--columnar', action='store_true',
+                        help="Run the selector in columnar mode: "
+                        "the selector process_chunk(...) method is called "
+                        "with NumPy arrays of its declared columns.")
+
+    parser.add_argument('--chunk-size', type=int, required=False,
+                        default=100000, dest='chunk_size',
+                        help='Number of entries per chunk in columnar mode'
+                        ' (def: 100000)')
+
+    parser.add_argument('--prune-branches', action='store_true',
+                        dest='prune',
+                        help="Disable the branches the selector doesn't use."
+                        " The used branches are learned on the first entries"
+                        " of each job, plus any in the selector 'branches'"
+                        " and MetaTree.")
+
+    parser.add_argument('--learn-entries', type=int, required=False,
+                        default=1000, dest='learn_entries',
+                        help='Number of entries used to learn which branches'
+                        ' are used with --prune-branches (def: 1000)')
+
+    parser.add_argument('--split-entries', type=int, required=False,
+                        default=None, dest='min_entries', metavar='N',
+                        help='Split the input files into entry ranges of at'
+                        ' least N entries, to balance the load between the'
+                        ' workers.  Overrides --chain.')
+
+    parser.add_argument('--report', metavar='report.json', default=None,
+                        help='Write a JSON report of the time spent in each'
+                        ' stage (reading, selector, fills, merging) and of'
+                        ' the throughput, and show the live throughput in'
+                        ' the progress bar')
+
+    parser.add_argument('--profile', metavar='DIR', default=None,
+                        dest='profile_dir',
+                        help='Write a cProfile output for each job in DIR.'
+                        ' (see dump_profile_stats.py)')
+
+    parser.add_argument('--sample', metavar='stacks.txt', default=None,
+                        dest='samples',
+                        help='Run a sampling profiler in the workers, and'
+                        ' write the collapsed stacks (for flamegraph.pl) to'
+                        ' this file')
+
+    parser.add_argument('--sample-interval', type=float, default=5.,
+                        dest='sample_interval', metavar='ms',
+                        help='Sampling interval, in ms of CPU time (def: 5)')
+
     parser.add_argument('--single-mode', action='store_true', dest='single',
                         help="Run as a single job.")
 
@@ -102,15 +177,57 @@ if __name__ == "__main__":
         log.info("Getting tree name from selector module")
         tree_name = selector.tree
 
+    chunk_size = None
+    if args.columnar:
+        log.info("Running in columnar mode with %i entry chunks",
+                 args.chunk_size)
+        chunk_size = args.chunk_size
+
+    learn_entries = None
+    if args.prune:
+        log.info("Pruning unused branches after %i entries",
+                 args.learn_entries)
+        learn_entries = args.learn_entries
+
+    sample_interval = None
+    if args.samples:
+        log.info("Sampling the workers every %0.1f ms", args.sample_interval)
+        sample_interval = args.sample_interval / 1e3
+
+    memory_budget = None
+    if args.memory_budget:
+        memory_budget = args.memory_budget * 1e6
+
     if not args.single:
         log.info("Dispatching jobs")
         dispatch = MegaDispatcher(file_list, tree_name, args.output, selector,
-                                  args.workers, nchain=args.chain)
+                                  args.workers, nchain=args.chain,
+                                  chunk_size=chunk_size,
+                                  learn_entries=learn_entries,
+                                  nmergers=args.merge_workers,
+                                  in_memory=args.in_memory,
+                                  min_entries=args.min_entries,
+                                  report=args.report,
+                                  profile_dir=args.profile_dir,
+                                  samples=args.samples,
+                                  sample_interval=sample_interval,
+                                  max_workers=args.max_workers,
+                                  memory_budget=memory_budget,
+                                  max_tasks=args.max_tasks)
         dispatch.run()
     else:
         log.info("Running job as single process")
         print args.output
         processor = ChainProcessor(file_list, tree_name, selector,
-                                   args.output, log)
+                                   args.output, log, chunk_size=chunk_size,
+                                   learn_entries=learn_entries,
+                                   sample_interval=sample_interval,
+                                   time_entries=bool(args.report or
+                                                     args.samples))
         result = processor.process()
+        if args.report or args.samples:
+            collector = TelemetryCollector(args.report, args.samples)
+            collector.add(result[2])
+            collector.finished_jobs()
+            collector.write({})
     log.info("Mega2 job is complete")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''
+
+Benchmark the mega pipeline on synthetic ntuples.
+
+Runs the cut heavy, fill heavy and wide read selectors of MegaBenchmark in
+single mode and with N workers, and appends the entries/s, peak memory and
+merge time of each case to a JSON-lines results file, tagged with the git
+version of the code.  Results of different commits can be compared with
+--compare, which exits with status 1 if any case got slower than the
+tolerance, so it can be used as a regression gate.
+
+Usage:
+
+    mega_benchmark.py --workers 0 4 --output results.jsonl
+    mega_benchmark.py --output new.jsonl --compare results.jsonl
+
+'''
+
+from RecoLuminosity.LumiDB import argparse
+import json
+import logging
+import sys
+import time
+
+from FinalStateAnalysis.PlotTools.MegaBenchmark import SELECTORS, \
+    compare, describe_host, git_version, make_ntuples, read_results, run_case
+
+log = logging.getLogger("mega_benchmark")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workdir', default='mega_benchmark',
+                        help='Directory for the synthetic ntuples and'
+                        ' outputs (def: mega_benchmark)')
+    parser.add_argument('--files', type=int, default=4, dest='nfiles',
+                        help='Number of ntuples (def: 4)')
+    parser.add_argument('--entries', type=int, default=100000,
+                        dest='nentries',
+                        help='Entries per ntuple (def: 100000)')
+    parser.add_argument('--branches', type=int, default=50,
+                        dest='nbranches',
+                        help='Float branches per ntuple (def: 50)')
+    parser.add_argument('--selectors', nargs='+', default=sorted(SELECTORS),
+                        choices=sorted(SELECTORS),
+                        help='Selectors to run (def: all)')
+    parser.add_argument('--workers', nargs='+', type=int, default=[0, 4],
+                        help='Worker counts to run, 0 means single mode'
+                        ' (def: 0 4)')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Run the selectors in columnar mode')
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        dest='chunk_size',
+                        help='Chunk size in columnar mode (def: 100000)')
+    parser.add_argument('--in-memory', action='store_true', dest='in_memory',
+                        help='Sum the histograms in memory')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Run each case N times, and keep the fastest')
+    parser.add_argument('--output', default='mega_benchmark.jsonl',
+                        help='Results file, appended to'
+                        ' (def: mega_benchmark.jsonl)')
+    parser.add_argument('--compare', metavar='baseline.jsonl', default=None,
+                        help='Compare the throughput with a previous'
+                        ' results file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed relative slowdown with --compare'
+                        ' (def: 0.1)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print debug output')
+
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    files = make_ntuples(args.workdir, args.nfiles, args.nentries,
+                         args.nbranches)
+    chunk_size = args.chunk_size if args.columnar else None
+
+    version = git_version()
+    host = describe_host()
+    results = []
+    for selector in args.selectors:
+        for nworkers in args.workers:
+            mode = 'single' if not nworkers else '%iw' % nworkers
+            log.info("Running %s selector in %s mode", selector, mode)
+            runs = [run_case(files, args.workdir, selector, nworkers,
+                             chunk_size, args.in_memory)
+                    for i in range(args.repeat)]
+            best = max(runs, key=lambda x: x['entries_per_second'])
+            record = dict(best, selector=selector, mode=mode,
+                          columnar=args.columnar, in_memory=args.in_memory,
+                          nfiles=args.nfiles, nentries=args.nentries,
+                          nbranches=args.nbranches, version=version,
+                          time=time.strftime('%Y-%m-%d %H:%M:%S'), **host)
+            log.info("%s %s: %0.0f entries/s, %0.0f MB peak memory (PSS), "
+                     "%0.1f s merging", selector, mode,
+                     record['entries_per_second'], record['peak_memory_mb'],
+                     record['merge_time'])
+            results.append(record)
+
+    with open(args.output, 'a') as output:
+        for record in results:
+            output.write(json.dumps(record, sort_keys=True) + '\n')
+
+    if args.compare:
+        regressions = 0
+        for key, ratio, is_regression in compare(
+                results, read_results(args.compare), args.tolerance):
+            print '%-6s %-7s %0.2fx%s' % (
+                key[0], key[1], ratio, '  REGRESSION' if is_regression else '')
+            regressions += is_regression
+        if regressions:
+            sys.exit(1)
@@ -4,16 +4,28 @@
 
 Command Line tool to get the events which pass a set of cuts.
 
-Maybe should be parallelized in the future?
+The input files are scanned in parallel by a pool of worker processes.  The
+events passing the selections in each file are written to a partial output
+in [output].parts/, which is moved into place only when the file is
+complete.  If the job is interrupted, rerunning the same command skips the
+files which are already done.
+
+The output is in JSON-lines format: one event per line, like:
+
+    {"evt": [run, lumi, evt], "branch": value, ...}
 
 Author: Evan K. Friis, UW Madison
 
 '''
 
 from RecoLuminosity.LumiDB import argparse
+import hashlib
+import inspect
 import logging
 import json
+import multiprocessing
 import os
+import shutil
 from progressbar import ETA, ProgressBar, FormatLabel, Bar
 import sys
 
@@ -27,6 +39,95 @@ sys.argv = []
 
 import ROOT
 
+# The selections and branches to store, set before the pool is forked
+_selections = []
+_branches = []
+_meta = None
+
+def selection_fingerprint(module, selections):
+    ''' Hash of the source code the selections depend on
+
+    This is the source of the selector module and of the modules where each
+    of the selections is defined, so editing a selection invalidates the
+    previous results.
+    '''
+    sources = set([inspect.getsourcefile(module)])
+    for name, selection in selections:
+        # If it is not a function or a class, use the class of the object.
+        # Built-ins have no source, and don't change.
+        for obj in (selection, type(selection)):
+            try:
+                sources.add(inspect.getsourcefile(obj))
+                break
+            except TypeError:
+                continue
+    hash = hashlib.md5()
+    for source in sorted(x for x in sources if x is not None):
+        hash.update(source)
+        with open(source) as source_file:
+            hash.update(source_file.read())
+    return hash.hexdigest()
+
+def partial_output(parts_dir, file, selections, branches, fingerprint=''):
+    ''' Get the partial output file for an input file
+
+    The name depends on the selections, branches and on the [fingerprint] of
+    the selection code, so changing them invalidates the previous results.
+    '''
+    hash = hashlib.md5(file)
+    hash.update(repr((selections, branches, fingerprint)))
+    return os.path.join(parts_dir, hash.hexdigest() + '.json')
+
+def scan_file(file, treename, output):
+    ''' Write the events in [file] which pass the selections to [output]
+
+    Returns the number of rows and selected events.
+    '''
+    tfile = ROOT.TFile.Open(file, 'READ')
+    if not tfile or tfile.IsZombie():
+        raise IOError("Can't open file %s" % file)
+    tree = tfile.Get(treename)
+    if not tree:
+        raise IOError("Can't get tree %s from %s" % (treename, file))
+
+    if _meta is not None:
+        # Disable unused branches
+        tree.SetBranchStatus('*', 0)
+        for b in _meta.active_branches():
+            tree.SetBranchStatus(b, 1)
+        for b in ['run', 'lumi', 'evt'] + _branches:
+            tree.SetBranchStatus(b, 1)
+
+    nrows = tree.GetEntries()
+    npassed = 0
+    temp_output = output + '.tmp'
+    with open(temp_output, 'w') as json_file:
+        for row in xrange(nrows):
+            tree.GetEntry(row)
+            all_passed = True
+            for name, selection in _selections:
+                passed = selection(tree)
+                if not passed:
+                    all_passed = False
+                    break
+            if all_passed:
+                this_event = {
+                    'evt': (tree.run, tree.lumi, tree.evt),
+                }
+                for branch in _branches:
+                    this_event[branch] = getattr(tree, branch)
+                json_file.write(json.dumps(this_event) + '\n')
+                npassed += 1
+    tfile.Close()
+    # Only mark the file as done once everything is written
+    os.rename(temp_output, output)
+    return nrows, npassed
+
+def _scan_file(args):
+    ''' Pool.imap helper '''
+    file, treename, output = args
+    return (file,) + scan_file(file, treename, output)
+
 if __name__ == "__main__":
 
     parser.add_argument('selector', metavar='selector', type=str,
@@ -41,7 +142,7 @@ if __name__ == "__main__":
                         help='Path to TTree in data files (Ex: /my/dir/myTree)')
 
     parser.add_argument('output', type=str,
-                        help='Output JSON file')
+                        help='Output JSON-lines file')
 
     parser.add_argument('selections', metavar="selection", nargs="+",
                         help="Which selections to apply in the cut flow."
@@ -50,6 +151,16 @@ if __name__ == "__main__":
     parser.add_argument('--branches', default=[], metavar="branch", nargs='*',
                         help="Store the values of the branches in the output")
 
+    parser.add_argument('--workers', type=int, required=False, default=4,
+                        help='Number of worker processes (def: 4)')
+
+    parser.add_argument('--restart', action='store_true',
+                        help="Don't reuse the partial outputs of a previous"
+                        " run")
+
+    parser.add_argument('--keep-parts', action='store_true', dest='keep_parts',
+                        help="Keep the partial outputs after merging them")
+
     args = parser.parse_args(args[1:])
 
     log.info("Checking inputs file %s exists..." % args.inputs)
@@ -73,11 +184,6 @@ if __name__ == "__main__":
         log.error("Dataset %s has no files!  Skipping..." % args.inputs)
         sys.exit(1)
 
-    log.info("Building TChain")
-    chain = ROOT.TChain(args.tree)
-    for file in file_list:
-        chain.AddFile(file)
-
     log.info("Building selectors")
     path_to_selector = os.path.dirname(os.path.abspath(args.selector))
     module_name = os.path.basename(args.selector)
@@ -86,60 +192,57 @@ if __name__ == "__main__":
 
     module = __import__(class_name, fromlist=[args.selections])
     log.info("Loading %i selections", len(args.selections))
-    selections = []
+    selection_names = []
     for selection in args.selections:
         selection = selection.replace('+', '')
         selection = selection.replace('-', '')
-        selections.append( (selection, getattr(module, selection)) )
-
-    log.info("Beginning loop over %i TChain entries", chain.GetEntries())
-    current_event = (None, None, None)
+        selection_names.append(selection)
+        _selections.append( (selection, getattr(module, selection)) )
+    _branches.extend(args.branches)
 
     log.info("Trying to import meta tree")
-    try:
-        #metamodule = __import__(class_name, fromlist=['meta'])
-        meta = getattr(module, 'meta')
-        log.info("Got meta tree! - Disabling unused branches")
-        chain.SetBranchStatus('*', 0)
-        for b in meta.active_branches():
-            chain.SetBranchStatus(b, 1)
-        chain.SetBranchStatus('run', 1)
-        chain.SetBranchStatus('lumi', 1)
-        chain.SetBranchStatus('evt', 1)
-        for b in args.branches:
-            chain.SetBranchStatus(b, 1)
-    except:
-        raise
+    _meta = getattr(module, 'meta', None)
+    if _meta is None:
         log.warning("Couldn't get meta tree - will not disable branches")
 
+    parts_dir = args.output + '.parts'
+    if args.restart and os.path.exists(parts_dir):
+        shutil.rmtree(parts_dir)
+    if not os.path.exists(parts_dir):
+        os.makedirs(parts_dir)
+
+    fingerprint = selection_fingerprint(module, _selections)
+    outputs = [partial_output(parts_dir, file, selection_names, args.branches,
+                              fingerprint)
+               for file in file_list]
+    to_scan = [(file, args.tree, output)
+               for file, output in zip(file_list, outputs)
+               if not os.path.exists(output)]
+    log.info("Scanning %i files (%i already done)",
+             len(to_scan), len(file_list) - len(to_scan))
 
-    passed_events = []
-
-    nrows = chain.GetEntries()
     pbar = ProgressBar(widgets=[
-        FormatLabel('Processed %(value)i/' + str(nrows) + ' rows. '),
-        ETA(), Bar('>')], maxval=nrows).start()
+        FormatLabel('Processed %(value)i/' + str(len(to_scan)) + ' files. '),
+        ETA(), Bar('>')], maxval=len(to_scan)).start()
     pbar.update(0)
 
-    for row in xrange(nrows):
-        pbar.update(row)
-        chain.GetEntry(row)
-        all_passed = True
-        for name, selection in selections:
-            passed = selection(chain)
-            if not passed:
-                all_passed = False
-                break
-        if all_passed:
-            this_event = {
-                'evt': (chain.run, chain.lumi, chain.evt),
-            }
-            for branch in args.branches:
-                this_event[branch] = getattr(chain, branch)
-            passed_events.append(this_event)
+    pool = multiprocessing.Pool(args.workers)
+    try:
+        for i, (file, nrows, npassed) in enumerate(
+                pool.imap_unordered(_scan_file, to_scan)):
+            log.info("%s: %i/%i rows passed", file, npassed, nrows)
+            pbar.update(i + 1)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
     log.info("Dumping output")
     with open(args.output, 'w') as json_file:
-        json.dump(passed_events, json_file, indent=2)
-
-
+        for output in outputs:
+            with open(output) as part:
+                shutil.copyfileobj(part, json_file)
+    if not args.keep_parts:
+        shutil.rmtree(parts_dir)
@@ -0,0 +1,67 @@
+'''
+
+Check that the columnar reader only sees the entries of an EntryRangeTree,
+for every unit made by split_entries.
+
+'''
+
+from FinalStateAnalysis.PlotTools.EntryRange import \
+    EntryRangeTree, split_entries
+from FinalStateAnalysis.PlotTools.MegaColumns import iter_chunks
+import array
+import numpy
+import unittest
+
+class DrawBuffer(array.array):
+    ''' Mimics the double* returned by TTree::GetV1 '''
+    def SetSize(self, size):
+        pass
+
+class FakeTree(object):
+    ''' A tree with a single branch "entry", equal to the entry number '''
+    def __init__(self, nentries):
+        self.nentries = nentries
+        self.draws = []
+        self.buffer = DrawBuffer('d')
+
+    def GetEntries(self):
+        return self.nentries
+
+    def GetName(self):
+        return 'fake'
+
+    def SetEstimate(self, estimate):
+        pass
+
+    def Draw(self, varexp, selection, option, nentries, firstentry):
+        self.draws.append((firstentry, nentries))
+        last = min(self.nentries, firstentry + nentries)
+        self.buffer = DrawBuffer('d', range(firstentry, max(last, firstentry)))
+        return len(self.buffer)
+
+    def GetV1(self):
+        return self.buffer
+
+class TestEntryRangeChunks(unittest.TestCase):
+    def read(self, tree, chunk_size):
+        return numpy.concatenate(
+            [chunk['entry'] for chunk in
+             iter_chunks(tree, ['entry'], chunk_size)]).tolist()
+
+    def test_non_zero_first_entry(self):
+        tree = FakeTree(40000)
+        ranged = EntryRangeTree(tree, 30000, 10000)
+        self.assertEqual(self.read(ranged, 3000), range(30000, 40000))
+        self.assertEqual(tree.draws, [(30000, 3000), (33000, 3000),
+                                      (36000, 3000), (39000, 1000)])
+
+    def test_units_cover_file(self):
+        tree = FakeTree(40000)
+        entries = []
+        for unit in split_entries([('a', 40000)], 2):
+            ranged = EntryRangeTree(tree, unit.first_entry, unit.nentries)
+            entries.extend(self.read(ranged, 5000))
+        self.assertEqual(entries, range(40000))
+
+if __name__ == "__main__":
+    unittest.main()
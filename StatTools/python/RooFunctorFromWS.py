@@ -6,6 +6,10 @@ Builds a functor from a function in a RooWorkspace.
 
 This could be improved with cython.
 
+Both the RooFit and the TMVA functors can evaluate whole arrays of inputs at
+once (evaluate_batch), and RooFunctorFromWS.tabulate builds a fast
+interpolated version of a 1D function.
+
 Author: Evan K. Friis, UW Madison
 
 >>> from FinalStateAnalysis.Utilities.rootbindings import ROOT
@@ -21,12 +25,16 @@ Author: Evan K. Friis, UW Madison
 
 from FinalStateAnalysis.Utilities.rootbindings import ROOT
 import array
-from FinalStateAnalysis.PlotTools.decorators import memo_last
+import bisect
+import numpy
+from FinalStateAnalysis.PlotTools.decorators import memo_lru
 
 #ROOT.gSystem.Load("libFinalStateAnalysisStatTools")
 
 TMVA_tools = ROOT.TMVA.Tools.Instance()
 
+_NUMBERS = (int, long, float, numpy.number)
+
 class RooFunctorFromWS(ROOT.RooFunctor):
     def __init__(self, workspace, functionname, var='x'):
         # Get the RooFormulaVar
@@ -37,11 +45,100 @@ class RooFunctorFromWS(ROOT.RooFunctor):
         self.x.setRange(0, 1e99)
 
     def __call__(self, x):
+        if not isinstance(x, _NUMBERS):
+            return self.evaluate_batch(x)
         self.x.setVal(x)
         return self.function.getVal()
 
+    def evaluate_batch(self, xs):
+        ''' Evaluate the function on an array of x
+
+        Each distinct value is only evaluated once.
+        '''
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        unique, inverse = numpy.unique(xs, return_inverse=True)
+        setval, getval = self.x.setVal, self.function.getVal
+        values = []
+        for x in unique.tolist():
+            setval(x)
+            values.append(getval())
+        return numpy.array(values)[inverse].reshape(xs.shape)
+
+    def tabulate(self, xmin, xmax, npoints=1001, tolerance=None):
+        ''' Tabulate the function on a grid of [npoints] in [xmin, xmax]
+
+        The returned TabulatedFunctor interpolates linearly between the
+        points, and falls back to this functor outside of the grid.  The
+        interpolation error is estimated at the midpoints of the grid, and
+        a ValueError is raised if it is larger than [tolerance].
+        '''
+        xs = numpy.linspace(xmin, xmax, npoints)
+        ys = self.evaluate_batch(xs)
+        midpoints = 0.5 * (xs[1:] + xs[:-1])
+        max_error = numpy.abs(
+            self.evaluate_batch(midpoints) - 0.5 * (ys[1:] + ys[:-1])).max()
+        if tolerance is not None and max_error > tolerance:
+            raise ValueError(
+                "Interpolation error %g is larger than %g, use more points"
+                % (max_error, tolerance))
+        return TabulatedFunctor(xs, ys, max_error, self)
+
+class TabulatedFunctor(object):
+    ''' Linear interpolation of a 1D function tabulated on a grid
+
+    Outside of the grid the exact [fallback] functor is used, if given,
+    otherwise the first or last value.  [max_error] is the estimated
+    interpolation error.
+
+    >>> functor = TabulatedFunctor([0., 1., 2.], [0., 1., 4.], 0.25)
+    >>> functor(0.5), functor(1.5), functor(3)
+    (0.5, 2.5, 4.0)
+    >>> functor(numpy.array([0.5, 1.5, -1])).tolist()
+    [0.5, 2.5, 0.0]
+    >>> functor = TabulatedFunctor([0., 1., 2.], [0., 1., 4.], 0.25,
+    ...                            lambda x: x * x)
+    >>> functor(3), functor(numpy.array([1.5, 3.])).tolist()
+    (9, [2.5, 9.0])
+
+    '''
+    def __init__(self, x, y, max_error, fallback=None):
+        self.x = numpy.asarray(x, dtype=numpy.float64)
+        self.y = numpy.asarray(y, dtype=numpy.float64)
+        self.max_error = max_error
+        self.fallback = fallback
+        # Plain lists are faster for single lookups
+        self.x_list = self.x.tolist()
+        self.y_list = self.y.tolist()
+        self.xmin, self.xmax = self.x_list[0], self.x_list[-1]
+
+    def __call__(self, x):
+        if isinstance(x, _NUMBERS):
+            if x < self.xmin or x > self.xmax:
+                if self.fallback is not None:
+                    return self.fallback(x)
+                return self.y_list[0] if x < self.xmin else self.y_list[-1]
+            xs, ys = self.x_list, self.y_list
+            i = min(bisect.bisect_right(xs, x), len(xs) - 1)
+            return ys[i - 1] + (x - xs[i - 1]) * (ys[i] - ys[i - 1]) / (
+                xs[i] - xs[i - 1])
+        x = numpy.asarray(x, dtype=numpy.float64)
+        output = numpy.interp(x, self.x, self.y)
+        if self.fallback is not None:
+            outside = (x < self.xmin) | (x > self.xmax)
+            if outside.any():
+                output[outside] = [self.fallback(value)
+                                   for value in x[outside].tolist()]
+        return output
+
 class FunctorFromMVA(object):
     def __init__(self, name, xml_filename, *variables, **kwargs):
+        '''
+        Book the MVA [name] from [xml_filename], with the input [variables].
+
+        The results of the last [cache_size] (default 10000) distinct inputs
+        are kept, as the same objects (i.e. jets) are often evaluated many
+        times in an event.
+        '''
         self.reader    = ROOT.TMVA.Reader( "!Color:Silent=%s:Verbose=%s" % (kwargs.get('silent','T'), kwargs.get('verbose','F')))
         self.var_map   = {}
         self.name      = name
@@ -51,18 +148,22 @@ class FunctorFromMVA(object):
             self.var_map[var] = array.array('f',[0]) 
             self.reader.AddVariable(var, self.var_map[var])
         self.reader.BookMVA(name, xml_filename)
+        self.evaluate_cached = memo_lru(kwargs.get('cache_size', 10000))(
+            self.evaluate_kvars)
 
     def evaluate_(self): #so I can profile the time needed
         return self.reader.EvaluateMVA(self.name)
 
-    @memo_last
-    def __call__(self, **kvars):
+    def check_names(self, kvars):
         #kvars enforces that we use the proper vars
         if not ( 
                  all(name in self.variables for name in kvars.keys()) and \
                  all(name in kvars.keys() for name in self.variables)
                 ):
             raise Exception("Wrong variable names. Available variables: %s" % self.variables.__repr__())
+
+    def evaluate_kvars(self, **kvars):
+        self.check_names(kvars)
         for name, val in kvars.iteritems():
             self.var_map[name][0] = val
         retval = self.evaluate_() #reader.EvaluateMVA(self.name)
@@ -70,6 +171,33 @@ class FunctorFromMVA(object):
             print "returning 1 in %s, kvars: %s" % (self.xml_filename, kvars.items()) 
         return retval
 
+    def __call__(self, **kvars):
+        return self.evaluate_cached(**kvars)
+
+    def evaluate_batch(self, **arrays):
+        '''
+        Evaluate the MVA on arrays of the input variables, returns an array.
+
+        The reader takes single precision inputs, so the rows are compared
+        in single precision, and each distinct row is only evaluated once.
+        '''
+        self.check_names(arrays)
+        columns = [numpy.asarray(arrays[var], dtype=numpy.float32).ravel()
+                   for var in self.variables]
+        shape = numpy.shape(arrays[self.variables[0]])
+        if not len(columns[0]):
+            return numpy.zeros(shape)
+        rows, inverse = numpy.unique(numpy.column_stack(columns), axis=0,
+                                     return_inverse=True)
+        buffers = [self.var_map[var] for var in self.variables]
+        evaluate, name = self.reader.EvaluateMVA, self.name
+        values = []
+        for row in rows.tolist():
+            for buffer, value in zip(buffers, row):
+                buffer[0] = value
+            values.append(evaluate(name))
+        return numpy.array(values)[inverse].reshape(shape)
+
 def build_roofunctor(filename, wsname, functionname, var='x'):
     ''' Build a functor from a filename '''
     file = ROOT.TFile.Open(filename)
@@ -78,27 +206,78 @@ def build_roofunctor(filename, wsname, functionname, var='x'):
     ws = file.Get(wsname)
     return RooFunctorFromWS(ws, functionname, var)
 
+class TH2Corrector(object):
+    ''' Lookup of the bin contents of a TH2, as NumPy arrays
+
+    The underflow and overflow are mapped to the first and last bins, and
+    empty bins return [floor] (so the result can be divided by).  Can be
+    called with numbers or arrays of x and y, and pickled, since it holds no
+    ROOT objects.
+
+    >>> corrector = TH2Corrector([0, 10, 20], [0, 1], [[0.5], [0.]])
+    >>> corrector(5, 0.5), corrector(-1, 3), corrector(15, 0.5)
+    (0.5, 0.5, 1e-08)
+    >>> corrector(numpy.array([5, 25]), numpy.array([0.5, 0.5])).tolist()
+    [0.5, 1e-08]
+
+    '''
+    def __init__(self, x_edges, y_edges, contents, floor=1e-8):
+        self.x_edges = numpy.asarray(x_edges, dtype=numpy.float64)
+        self.y_edges = numpy.asarray(y_edges, dtype=numpy.float64)
+        # contents[i, j] is the content of the bin (i + 1, j + 1)
+        self.contents = numpy.array(contents, dtype=numpy.float64)
+        if self.contents.shape != (len(x_edges) - 1, len(y_edges) - 1):
+            raise ValueError("Expected %i x %i bin contents, got %s" % (
+                len(x_edges) - 1, len(y_edges) - 1,
+                str(self.contents.shape)))
+        self.contents[self.contents == 0] = floor
+        # Plain lists are faster for single lookups
+        self.x_list = self.x_edges.tolist()
+        self.y_list = self.y_edges.tolist()
+        self.content_list = self.contents.tolist()
+        self.nx = len(self.x_list) - 1
+        self.ny = len(self.y_list) - 1
+
+    @classmethod
+    def from_hist(cls, hist, floor=1e-8):
+        ''' Extract the edges and contents of a TH2 '''
+        binsx = hist.GetNbinsX()
+        binsy = hist.GetNbinsY()
+        xaxis, yaxis = hist.GetXaxis(), hist.GetYaxis()
+        x_edges = [xaxis.GetBinLowEdge(i) for i in range(1, binsx + 2)]
+        y_edges = [yaxis.GetBinLowEdge(i) for i in range(1, binsy + 2)]
+        contents = [[hist.GetBinContent(i, j) for j in range(1, binsy + 1)]
+                    for i in range(1, binsx + 1)]
+        return cls(x_edges, y_edges, contents, floor)
+
+    def __call__(self, xval, yval):
+        if isinstance(xval, _NUMBERS) and isinstance(yval, _NUMBERS):
+            xbin = bisect.bisect_right(self.x_list, xval) - 1
+            xbin = (xbin if xbin < self.nx else self.nx - 1) \
+                if xbin >= 0 else 0
+            ybin = bisect.bisect_right(self.y_list, yval) - 1
+            ybin = (ybin if ybin < self.ny else self.ny - 1) \
+                if ybin >= 0 else 0
+            return self.content_list[xbin][ybin]
+        xbin = numpy.clip(
+            numpy.searchsorted(self.x_edges, xval, side='right') - 1,
+            0, self.nx - 1)
+        ybin = numpy.clip(
+            numpy.searchsorted(self.y_edges, yval, side='right') - 1,
+            0, self.ny - 1)
+        return self.contents[xbin, ybin]
+
 def make_corrector_from_th2(filename, path):
+    ''' Build a TH2Corrector from the histogram [path] in [filename] '''
     tfile = ROOT.TFile.Open(filename)
     if not tfile:
         raise IOError("Can't open file: %s" % filename)
-    hist  = tfile.Get(path).Clone()
-    #print hist
-    binsx = hist.GetNbinsX()
-    binsy = hist.GetNbinsY()
-    def refFun(xval,yval):
-        #print hist
-        xbin = hist.GetXaxis().FindFixBin(xval) #Faster than FindBin
-        xbin = (xbin if xbin <= binsx else binsx ) if xbin >= 1 else 1 #Compute underflow and overflow as first and last bin
-        ybin = hist.GetYaxis().FindFixBin(yval)
-        ybin = (ybin if ybin <= binsy else binsy ) if ybin >= 1 else 1 #Compute underflow and overflow as first and last bin
-        prob = hist.GetBinContent(xbin,ybin)
-        if prob:
-            return prob
-        else:
-            return 10**-8
-           # raise ZeroDivisionError(" catched trying to return weight for (%.3f,%.3f) ==> (%i,%i) bin out of (%i,%i). Prob: %.3f. Hist: %s : %s. " % (xval, yval, xbin, ybin, binsx, binsy , prob, filename, path))
-    return refFun
+    hist = tfile.Get(path)
+    if not hist:
+        raise IOError("Can't get %s from file: %s" % (path, filename))
+    corrector = TH2Corrector.from_hist(hist)
+    tfile.Close()
+    return corrector
 
 def build_uncorr_2Droofunctor(functor_x, functor_y, filename, num='numerator', den='denominator'):
     ''' Build a functor from a filename '''
@@ -106,8 +285,8 @@ def build_uncorr_2Droofunctor(functor_x, functor_y, filename, num='numerator', d
     num_int = file.Get(num).Integral()
     den_int = file.Get(den).Integral()
     scale   = num_int/den_int
+    file.Close()
     def _f(x, y):
-        print scale
         return functor_x(x)*functor_y(y)/scale
     return _f
 
@@ -7,7 +7,11 @@ import sys
 import os
 from FinalStateAnalysis.MetaData.data_views import extract_sample, read_lumi
 from FinalStateAnalysis.StatTools.RooFunctorFromWS import FunctorFromMVA
+from FinalStateAnalysis.PlotTools.MegaColumns import iter_chunks, fill_histogram
+import itertools
 import logging
+import multiprocessing
+import numpy
 from array import array
 from rootpy.utils import asrootpy
 logging.basicConfig(stream=sys.stderr, level=logging.INFO)
@@ -20,6 +24,8 @@ parser.add_argument('--tree', required=True, help='Path to tree')
 parser.add_argument('--cut', required=True, help='branch name of id/iso WP')
 parser.add_argument('--neighbors', type=int, help='numer of heighbors to use', default=100)
 parser.add_argument('--makePlots', type=int, help='skip the plotting step to be faster', default=1)
+parser.add_argument('--jobs', type=int, help='number of processes reading the input files', default=multiprocessing.cpu_count())
+parser.add_argument('--chunk-size', type=int, help='number of entries read at once', default=100000)
 
 
 args = parser.parse_args()
@@ -46,10 +52,26 @@ def round_to_ints(histo):
         nentries = ROOT.TMath.Nint(histo.GetBinContent(bin)) \
                    if histo.GetBinContent(bin) >= 0 else 0
         centerx  = histo.GetXaxis().GetBinCenter(bin)
-        for _ in range(nentries):
-            new.Fill(centerx)
+        fill_histogram(new, numpy.repeat(centerx, nentries))
     return new
 
+def read_training_rows(job):
+    ''' Read the [branches] of a file into a float32 array of rows, with the
+    last (weight) column scaled by [factor] '''
+    filename, tree_path, branches, factor, chunk_size = job
+    tfile = ROOT.TFile.Open(filename)
+    if not tfile:
+        raise IOError("Can't open file: %s" % filename)
+    tree = tfile.Get(tree_path)
+    chunks = [numpy.zeros((0, len(branches)), dtype=numpy.float32)]
+    for chunk in iter_chunks(tree, branches, chunk_size):
+        rows = numpy.column_stack([chunk[branch] for branch in branches])
+        #scale by lumi factor
+        rows[:, -1] *= factor
+        chunks.append(rows.astype(numpy.float32))
+    tfile.Close()
+    return numpy.concatenate(chunks)
+
 
 
 data_files  = filter(lambda x: 'data_' in x, args.files)
@@ -59,77 +81,56 @@ wz_file     = filter(lambda x: 'WZ'    in x, args.files)[0]
 output_file = args.outputfile
 input_tree  = args.tree #'wjets/pt10/muonInfo'
 selection   = args.cut #'h2taucuts'
-out_tfile   = ROOT.TFile.Open(output_file, 'recreate')
 cut_pass    = ROOT.TCut('%s==1' % selection)
 cut_fail    = ROOT.TCut('%s==0' % selection)
 
-log.info('Getting data Tree')
-data_tree   = ROOT.TChain(input_tree)
+training_vars = args.variables+[args.cut,'weight']
+cut_column    = len(args.variables)
+
+def count_pass_fail(rows):
+    cut = rows[:, cut_column]
+    return (cut == 1).sum(), (cut == 0).sum()
+
 data_lumi   = 0.
 for i in data_files:
     data_lumi += get_lumi(i)
-    data_tree.Add(i)
-num_pass    = data_tree.GetEntries(cut_pass.GetTitle())
-num_fail    = data_tree.GetEntries(cut_fail.GetTitle())
-log.info("found %i input files for a total lumi: %f total passing events: %i. total failing events: %i" % (len(data_files), data_lumi, num_pass, num_fail) )
 
-
-log.info('getting ZZ dataset...')
-zz_tree    = ROOT.TFile.Open(zz_file).Get(input_tree)
 zz_lumi    = get_lumi(zz_file)
 zz_factor  = -(data_lumi / zz_lumi)
-log.info('   Events are going to be scaled by %f' % zz_factor)
+log.info('ZZ events are going to be scaled by %f' % zz_factor)
 
-log.info('getting WZ dataset...')
-wz_tree    = ROOT.TFile.Open(wz_file).Get(input_tree)
 wz_lumi    = get_lumi(wz_file)
 wz_factor  = -(data_lumi / wz_lumi)
-log.info('   Events are going to be scaled by %f' % wz_factor)
-
-out_tfile.cd()
-training_vars   = args.variables+[args.cut,'weight']
-training_NTuple = ROOT.TNtuple('training_ntuple', 'training_ntuple', ':'.join(training_vars) )
-
-#Copy the data tree as it is
-log.info('copying data events into training tree')
-for row in data_tree:
-    training_NTuple.Fill(
-        array('f',
-              [ getattr(row, var) for var in training_vars ]
-          )
-    )
-
-#Copy WZ and ZZ Trees but scale each event by the proper lumi factor
+log.info('WZ events are going to be scaled by %f' % wz_factor)
 
-#WZ
-log.info('copying WZ events into training tree')
-for row in wz_tree:
-    to_fill = array('f',
-                    [ getattr(row, var) for var in training_vars ]
-                )
-    #scale by lumi factor
-    to_fill[-1] *= wz_factor
+#Read the data files as they are, and the WZ and ZZ files scaling each event
+#by the proper lumi factor, in parallel. The files are read in order, so
+#the training tree is filled while the next files are being read.
+jobs = [(i, input_tree, training_vars, 1., args.chunk_size) for i in data_files]
+jobs.append((wz_file, input_tree, training_vars, wz_factor, args.chunk_size))
+jobs.append((zz_file, input_tree, training_vars, zz_factor, args.chunk_size))
 
-    training_NTuple.Fill(
-        to_fill
-    )
+pool = multiprocessing.Pool(args.jobs)
 
-#ZZ
-log.info('copying ZZ events into training tree')
-for row in zz_tree:
-    to_fill = array('f',
-                    [ getattr(row, var) for var in training_vars ]
-                )
-    #scale by lumi factor
-    to_fill[-1] *= zz_factor
-
-    training_NTuple.Fill(
-        to_fill
-    )
+#Open the output only after the workers are started, so they don't inherit it
+out_tfile       = ROOT.TFile.Open(output_file, 'recreate')
+training_NTuple = ROOT.TNtuple('training_ntuple', 'training_ntuple', ':'.join(training_vars) )
 
+samples = []
+for job, rows in itertools.izip(jobs, pool.imap(read_training_rows, jobs)):
+    log.info('copying %i events from %s into training tree' % (len(rows), job[0]))
+    for row in rows.tolist():
+        training_NTuple.Fill( array('f', row) )
+    samples.append(rows)
+pool.close()
+pool.join()
+
+training_rows      = numpy.concatenate(samples)
+num_data           = sum(len(rows) for rows in samples[:len(data_files)])
+num_pass, num_fail = count_pass_fail(training_rows[:num_data])
+log.info("found %i input files for a total lumi: %f total passing events: %i. total failing events: %i" % (len(data_files), data_lumi, num_pass, num_fail) )
 
-num_pass    = training_NTuple.GetEntries(cut_pass.GetTitle())
-num_fail    = training_NTuple.GetEntries(cut_fail.GetTitle())
+num_pass, num_fail = count_pass_fail(training_rows)
 
 
 #Start TMVA and create factory
@@ -189,18 +190,19 @@ if args.makePlots:
     log.info("making plots")
     functor = FunctorFromMVA('kNN', target, *args.variables)
 
-    for row in training_NTuple:
-        var_d  = dict([(v, getattr(row, v)) for v in args.variables])
-        mva    = functor(**var_d)
-        weight = row.weight
-        cut    = bool( getattr(row, args.cut) )
-        for var in args.variables:
-            value = var_d[var]
-            hist_maps[var]['estimate'].Fill(value, mva*weight)
-            hist_maps[var]['all'].Fill(value, weight)
-            hist_maps[var]['estimate_all'].Fill(value, weight)
-            if cut:
-                hist_maps[var]['pass'].Fill(value, weight)
+    #Evaluate the kNN on all the training rows at once
+    columns = dict((v, training_rows[:, i]) for i, v in enumerate(training_vars))
+    mvas    = functor.evaluate_batch(
+        **dict((v, columns[v]) for v in args.variables))
+    weight  = columns['weight']
+    cut     = columns[args.cut] != 0
+
+    for var in args.variables:
+        value = columns[var]
+        fill_histogram(hist_maps[var]['estimate'], value, weights=mvas*weight)
+        fill_histogram(hist_maps[var]['all'], value, weights=weight)
+        fill_histogram(hist_maps[var]['estimate_all'], value, weights=weight)
+        fill_histogram(hist_maps[var]['pass'], value[cut], weights=weight[cut])
 
 
     canvas = plotting.Canvas(name='adsf', title='asdf')
@@ -0,0 +1,61 @@
+'''
+
+Check that TH2Corrector gives the same results as looking up the bins of the
+TH2 with FindFixBin, and survives pickling.
+
+'''
+
+from FinalStateAnalysis.StatTools.RooFunctorFromWS import TH2Corrector
+from FinalStateAnalysis.Utilities.rootbindings import ROOT
+import array
+import numpy
+import pickle
+import unittest
+
+def reference(hist, xval, yval):
+    ''' The old make_corrector_from_th2 lookup '''
+    binsx = hist.GetNbinsX()
+    binsy = hist.GetNbinsY()
+    xbin = hist.GetXaxis().FindFixBin(xval)
+    xbin = (xbin if xbin <= binsx else binsx) if xbin >= 1 else 1
+    ybin = hist.GetYaxis().FindFixBin(yval)
+    ybin = (ybin if ybin <= binsy else binsy) if ybin >= 1 else 1
+    prob = hist.GetBinContent(xbin, ybin)
+    return prob if prob else 10**-8
+
+class TestTH2Corrector(unittest.TestCase):
+    def setUp(self):
+        xbins = array.array('d', [0, 10, 15, 20, 30, 50, 100])
+        self.hist = ROOT.TH2F('fakerate', 'fakerate', len(xbins) - 1, xbins,
+                              4, 0, 2.5)
+        random = numpy.random.RandomState(42)
+        for i in range(1, self.hist.GetNbinsX() + 1):
+            for j in range(1, self.hist.GetNbinsY() + 1):
+                # Leave some bins empty, to check the floor
+                if (i + j) % 5:
+                    self.hist.SetBinContent(i, j, random.uniform(0, 1))
+        self.corrector = TH2Corrector.from_hist(self.hist)
+        self.xs = numpy.concatenate([random.uniform(-10, 120, 1000),
+                                     [0, 10, 15, 100, 120]])
+        self.ys = numpy.concatenate([random.uniform(-1, 3, 1000),
+                                     [0, 0.625, 1.25, 2.5, -0.5]])
+
+    def test_scalar(self):
+        for x, y in zip(self.xs, self.ys):
+            self.assertAlmostEqual(self.corrector(float(x), float(y)),
+                                   reference(self.hist, x, y), 6)
+
+    def test_array(self):
+        expected = [reference(self.hist, x, y)
+                    for x, y in zip(self.xs, self.ys)]
+        numpy.testing.assert_allclose(self.corrector(self.xs, self.ys),
+                                      expected, rtol=1e-6)
+
+    def test_pickle(self):
+        corrector = pickle.loads(pickle.dumps(self.corrector, 2))
+        numpy.testing.assert_array_equal(corrector(self.xs, self.ys),
+                                         self.corrector(self.xs, self.ys))
+
+
+if __name__ == '__main__':
+    unittest.main()
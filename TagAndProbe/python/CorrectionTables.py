@@ -0,0 +1,163 @@
+'''
+
+Flat NumPy lookup tables for DATA/MC corrections.
+
+Evaluating the corrections through ROOT objects (TGraph::Eval) or chains of
+Python if statements costs a PyROOT call or a dozen comparisons per lepton.
+These tables store the corrections as flat arrays, built once, which can be
+evaluated either on scalars (with a fast bisection) or on whole arrays of
+(pt, eta) in columnar selectors.
+
+GraphTable reproduces TGraph::Eval: linear interpolation between the points,
+and linear extrapolation from the first or last two points.  Linear
+combinations of GraphTables (i.e. luminosity weighted averages of periods)
+are again GraphTables, so they can be built once as well.
+
+PtEtaTable is a step function of pt and |eta|, for the binned corrections.
+
+'''
+
+import bisect
+import numpy
+
+
+_NUMBERS = (int, long, float, numpy.number)
+
+
+def is_scalar(*values):
+    ''' Check if all the arguments are plain numbers '''
+    for x in values:
+        if not isinstance(x, _NUMBERS):
+            return False
+    return True
+
+
+class GraphTable(object):
+    ''' Piecewise linear function, like TGraph::Eval
+
+    >>> table = GraphTable([0., 1., 3.], [1., 2., 0.])
+    >>> table(0.5), table(2.), table(-1.), table(4.)
+    (1.5, 1.0, 0.0, -1.0)
+    >>> table(numpy.array([0.5, 2., -1., 4.])).tolist()
+    [1.5, 1.0, 0.0, -1.0]
+    >>> other = GraphTable([0., 2.], [0., 2.])
+    >>> combined = GraphTable.weighted_sum([table, other], [0.25, 0.75])
+    >>> combined(numpy.array([-1., 0.5, 2., 4.])).tolist()
+    [-0.75, 0.75, 1.75, 2.75]
+
+    '''
+    def __init__(self, x, y):
+        order = numpy.argsort(x, kind='mergesort')
+        self.x = numpy.asarray(x, dtype=numpy.float64)[order]
+        self.y = numpy.asarray(y, dtype=numpy.float64)[order]
+        if len(self.x) < 1:
+            raise ValueError("Can't build a GraphTable without points")
+        # Plain lists are faster for scalar lookups
+        self.x_list = self.x.tolist()
+        self.y_list = self.y.tolist()
+
+    @classmethod
+    def from_graph(cls, graph):
+        ''' Build a table from the points of a TGraph '''
+        n = graph.GetN()
+        xs, ys = graph.GetX(), graph.GetY()
+        return cls([xs[i] for i in range(n)], [ys[i] for i in range(n)])
+
+    @classmethod
+    def weighted_sum(cls, tables, weights):
+        ''' Build the table of sum(weight * table)
+
+        The points of all the tables are used, so the result is exact (up to
+        rounding) everywhere, extrapolation included.
+        '''
+        x = numpy.unique(numpy.concatenate([table.x for table in tables]))
+        y = sum(weight * table(x) for table, weight in zip(tables, weights))
+        return cls(x, y)
+
+    def __call__(self, x):
+        if isinstance(x, _NUMBERS):
+            xs, ys = self.x_list, self.y_list
+            if len(xs) == 1:
+                return ys[0]
+            i = bisect.bisect_right(xs, x) - 1
+            i = min(max(i, 0), len(xs) - 2)
+            dx = xs[i + 1] - xs[i]
+            if not dx:
+                return ys[i]
+            return ys[i] + (x - xs[i]) * (ys[i + 1] - ys[i]) / dx
+        x = numpy.asarray(x, dtype=numpy.float64)
+        if len(self.x) == 1:
+            return numpy.full(x.shape, self.y[0])
+        i = numpy.searchsorted(self.x, x, side='right') - 1
+        i = numpy.clip(i, 0, len(self.x) - 2)
+        dx = self.x[i + 1] - self.x[i]
+        slope = numpy.where(dx != 0, (self.y[i + 1] - self.y[i]) /
+                            numpy.where(dx != 0, dx, 1.), 0.)
+        return self.y[i] + (x - self.x[i]) * slope
+
+
+class PtEtaTable(object):
+    ''' Step function of pt and |eta|
+
+    values[i][j] is the value in the i-th |eta| bin and j-th pt bin.  The
+    bins are defined by their inner edges, and are closed on the left
+    (lower <= x < upper), unless right_closed_pt (or right_closed_eta) is
+    set.  The first and last bins extend to infinity.
+
+    >>> table = PtEtaTable([15, 20], [1.2], [[1., 2., 3.], [4., 5., 6.]])
+    >>> table(10, 0.5), table(15, -1.3), table(50, 1.2)
+    (1.0, 5.0, 6.0)
+    >>> table(numpy.array([10, 15, 50]), numpy.array([0.5, -1.3, 1.2]))
+    array([1., 5., 6.])
+
+    '''
+    def __init__(self, pt_edges, eta_edges, values, right_closed_pt=False,
+                 right_closed_eta=False):
+        self.pt_edges = numpy.asarray(pt_edges, dtype=numpy.float64)
+        self.eta_edges = numpy.asarray(eta_edges, dtype=numpy.float64)
+        self.values = numpy.asarray(values, dtype=numpy.float64)
+        if self.values.shape != (len(eta_edges) + 1, len(pt_edges) + 1):
+            raise ValueError("Expected %i x %i values, got %s" % (
+                len(eta_edges) + 1, len(pt_edges) + 1,
+                str(self.values.shape)))
+        self.pt_side = 'left' if right_closed_pt else 'right'
+        self.eta_side = 'left' if right_closed_eta else 'right'
+        self.pt_list = self.pt_edges.tolist()
+        self.eta_list = self.eta_edges.tolist()
+        self.value_list = self.values.tolist()
+        self.pt_bisect = bisect.bisect_left if right_closed_pt \
+            else bisect.bisect_right
+        self.eta_bisect = bisect.bisect_left if right_closed_eta \
+            else bisect.bisect_right
+
+    @classmethod
+    def tabulate(cls, function, pt_edges, eta_edges, right_closed_pt=False,
+                 right_closed_eta=False):
+        ''' Build a table from a binned function(pt, abseta)
+
+        The function is evaluated once inside each bin, so it must be
+        constant in each of them.
+        '''
+        def centers(edges):
+            edges = list(edges)
+            return [edges[0] - 1.] + [
+                0.5 * (low + high) for low, high in zip(edges, edges[1:])
+            ] + [edges[-1] + 1.]
+        values = [[function(pt, eta) for pt in centers(pt_edges)]
+                  for eta in centers(eta_edges)]
+        return cls(pt_edges, eta_edges, values, right_closed_pt,
+                   right_closed_eta)
+
+    def __call__(self, pt, eta):
+        if is_scalar(pt, eta):
+            return self.value_list[self.eta_bisect(self.eta_list, abs(eta))][
+                self.pt_bisect(self.pt_list, pt)]
+        i = numpy.searchsorted(self.eta_edges, numpy.abs(eta),
+                               side=self.eta_side)
+        j = numpy.searchsorted(self.pt_edges, pt, side=self.pt_side)
+        return self.values[i, j]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
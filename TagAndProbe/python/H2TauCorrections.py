@@ -6,92 +6,86 @@ For now just the trigger and electron ID & ISO measured by Valentina.
 
 See: https://twiki.cern.ch/twiki/bin/view/CMS/HiggsToTauTauWorking2012
 
+The corrections are stored in lookup tables (see CorrectionTables), so all
+the functions accept either numbers or NumPy arrays of pt and |eta|.  The
+2012 tables are filled from the C++ functions when this module is loaded.
+
 '''
 
+from FinalStateAnalysis.TagAndProbe.CorrectionTables import PtEtaTable
 from FinalStateAnalysis.Utilities.rootbindings import ROOT
 #ROOT.gSystem.Load("libFinalStateAnalysisTagAndProbe")
 
+# Rows: |eta| bins, columns: pt bins
+_MUEG_MU_2011 = PtEtaTable([15, 20, 30], [1.2], [
+    [1.01, 0.99, 0.99, 0.992],
+    [1.03, 1.07, 1.04, 1.06],
+])
+
+_MUEG_E_2011 = PtEtaTable([15, 20, 30], [1.5], [
+    [0.98, 1.0, 1.001, 1.003],
+    [0.97, 1.05, 1.00, 1.008],
+])
+
+_E_IDISO_2011 = PtEtaTable([15, 20], [1.479], [
+    [1.04, 0.962, 0.985],
+    [0.976, 1.148, 1.012],
+])
+
+_MU_IDISO_2011 = PtEtaTable([15, 20], [1.5], [
+    [0.99, 1.02, 1.01],
+    [1.03, 1.025, 1.01],
+])
+
+# The 2012 scale factors are binned in (low, high] pt bins and [low, high)
+# |eta| bins, see src/ScaleFactorsMuEG201253X.cc
+_PT_EDGES_2012 = [10, 15, 20, 25, 30, 35]
+
+_MUEG_MU_2012 = PtEtaTable.tabulate(
+    ROOT.muTrigScale_MuEG_2012_53X, _PT_EDGES_2012, [0.8, 1.2, 1.6, 2.1],
+    right_closed_pt=True)
+
+_MUEG_E_2012 = PtEtaTable.tabulate(
+    ROOT.eleTrigScale_MuEG_2012_53X, _PT_EDGES_2012, [0.8, 1.5, 2.3],
+    right_closed_pt=True)
+
+_E_IDISO_2012 = PtEtaTable.tabulate(
+    ROOT.eleIDscale_MuEG_2012_53X, _PT_EDGES_2012, [0.8, 1.5, 2.3],
+    right_closed_pt=True)
+
+_MU_IDISO_2012 = PtEtaTable.tabulate(
+    ROOT.muIDscale_MuEG_2012_53X, _PT_EDGES_2012, [0.8, 1.2, 1.6, 2.1],
+    right_closed_pt=True)
+
 
 def correct_mueg_mu_2011(pt, abseta):
     ''' Get DATA-MC correction factor mu leg of MuEG trigger '''
-    if abseta < 1.2:
-        if pt < 15:
-            return 1.01
-        if pt < 20:
-            return 0.99
-        if pt < 30:
-            return 0.99
-        return 0.992
-    else:
-        if pt < 15:
-            return 1.03
-        if pt < 20:
-            return 1.07
-        if pt < 30:
-            return 1.04
-        return 1.06
+    return _MUEG_MU_2011(pt, abseta)
 
 
 def correct_mueg_e_2011(pt, abseta):
     ''' Get DATA-MC correction factor electron leg of MuEG trigger '''
-    if abseta < 1.5:
-        if pt < 15:
-            return 0.98
-        if pt < 20:
-            return 1.0
-        if pt < 30:
-            return 1.001
-        return 1.003
-    else:
-        if pt < 15:
-            return 0.97
-        if pt < 20:
-            return 1.05
-        if pt < 30:
-            return 1.00
-        return 1.008
+    return _MUEG_E_2011(pt, abseta)
 
 
 def correct_mueg_mu_2012(pt, abseta):
     ''' Get DATA-MC correction factor muon leg of MuEG trigger '''
-    return ROOT.muTrigScale_MuEG_2012_53X(pt, abseta)
+    return _MUEG_MU_2012(pt, abseta)
 
 
 def correct_mueg_e_2012(pt, abseta):
     ''' Get DATA-MC correction factor electron leg of MuEG trigger '''
-    return ROOT.eleTrigScale_MuEG_2012_53X(pt, abseta)
+    return _MUEG_E_2012(pt, abseta)
 
 
 def correct_e_idiso_2011(pt, abseta):
     ''' Get DATA-MC correction factor electron ID and Iso '''
-    if abseta < 1.479:
-        if pt < 15:
-            return 1.04
-        if pt < 20:
-            return 0.962
-        return 0.985
-    else:
-        if pt < 15:
-            return 0.976
-        if pt < 20:
-            return 1.148
-        return 1.012
+    return _E_IDISO_2011(pt, abseta)
 
 
 def correct_mu_idiso_2011(pt, abseta):
     ''' Get DATA-MC correction factor muon ID and Iso '''
-    if abseta < 1.5:
-        if pt < 15:
-            return 0.99
-        if pt < 20:
-            return 1.02
-        return 1.01
-    else:
-        if pt < 15:
-            return 1.03
-        if pt < 20:
-            return 1.025
-        return 1.01
+    return _MU_IDISO_2011(pt, abseta)
 
 
 def correct_e_idiso_2012(pt, abseta):
@@ -100,7 +94,7 @@ def correct_e_idiso_2012(pt, abseta):
     Twiki: HiggsToTauTauWorkingHCP2012#Electron_ID_Isolation_EMu_Channe
 
     '''
-    return ROOT.eleIDscale_MuEG_2012_53X(pt, abseta)
+    return _E_IDISO_2012(pt, abseta)
 
 
 def correct_mu_idiso_2012(pt, abseta):
@@ -108,7 +102,7 @@ def correct_mu_idiso_2012(pt, abseta):
 
     Twiki: HiggsToTauTauWorkingHCP2012#Muon_ID_Isolation_EMu_Channel
     '''
-    return ROOT.muIDscale_MuEG_2012_53X(pt, abseta)
+    return _MU_IDISO_2012(pt, abseta)
 
 
 def correct_mu_trg_2012(pt, abseta):
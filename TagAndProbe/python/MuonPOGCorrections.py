@@ -25,6 +25,11 @@ which do what they say on the tin. Each of these returns a corrector object
 that has a method "correction(pt, eta)". Note that the Mu17_Mu8 corrections are
 only available for 2012.
 
+The graphs are converted to lookup tables (see CorrectionTables) when the
+corrector is built, so the correctors can be called either with numbers or
+with NumPy arrays of pt and eta (in columnar selectors).  The 2011 and 2012
+combiners build a single luminosity weighted table of the periods.
+
 The trigger efficiencies for 2011 are encoded in a C++ file::
 interface/MuonPOG2011HLTEfficiencies.h
 
@@ -35,8 +40,12 @@ muon_pog_Mu13Mu8_eta_eta_2011(eta1, eta2)
 
 '''
 
+import copy
+import numpy
 import os
 import re
+from FinalStateAnalysis.TagAndProbe.CorrectionTables import GraphTable, \
+    is_scalar
 from FinalStateAnalysis.Utilities.rootbindings import ROOT
 
 _DATA_DIR = os.path.join(os.environ['CMSSW_BASE'], 'src',
@@ -227,6 +236,8 @@ Muon POG corrections are generally by eta dependent for pt > 20,
 and pt dependent for pt < 20, split by barrel and endcap.
 
 '''
+    tables = ('correct_by_pt_barrel', 'correct_by_pt_endcap',
+              'correct_by_eta_pt20')
 
     def __init__(self, file, pt_barrel, pt_endcap, eta_pt20, abs_eta=False, pt_thr=20):
         self.filename = file
@@ -234,7 +245,7 @@ and pt dependent for pt < 20, split by barrel and endcap.
         self.abs_eta = abs_eta
         self.pt_thr = pt_thr
 
-        # Map the functions to the appropriate TGraphAsymmErrors
+        # Map the functions to lookup tables of the TGraphAsymmErrors
         self.correct_by_pt_barrel = self.load_graph_eval_func(pt_barrel)
         self.correct_by_pt_endcap = self.load_graph_eval_func(pt_endcap)
         self.correct_by_eta_pt20 = self.load_graph_eval_func(eta_pt20)
@@ -248,9 +259,23 @@ and pt dependent for pt < 20, split by barrel and endcap.
         obj = key.ReadObj()
         if not obj:
             raise IOError("Object with key name %s d.n.e. can't be read" % name)
-        return obj.Eval
+        return GraphTable.from_graph(obj)
+
+    def options(self):
+        ''' The options which must match to combine correctors '''
+        return (self.pt_thr, self.abs_eta)
 
     def __call__(self, pt, eta):
+        if not is_scalar(pt, eta):
+            pt, eta = numpy.broadcast_arrays(
+                numpy.asarray(pt, dtype=numpy.float64),
+                numpy.asarray(eta, dtype=numpy.float64))
+            abseta = numpy.abs(eta)
+            return numpy.where(
+                pt < self.pt_thr,
+                numpy.where(abseta < 1.2, self.correct_by_pt_barrel(pt),
+                            self.correct_by_pt_endcap(pt)),
+                self.correct_by_eta_pt20(abseta if self.abs_eta else eta))
         if pt < self.pt_thr:
             if abs(eta) < 1.2:
                 return self.correct_by_pt_barrel(pt)
@@ -270,13 +295,15 @@ class MuonPOGCorrection3R(object):
     and pt dependent for pt < 20, split by barrel, overlap and endcap.
 
     '''
+    tables = ('correct_by_pt_barrel', 'correct_by_pt_overlap',
+              'correct_by_pt_endcap', 'correct_by_eta_pt20')
 
     def __init__(self, file, pt_barrel, pt_overlap, pt_endcap, eta_pt20, pt_thr=20):
         self.filename = file
         self.file = ROOT.TFile.Open(file)
         self.pt_thr  = pt_thr
 
-        # Map the functions to the appropriate TGraphAsymmErrors
+        # Map the functions to lookup tables of the TGraphAsymmErrors
         self.correct_by_pt_barrel = self.load_graph_eval_func(pt_barrel)
         self.correct_by_pt_overlap = self.load_graph_eval_func(pt_overlap)
         self.correct_by_pt_endcap = self.load_graph_eval_func(pt_endcap)
@@ -291,9 +318,24 @@ class MuonPOGCorrection3R(object):
         obj = key.ReadObj()
         if not obj:
             raise IOError("Object with key name %s d.n.e. can't be read" % name)
-        return obj.Eval
+        return GraphTable.from_graph(obj)
+
+    def options(self):
+        ''' The options which must match to combine correctors '''
+        return (self.pt_thr,)
 
     def __call__(self, pt, eta):
+        if not is_scalar(pt, eta):
+            pt, eta = numpy.broadcast_arrays(
+                numpy.asarray(pt, dtype=numpy.float64),
+                numpy.asarray(eta, dtype=numpy.float64))
+            abseta = numpy.abs(eta)
+            by_pt = numpy.where(
+                abseta < 0.9, self.correct_by_pt_barrel(pt),
+                numpy.where(abseta < 1.2, self.correct_by_pt_overlap(pt),
+                            self.correct_by_pt_endcap(pt)))
+            return numpy.where(pt < self.pt_thr, by_pt,
+                               self.correct_by_eta_pt20(eta))
 
         if pt < self.pt_thr:
             if abs(eta) < 0.9:
@@ -309,31 +351,61 @@ class MuonPOGCorrection3R(object):
 
 
 
+def combine_correctors(correctors, weights):
+    ''' Build a single corrector with the weighted average of the tables
+
+    Returns None if the correctors can't be combined (different types or
+    pt thresholds).
+    '''
+    first = correctors[0]
+    for corrector in correctors[1:]:
+        if type(corrector) is not type(first) or \
+                corrector.options() != first.options():
+            return None
+    output = copy.copy(first)
+    for name in first.tables:
+        setattr(output, name, GraphTable.weighted_sum(
+            [getattr(x, name) for x in correctors], weights))
+    return output
+
+
 class MuonPOG2011Combiner(object):
     ''' They provide 2011 A and B separate, we have to combine them '''
+    # Weighted average, by int. lumi
+    weights = (2.1/4.6, 2.5/4.6)
+
     def __init__(self, corrector2011A, corrector2011B):
         self.corrA = corrector2011A
         self.corrB = corrector2011B
+        self.combined = combine_correctors([self.corrA, self.corrB],
+                                           self.weights)
 
     def __call__(self, pt, eta):
-        # Weighted average, by int. lumi
-        return self.corrA(pt, eta)*(2.1/4.6) + \
-                self.corrB(pt, eta)*(2.5/4.6)
+        if self.combined is not None:
+            return self.combined(pt, eta)
+        return self.corrA(pt, eta)*self.weights[0] + \
+                self.corrB(pt, eta)*self.weights[1]
 
 
 
 class MuonPOG2012Combiner(object):
     ''' They provide 2012 A, B, C, D separate, we have to combine them '''
+    # Weighted average, by int. lumi
+    # CHECK THE NUMBERS!!! - Lumi split by ranges just a guess right now
+    weights = (1./19., 4./19., 6./19., 8./19.)
+
     def __init__(self, corrector2012A, corrector2012B, corrector2012C, corrector2012D):
         self.corrA = corrector2012A
         self.corrB = corrector2012B
         self.corrC = corrector2012C
         self.corrD = corrector2012D
+        self.combined = combine_correctors(
+            [self.corrA, self.corrB, self.corrC, self.corrD], self.weights)
 
     def __call__(self, pt, eta):
-        # Weighted average, by int. lumi
-        return self.corrA(pt, eta)*(1./19.) + self.corrB(pt, eta)*(4./19.) + self.corrC(pt, eta)*(6./19.) + self.corrD(pt, eta)*(8./19.)
-                # CHECK THE NUMBERS!!! - Lumi split by ranges just a guess right now
+        if self.combined is not None:
+            return self.combined(pt, eta)
+        return self.corrA(pt, eta)*self.weights[0] + self.corrB(pt, eta)*self.weights[1] + self.corrC(pt, eta)*self.weights[2] + self.corrD(pt, eta)*self.weights[3]
 
 
 
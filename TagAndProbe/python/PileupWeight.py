@@ -4,21 +4,111 @@ Class which figures out the correct PU weight.
 Takes as input a MC PU tag (i.e. 'S7') and a set of .root files with the
 pileup distributions (generated by pileupCalc.py [1])
 
+The data/MC ratio is computed once, as an array of per bin weights, and
+cached on disk in $PILEUPWEIGHTCACHE (default: ~/.pileupweights), keyed by
+the MC tag and the paths and modification times of the input files.  If the
+cache can't be read or written, the weights are just computed again.  The
+weights can be evaluated on a number or on a NumPy array of nTruePU.
+
 [1] https://twiki.cern.ch/twiki/bin/view/CMS/PileupJSONFileforData
 
 Author: Evan K. Friis, UW
 
 '''
 
-import array
+import bisect
+import hashlib
+import logging
+import numpy
+import os
 from FinalStateAnalysis.Utilities.FileInPath import FileInPath
 import ROOT
 
+log = logging.getLogger(__name__)
+
 # MC distributions (built at bottom of file)
 _MC_PU_DISTRIBUTIONS = {}
 
+DEFAULT_CACHE = os.environ.get(
+    'PILEUPWEIGHTCACHE', os.path.expanduser('~/.pileupweights'))
+
+# Relative uncertainty on the min. bias cross section, used to build the
+# up/down variations when no shifted data files are given.
+DEFAULT_SHIFT = 0.05
+
+
+def _histogram_arrays(histogram):
+    ''' Get the (bin edges, contents with under/overflow) of a TH1 '''
+    nbins = histogram.GetNbinsX()
+    axis = histogram.GetXaxis()
+    edges = numpy.array([axis.GetBinLowEdge(i) for i in range(1, nbins + 2)])
+    contents = numpy.array(
+        [histogram.GetBinContent(i) for i in range(nbins + 2)])
+    return edges, contents
+
+
+def _read_pileup(filenames):
+    ''' Sum the 'pileup' histograms of a list of files '''
+    edges, total = None, None
+    for filename in filenames:
+        file = ROOT.TFile.Open(filename)
+        if not file:
+            raise IOError("Can't open PU file: %s" % filename)
+        file_edges, contents = _histogram_arrays(file.Get('pileup'))
+        file.Close()
+        if total is None:
+            edges, total = file_edges, contents
+        else:
+            total = total + contents
+    return edges, total
+
+
+def _normalize(contents):
+    ''' Normalize to the integral of the bins (without under/overflow) '''
+    return contents / contents[1:-1].sum()
+
+
+def shift_distribution(edges, contents, shift):
+    ''' Scale the x axis of a (normalized) distribution by (1 + shift)
+
+    This is how a change of the min. bias cross section moves the number of
+    true interactions in data.  The under/overflow are kept as is.
+
+    >>> edges = numpy.array([0., 1., 2., 3., 4.])
+    >>> contents = numpy.array([0., 0., 1., 0., 0., 0.])
+    >>> shifted = shift_distribution(edges, contents, 1.)
+    >>> [round(x, 3) for x in shifted]
+    [0.0, 0.0, 0.143, 0.429, 0.429, 0.0]
+
+    '''
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    density = contents[1:-1]
+    shifted = numpy.interp(centers / (1. + shift), centers, density,
+                           left=0., right=0.)
+    output = contents.copy()
+    output[1:-1] = shifted * density.sum() / shifted.sum()
+    return output
+
+
+def _ratio(data, mc):
+    ''' data/mc, or 1 where there is no MC '''
+    output = numpy.ones(len(data))
+    nonzero = mc != 0
+    output[nonzero] = data[nonzero] / mc[nonzero]
+    return output
+
+
+def _file_stamps(filenames):
+    stamps = []
+    for filename in filenames:
+        stat = os.stat(filename) if os.path.exists(filename) else None
+        stamps.append((os.path.abspath(filename),
+                       stat and stat.st_mtime, stat and stat.st_size))
+    return stamps
+
+
 class PileupWeight(object):
-    def __init__(self, mctag, *datafiles):
+    def __init__(self, mctag, *datafiles, **kwargs):
         '''
         Build a PU weight object.
 
@@ -32,58 +122,141 @@ class PileupWeight(object):
         Note that for 7TeV data there must be 500 bins (0-50) and for 8TeV there
         should 600 bins (0-60)
 
-        '''
-        self.data = None
-        for filename in datafiles:
-            file = ROOT.TFile.Open(filename)
-            pu = file.Get('pileup')
-            if self.data is None:
-                self.data = pu.Clone()
-                self.data.SetDirectory(0)
-            else:
-                self.data.Add(pu)
-            file.Close()
+        The up/down variations use the [up] and [down] lists of data files
+        (computed with a shifted min. bias cross section) if given, otherwise
+        the data distribution is stretched by 1 +/- [shift].  The ratios are
+        cached in [cache_dir] (None to disable the cache).
 
-        # Normalize
-        self.data.Scale(1./self.data.Integral())
+        '''
+        up = kwargs.pop('up', None)
+        down = kwargs.pop('down', None)
+        shift = kwargs.pop('shift', DEFAULT_SHIFT)
+        cache_dir = kwargs.pop('cache_dir', DEFAULT_CACHE)
+        if kwargs:
+            raise TypeError("Unknown options: %s" % ", ".join(kwargs))
 
         if not mctag in _MC_PU_DISTRIBUTIONS:
             raise KeyError("Unknown PU distribution %s, allowed: %s" %
                            (mctag, " ".join(_MC_PU_DISTRIBUTIONS.keys())))
+        mc_file = _MC_PU_DISTRIBUTIONS[mctag]
+
+        # Everything the weights depend on
+        key = repr((mctag, _file_stamps([mc_file]), _file_stamps(datafiles),
+                    up and _file_stamps(up), down and _file_stamps(down),
+                    shift))
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = os.path.join(
+                cache_dir, hashlib.md5(key).hexdigest() + '.npz')
 
-        mc_file = ROOT.TFile.Open(_MC_PU_DISTRIBUTIONS[mctag])
-        if not mc_file:
-            raise IOError("Can't open %s MC file: %s" % (mctag, _MC_PU_DISTRIBUTIONS[mctag]))
+        if cache_file is None or not self.load(cache_file):
+            self.build(mctag, mc_file, datafiles, up, down, shift)
+            if cache_file is not None:
+                try:
+                    self.save(cache_file)
+                except (IOError, OSError), e:
+                    # i.e. read-only or missing HOME on batch nodes
+                    log.warning("Can't write PU weight cache %s: %s",
+                                cache_file, e)
 
-        mc_base = mc_file.Get('pileup')
-        self.mc = mc_base.Clone()
+        # Plain lists are faster for single lookups
+        self.edge_list = self.edges.tolist()
+        self.weight_list = self.weights.tolist()
+
+    def build(self, mctag, mc_file, datafiles, up, down, shift):
+        ''' Compute the data/MC weights from the input files '''
+        data_edges, data = _read_pileup(datafiles)
+        mc_edges, mc = _read_pileup([mc_file])
 
         # Make sure bins are consistent
-        if not ROOT.TEfficiency.CheckBinning(self.mc, self.data):
+        if len(mc_edges) != len(data_edges) or \
+                not numpy.allclose(mc_edges, data_edges):
             error = "Data and MC PU histograms do not have the same binning!\n"
             def print_bins(tag, x):
                 return "%s: (%i, %0.1f, %0.1f)" % (
-                    tag, x.GetNbinsX(), x.GetXaxis().GetXmin(),
-                    x.GetXaxis().GetXmax())
-            error += print_bins(mctag, self.mc)
+                    tag, len(x) - 1, x[0], x[-1])
+            error += print_bins(mctag, mc_edges)
             error += "\n"
-            error += print_bins('data', self.data)
+            error += print_bins('data', data_edges)
             raise ValueError(error)
 
-        # Normalize MC
-        self.mc.Scale(1./self.mc.Integral())
+        # Normalize
+        data = _normalize(data)
+        mc = _normalize(mc)
+
+        variations = []
+        for files, sign in [(up, 1), (down, -1)]:
+            if files:
+                edges, shifted = _read_pileup(files)
+                if len(edges) != len(data_edges):
+                    raise ValueError(
+                        "Shifted data PU histograms have a different binning")
+                variations.append(_normalize(shifted))
+            else:
+                variations.append(
+                    shift_distribution(data_edges, data, sign * shift))
+
+        self.edges = data_edges
+        self.weights = _ratio(data, mc)
+        self.weights_up = _ratio(variations[0], mc)
+        self.weights_down = _ratio(variations[1], mc)
+
+    def load(self, cache_file):
+        ''' Read the weights from the cache, returns False if it fails '''
+        if not os.path.exists(cache_file):
+            return False
+        try:
+            with numpy.load(cache_file) as cached:
+                self.edges = cached['edges']
+                self.weights = cached['weights']
+                self.weights_up = cached['weights_up']
+                self.weights_down = cached['weights_down']
+        except (IOError, OSError, KeyError, ValueError), e:
+            log.warning("Can't read PU weight cache %s: %s", cache_file, e)
+            return False
+        return True
+
+    def save(self, cache_file):
+        ''' Write the weights to the cache, atomically '''
+        directory = os.path.dirname(cache_file)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another job created it in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        temp = cache_file + '.%i.tmp' % os.getpid()
+        try:
+            with open(temp, 'wb') as output:
+                numpy.savez(output, edges=self.edges, weights=self.weights,
+                            weights_up=self.weights_up,
+                            weights_down=self.weights_down)
+            os.rename(temp, cache_file)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def lookup(self, weights, ntruepu):
+        ''' Get the weights in the bins of ntruepu, like TH1::FindBin '''
+        return weights[numpy.searchsorted(self.edges, ntruepu, side='right')]
 
     def __call__(self, ntruepu):
         '''
         Get the PU weight given the true number of interactions
         '''
-        bin = self.data.FindBin(ntruepu)
-        data = self.data.GetBinContent(bin)
-        mc = self.mc.GetBinContent(bin)
-        if mc:
-            return data/mc
-        else:
-            return 1.0
+        if isinstance(ntruepu, (int, long, float)):
+            return self.weight_list[
+                bisect.bisect_right(self.edge_list, ntruepu)]
+        return self.lookup(self.weights, ntruepu)
+
+    def up(self, ntruepu):
+        ''' PU weight with the data distribution shifted up '''
+        return self.lookup(self.weights_up, ntruepu)
+
+    def down(self, ntruepu):
+        ''' PU weight with the data distribution shifted down '''
+        return self.lookup(self.weights_down, ntruepu)
 
 _MC_PU_DISTRIBUTIONS['S10'] = FileInPath("FinalStateAnalysis/TagAndProbe/data/MC_Summer12_PU_S10-600bins.root").full_path()
 _MC_PU_DISTRIBUTIONS['S7'] = 'fixme'
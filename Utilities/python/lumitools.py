@@ -2,10 +2,15 @@
 
 Tools for messing about with lumis and JSON files
 
+Lumi masks are represented by LumiMask objects, which store a sorted list of
+[first, last] lumi intervals for each run (just like the JSON format), so
+set operations never expand the masks into individual lumis.
+
 Author: Evan K. Friis, UW Madison
 
 '''
 
+import bisect
 import csv
 import json
 
@@ -61,22 +66,218 @@ def collapse_ranges_in_list(xs):
             output = [x, x]
     yield output
 
+def _merge_intervals(intervals):
+    '''
+    Sort and merge overlapping or adjacent [first, last] intervals.
+    Example:
+    >>> _merge_intervals([[8, 10], [1, 3], [2, 5], [6, 6]])
+    [[1, 6], [8, 10]]
+    '''
+    output = []
+    for first, last in sorted(intervals):
+        if output and first <= output[-1][1] + 1:
+            output[-1][1] = max(output[-1][1], last)
+        else:
+            output.append([first, last])
+    return output
+
+def _intersect_intervals(a, b):
+    '''
+    Intersection of two sorted lists of disjoint intervals.
+    Example:
+    >>> _intersect_intervals([[1, 5], [8, 10]], [[3, 9]])
+    [[3, 5], [8, 9]]
+    '''
+    output = []
+    i, j = 0, 0
+    while i < len(a) and j < len(b):
+        first = max(a[i][0], b[j][0])
+        last = min(a[i][1], b[j][1])
+        if first <= last:
+            output.append([first, last])
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return output
+
+def _subtract_intervals(a, b):
+    '''
+    Difference of two sorted lists of disjoint intervals.
+    Example:
+    >>> _subtract_intervals([[1, 10], [12, 15]], [[3, 4], [9, 13]])
+    [[1, 2], [5, 8], [14, 15]]
+    '''
+    output = []
+    j = 0
+    for first, last in a:
+        current = first
+        while j < len(b) and b[j][1] < current:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] <= last:
+            if b[k][0] > current:
+                output.append([current, b[k][0] - 1])
+            current = max(current, b[k][1] + 1)
+            k += 1
+        if current <= last:
+            output.append([current, last])
+    return output
+
+class LumiMask(object):
+    '''
+    A set of run-lumis, stored as intervals.
+    Example:
+    >>> a = LumiMask({'100': [[1, 10]], '150': [[1, 2], [8, 8]]})
+    >>> b = LumiMask.from_run_lumis([(100, 5), (100, 6), (150, 2), (200, 1)])
+    >>> sorted((a | b).to_json().items())
+    [('100', [[1, 10]]), ('150', [[1, 2], [8, 8]]), ('200', [[1, 1]])]
+    >>> sorted((a & b).to_json().items())
+    [('100', [[5, 6]]), ('150', [[2, 2]])]
+    >>> sorted((a - b).to_json().items())
+    [('100', [[1, 4], [7, 10]]), ('150', [[1, 1], [8, 8]])]
+    >>> (100, 7) in a, (100, 11) in a, len(a), len(b)
+    (True, False, 13, 4)
+    >>> a.contains([100, 100, 150, 150, 300], [0, 10, 2, 3, 1]).tolist()
+    [False, True, True, False, False]
+    >>> a.select_runs(120, None).to_json()
+    {'150': [[1, 2], [8, 8]]}
+    '''
+    def __init__(self, mask=None):
+        # run => sorted list of disjoint [first, last] lumi intervals
+        self.runs = {}
+        for run, intervals in (mask or {}).iteritems():
+            merged = _merge_intervals(intervals)
+            if merged:
+                self.runs[int(run)] = merged
+
+    @classmethod
+    def from_run_lumis(cls, run_lumis):
+        ''' Build a mask from an iterable of (run, lumi) '''
+        output = cls()
+        for run, lumi in sorted(run_lumis):
+            intervals = output.runs.setdefault(run, [])
+            if intervals and lumi <= intervals[-1][1] + 1:
+                intervals[-1][1] = max(intervals[-1][1], lumi)
+            else:
+                intervals.append([lumi, lumi])
+        return output
+
+    @classmethod
+    def from_file(cls, filepath):
+        '''
+        Read a lumi mask from a json file.
+        If filepath is of the form file:first:last then only take runs between
+        first and last.
+        '''
+        path = filepath
+        first = None
+        last = None
+        if ':' in filepath:
+            path, first, last = tuple(filepath.split(':'))
+            first = int(first)
+            last = int(last)
+        with open(path, 'r') as file:
+            return cls(json.load(file)).select_runs(first, last)
+
+    def to_json(self):
+        ''' Convert to a crab -report like json summary '''
+        return dict((str(run), [list(x) for x in intervals])
+                    for run, intervals in self.runs.iteritems())
+
+    def select_runs(self, first=None, last=None):
+        ''' Get the part of the mask with first <= run <= last '''
+        output = LumiMask()
+        for run, intervals in self.runs.iteritems():
+            if first is not None and run < first:
+                continue
+            if last is not None and run > last:
+                continue
+            output.runs[run] = [list(x) for x in intervals]
+        return output
+
+    def _combine(self, other, operation, runs):
+        output = LumiMask()
+        for run in runs:
+            intervals = operation(self.runs.get(run, []),
+                                  other.runs.get(run, []))
+            if intervals:
+                output.runs[run] = intervals
+        return output
+
+    def union(self, other):
+        return self._combine(other, lambda a, b: _merge_intervals(a + b),
+                             set(self.runs) | set(other.runs))
+
+    def intersection(self, other):
+        return self._combine(other, _intersect_intervals,
+                             set(self.runs) & set(other.runs))
+
+    def difference(self, other):
+        return self._combine(other, _subtract_intervals, self.runs)
+
+    __or__ = union
+    __add__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def __contains__(self, run_lumi):
+        run, lumi = run_lumi
+        intervals = self.runs.get(run)
+        if not intervals:
+            return False
+        i = bisect.bisect_right(intervals, [lumi, float('inf')]) - 1
+        return i >= 0 and lumi <= intervals[i][1]
+
+    def contains(self, runs, lumis):
+        ''' Vectorized membership test for arrays of runs and lumis '''
+        import numpy
+        runs = numpy.asarray(runs)
+        lumis = numpy.asarray(lumis)
+        output = numpy.zeros(len(runs), dtype=bool)
+        for run in numpy.unique(runs):
+            intervals = self.runs.get(int(run))
+            if not intervals:
+                continue
+            selected = (runs == run)
+            firsts = numpy.array([x[0] for x in intervals])
+            lasts = numpy.array([x[1] for x in intervals])
+            run_lumis = lumis[selected]
+            position = numpy.searchsorted(firsts, run_lumis, side='right') - 1
+            inside = position >= 0
+            inside[inside] = run_lumis[inside] <= lasts[position[inside]]
+            output[selected] = inside
+        return output
+
+    def __iter__(self):
+        for run in sorted(self.runs):
+            for first, last in self.runs[run]:
+                for lumi in xrange(first, last + 1):
+                    yield (run, lumi)
+
+    def __len__(self):
+        return sum(last - first + 1 for intervals in self.runs.itervalues()
+                   for first, last in intervals)
+
+    def __eq__(self, other):
+        return self.runs == other.runs
+
+    def __ne__(self, other):
+        return not self == other
+
 def json_summary(run_lumi_set):
     '''
-    Compute a crab -report like json summary for a set of runs and lumis.
+    Compute a crab -report like json summary for a set of runs and lumis,
+    or a LumiMask.
     Example:
     >>> run_lumis = [(100, 2), (100, 1), (150, 1), (150, 2), (150, 8)]
     >>> # Disable indentation
     >>> json_summary(run_lumis)
     {'150': [[1, 2], [8, 8]], '100': [[1, 2]]}
     '''
-    run_lumis = sorted(run_lumi_set)
-    output = {}
-    if not run_lumis:
-        return output
-    for run, lumis_in_run in group_by_run(run_lumis):
-        output[str(run)] = list(collapse_ranges_in_list(lumis_in_run))
-    return output
+    if isinstance(run_lumi_set, LumiMask):
+        return run_lumi_set.to_json()
+    return LumiMask.from_run_lumis(run_lumi_set).to_json()
 
 def lumi_list(lumimask, first=None, last=None):
     '''
@@ -96,21 +297,12 @@ def lumi_list(lumimask, first=None, last=None):
 
 def lumi_list_from_file(filepath):
     '''
-    Read a lumi mask from a json file and convert to to a set of run, lumis.
+    Read a lumi mask from a json file as a LumiMask.  It supports the set
+    operations (|, &, -), "in", len() and iteration over (run, lumi)s.
     If filepath is of the form file:first:last then only take runs between first
     and last.
     '''
-    path = filepath
-    first = None
-    last = None
-    if ':' in filepath:
-        path, first, last = tuple(filepath.split(':'))
-        first = int(first)
-        last = int(last)
-    result = None
-    with open(path, 'r') as file:
-        result = lumi_list(json.load(file), first, last)
-    return result
+    return LumiMask.from_file(filepath)
 
 if __name__ == "__main__":
     import doctest; doctest.testmod()
@@ -5,18 +5,21 @@ Stupid script to check the number of entries in an Ntuple
 
 Usage: get_ntuple_entries.py [tree] file1 [file2] ...
 
+The entry counts are cached in the MegaIndex.
+
 '''
 
+import glob
 import sys
-import ROOT
 
-treename = sys.argv[1]
-files = sys.argv[2:]
+from FinalStateAnalysis.PlotTools.MegaIndex import MegaIndex
 
-chain = ROOT.TChain(treename)
-for file in files:
-    chain.Add(file)
+treename = sys.argv[1]
+files = []
+for pattern in sys.argv[2:]:
+    # Expand wildcards like TChain::Add does
+    files.extend(sorted(glob.glob(pattern)) if '*' in pattern else [pattern])
 
 print "Added %i files" % len(files)
 
-print chain.GetEntries()
+print sum(entries for file, entries in MegaIndex().entries(files, treename))
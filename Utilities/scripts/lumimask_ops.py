@@ -30,9 +30,9 @@ if __name__ == "__main__":
     lumis2 = lumitools.lumi_list_from_file(args.lumimask2)
 
     set_operations = {
-        '+' : set.union,
-        '-' : set.difference,
-        'and' : set.intersection,
+        '+' : lumitools.LumiMask.union,
+        '-' : lumitools.LumiMask.difference,
+        'and' : lumitools.LumiMask.intersection,
     }
 
     result = set_operations[args.operation](lumis1, lumis2)